@@ -0,0 +1,189 @@
+"""Admission control: per-route concurrency and queue limits, DB time limits.
+
+Each route (Flask endpoint) gets at most ADMISSION_CONCURRENCY requests in
+flight per worker, with at most ADMISSION_QUEUE more waiting up to
+ADMISSION_QUEUE_TIMEOUT seconds for a slot; anything beyond that is turned
+away at once with 503 and Retry-After.  ADMISSION_LIMITS overrides this
+per route as ``endpoint=concurrency/queue``, e.g.
+``get_students_by_class_db=2/4,export_people=1/0``; 0 concurrency means
+unlimited.  Routes in ADMISSION_EXEMPT never touch the database and are
+always admitted.  A streamed response (the exports) holds its slot until
+the body has been sent or the client goes away.
+
+The statements of a request are bounded by DB_STATEMENT_TIMEOUT
+milliseconds (DB_STATEMENT_TIMEOUTS per route, 0 for none) and its wait for
+a connection by DB_CONNECT_TIMEOUTS seconds per route (default: the pool
+timeout).  A request that failed because it could not get a connection
+(the pool's circuit breaker is open or the wait ran out), lost it, or hit
+its statement timeout is answered with 503 and Retry-After instead of 500.
+"""
+import os
+import threading
+import time
+
+from flask import g, has_request_context, jsonify
+
+import metrics
+from db import CircuitOpen, on_unavailable, reset_request_limits, set_request_limits
+
+
+def _parse_map(name, default='', cast=float):
+    """``endpoint=value,...`` from the environment variable ``name``"""
+    result = {}
+    for item in os.environ.get(name, default).split(','):
+        if item.strip():
+            endpoint, _, value = item.partition('=')
+            result[endpoint.strip()] = cast(value)
+    return result
+
+
+def _limit(value):
+    concurrency, _, queue = value.partition('/')
+    return int(concurrency), int(queue or ADMISSION_QUEUE)
+
+
+ADMISSION_CONCURRENCY = int(os.environ.get('ADMISSION_CONCURRENCY', os.environ.get('DB_POOL_MAX', 10)))
+ADMISSION_QUEUE = int(os.environ.get('ADMISSION_QUEUE', 10))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+ADMISSION_LIMITS = _parse_map('ADMISSION_LIMITS', cast=_limit)
+ADMISSION_EXEMPT = set(os.environ.get(
+    'ADMISSION_EXEMPT', 'home,list_routes,prometheus_metrics,debug_info,healthz,readyz,static').split(','))
+
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 15000))
+# Streaming exports, bulk loads and view refreshes legitimately run long
+DB_STATEMENT_TIMEOUTS = _parse_map(
+    'DB_STATEMENT_TIMEOUTS', 'export_people=0,export_activities=0,bulk_add_people=0,refresh_matviews=0', int)
+DB_CONNECT_TIMEOUTS = _parse_map('DB_CONNECT_TIMEOUTS')
+
+rejected = metrics.register(metrics.Counter(
+    'http_requests_rejected_total', 'Requests turned away with 503', ('route', 'reason')))
+
+
+class RouteLimiter:
+    """At most ``concurrency`` holders at once and ``queue`` waiting for a turn"""
+
+    def __init__(self, concurrency, queue):
+        self.concurrency = concurrency
+        self.queue = queue
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._stats = {'admitted': 0, 'rejected': 0, 'timed_out': 0}
+
+    def acquire(self, timeout):
+        """Take a slot, waiting at most ``timeout`` seconds in the queue; False if refused"""
+        with self._cond:
+            if self._active >= self.concurrency:
+                if self._waiting >= self.queue:
+                    self._stats['rejected'] += 1
+                    return False
+                deadline = time.monotonic() + timeout
+                self._waiting += 1
+                try:
+                    while self._active >= self.concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats['timed_out'] += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self._stats['admitted'] += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def status(self):
+        with self._cond:
+            return {'concurrency': self.concurrency, 'queue': self.queue,
+                    'active': self._active, 'waiting': self._waiting, **self._stats}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(endpoint):
+    """This worker's limiter for ``endpoint``, or None if it is unlimited"""
+    with _limiters_lock:
+        if endpoint not in _limiters:
+            concurrency, queue = ADMISSION_LIMITS.get(endpoint, (ADMISSION_CONCURRENCY, ADMISSION_QUEUE))
+            _limiters[endpoint] = RouteLimiter(concurrency, queue) if concurrency > 0 else None
+        return _limiters[endpoint]
+
+
+def _unavailable(retry_after, reason):
+    response = jsonify({'error': 'Service temporarily overloaded, retry later', 'reason': reason})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(retry_after))
+    return response
+
+
+def admit(endpoint):
+    """Before a request: take a slot for its route and set its DB limits.
+
+    Returns a 503 response when the route is full, None to go ahead.
+    """
+    if endpoint is None or endpoint in ADMISSION_EXEMPT:
+        return None
+    route_limiter = limiter(endpoint)
+    if route_limiter is not None:
+        if not route_limiter.acquire(ADMISSION_QUEUE_TIMEOUT):
+            rejected.inc(endpoint, 'concurrency')
+            return _unavailable(ADMISSION_RETRY_AFTER, 'too many concurrent requests for this route')
+        g.admission_limiter = route_limiter
+    g.admission_limits = set_request_limits(
+        DB_STATEMENT_TIMEOUTS.get(endpoint, DB_STATEMENT_TIMEOUT) or None, DB_CONNECT_TIMEOUTS.get(endpoint))
+    return None
+
+
+def release():
+    """At request teardown: give back the route slot and the DB limits"""
+    token = g.pop('admission_limits', None)
+    if token is not None:
+        reset_request_limits(token)
+    route_limiter = g.pop('admission_limiter', None)
+    if route_limiter is not None:
+        route_limiter.release()
+
+
+def hold_for_stream(response):
+    """After a request: keep a streamed response's route slot until its body
+    has been sent, rather than giving it back when the headers go out"""
+    if response.is_streamed:
+        route_limiter = g.pop('admission_limiter', None)
+        if route_limiter is not None:
+            response.call_on_close(route_limiter.release)
+    return response
+
+
+def _remember_unavailable(exc):
+    if has_request_context():
+        g.db_unavailable = exc
+
+
+def degrade(response, endpoint):
+    """Turn the 500 of a request that the database could not serve into a 503"""
+    exc = g.pop('db_unavailable', None)
+    if exc is None or response.status_code != 500:
+        return response
+    retry_after = exc.retry_after if isinstance(exc, CircuitOpen) else ADMISSION_RETRY_AFTER
+    rejected.inc(endpoint or 'unmatched', 'database')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(retry_after))
+    return response
+
+
+def status():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {endpoint: route_limiter.status() for endpoint, route_limiter in limiters.items()
+            if route_limiter is not None}
+
+
+on_unavailable(_remember_unavailable)
@@ -1,36 +1,111 @@
-from flask import Flask, jsonify, request
-import psycopg2
+from flask import Flask, Response, g, jsonify, request
 import os
-from dotenv import load_dotenv
-import random
 
-# Load environment variables from .env file
-load_dotenv()
+import admission
+import batch
+import changes
+import compression
+import health
+import matviews
+import metrics
+import prepared
+import search
+import stats
+import writebehind
+from bulk import BULK_CHUNK_SIZE, insert_people, parse_upload
+from db import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS, get_connection, pool
+from export import EXPORT_FORMATS, parse_export_args, primed, stream_export
+from pagination import (
+    paginated_query, parse_fields, parse_filters, parse_ids, parse_include, parse_page, split_page,
+)
+from queries import (
+    ACTIVITIES_COLUMNS, ACTIVITIES_FROM, ACTIVITIES_GENDER_JOIN, ACTIVITIES_SELECT, ACTIVITY_FLAG_FILTERS,
+    CLASS_STUDENTS_COLUMNS, CLASS_STUDENTS_FROM, DELETE_PERSON, INSERT_DEFAULT_ACTIVITIES, INSERT_PERSON,
+    PEOPLE_FLAG_FILTERS, PEOPLE_LIST_COLUMNS, PEOPLE_LIST_FROM, PEOPLE_SELECT, VIEW_FLAG_FILTERS, WITH_ACTIVITIES,
+    nest_activities, select_columns,
+)
+from refdata import cache_stats, classes, genders
+from replicas import read_connection, remember_write, replicas
+from response_cache import cached_response, stats as response_cache_stats
+from serialization import install_json_provider, parse_row_format, tabulate
+from singleflight import coalesced, flights
 
 app = Flask(__name__)
+metrics.time_json_responses(install_json_provider(app))
 
-# PostgreSQL connection details (use environment variables for security)
-DB_HOST = os.environ.get('DB_HOST') or os.environ.get('DATABASE_HOST', 'centerbeam.proxy.rlwy.net')
-DB_PORT = os.environ.get('DB_PORT') or os.environ.get('DATABASE_PORT', '43742')
-DB_NAME = os.environ.get('DB_NAME') or os.environ.get('DATABASE_NAME', 'railway')
-DB_USER = os.environ.get('DB_USER') or os.environ.get('DATABASE_USER', 'postgres')
-DB_PASS = os.environ.get('DB_PASS') or os.environ.get('DATABASE_PASSWORD', 'HPrpLUmYHcScrLfeZZDjAXUcpKHpfHJs')
+@app.before_request
+def start_request_metrics():
+    g.metrics_token = metrics.start_request(request.endpoint or 'unmatched')
+
+@app.before_request
+def admit_request():
+    """Turn the request away with 503 if its route is at its limits"""
+    return admission.admit(request.endpoint)
+
+# after_request hooks run in reverse order of registration: the response is
+# degraded first and its final status recorded last
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.after_request
+def compress_response(response):
+    return compression.compress(response, request.accept_encodings)
+
+@app.after_request
+def pin_reads_after_write(response):
+    """Send the client's next reads to servers that have this write"""
+    # 202 only queued the write (write-behind): the primary's position now
+    # would not cover it, and reading it would cost a round trip per toggle
+    if (request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400
+            and response.status_code != 202):
+        return remember_write(response)
+    return response
+
+@app.after_request
+def hold_admission_for_stream(response):
+    return admission.hold_for_stream(response)
+
+@app.after_request
+def degrade_when_database_unavailable(response):
+    return admission.degrade(response, request.endpoint)
+
+@app.teardown_request
+def release_admission(exc):
+    admission.release()
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        metrics.finish_request(token, request.method, g.get('response_status', 500))
+
+def lookup(statement, params, nested=False):
+    """Run prepared ``statement`` on a read connection, sharing the result with
+    identical concurrent lookups: (columns, rows), or people with nested
+    activities when ``nested``"""
+    def run():
+        with read_connection() as conn:
+            cur = conn.cursor()
+            prepared.execute(cur, statement, params)
+            if nested:
+                result = nest_activities(cur)
+            else:
+                result = [desc[0] for desc in cur.description], cur.fetchall()
+            cur.close()
+        return result
+    key = tuple(tuple(param) if isinstance(param, list) else param for param in params)
+    return coalesced(statement, key, run)
 
 def test_database_connection():
     """Test if we can connect to the database"""
     try:
-        conn =  psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('SELECT version()')
-        version = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT version()')
+            version = cur.fetchone()
+            cur.close()
         return True, f"Connected to PostgreSQL: {version[0]}"
     except Exception as e:
         return False, f"Connection failed: {str(e)}"
@@ -43,6 +118,16 @@ def test_endpoint():
         'message': 'Flask API is running!',
         'database_connected': db_connected,
         'database_message': db_message,
+        'pool': pool.stats(),
+        'admission': admission.status(),
+        'refdata_cache': cache_stats(),
+        'response_cache': response_cache_stats,
+        'matviews': matviews.status(),
+        'replicas': replicas.status(),
+        'prepared_statements': prepared.stats,
+        'write_behind': writebehind.queue.status(),
+        'single_flight': flights.status(),
+        'compression': compression.stats,
         'environment_vars': {
             'DB_HOST': DB_HOST,
             'DB_PORT': DB_PORT,
@@ -52,37 +137,83 @@ def test_endpoint():
         }
     }), 200
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process answers, without touching the database"""
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: the database health from the background checker"""
+    ready, details = health.checker.status()
+    return jsonify({'status': 'ready' if ready else 'unavailable', **details}), 200 if ready else 503
+
 @app.route('/people', methods=['GET'])
+@cached_response('people', 'activities', 'gender', 'classes')
 def get_people():
+    if 'ids' in request.args:
+        return get_people_by_ids()
+    try:
+        last_id, limit = parse_page(request.args)
+        conditions, params = parse_filters(request.args, 'g.gender_name', 'p.created_at', PEOPLE_FLAG_FILTERS)
+        include_activities = parse_include(request.args)
+        row_format = parse_row_format(request.args)
+        fields = parse_fields(request.args, PEOPLE_LIST_COLUMNS, 'id')
+        if include_activities and row_format == 'columns':
+            raise ValueError('format=columns cannot be combined with include=activities')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT p.id, p.first_name, p.last_name, p.email, g.gender_name, 
-                   p.contact, p.mother_name, p.created_at
-            FROM people p
-            LEFT JOIN gender g ON p.gender_id = g.gender_id
-            ORDER BY p.id
-            LIMIT 50
-        ''')
-        columns = [desc[0] for desc in cur.description]
-        people = [dict(zip(columns, row)) for row in cur.fetchall()]
-        # Add random 'class' to each person
-        class_choices = ['cp1', 'cp2', 'cp3']
-        for person in people:
-            person['class'] = random.choice(class_choices)
-        cur.close()
-        conn.close()
+        sql = select_columns(PEOPLE_LIST_COLUMNS, fields) + PEOPLE_LIST_FROM
+        sql, params = paginated_query(sql, 'p.id', conditions, params, last_id, limit)
+        if include_activities:
+            sql = WITH_ACTIVITIES.format(people=sql)
+        with read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            if include_activities:
+                rows, next_cursor = split_page(nest_activities(cur), limit, id_index='id')
+                people = rows
+            else:
+                columns = [desc[0] for desc in cur.description]
+                rows, next_cursor = split_page(cur.fetchall(), limit)
+                people = tabulate(columns, rows, row_format)
+            cur.close()
         return jsonify({
             'people': people, 
-            'count': len(people),
-            'message': f'Successfully retrieved {len(people)} people'
+            'count': len(rows),
+            'next_cursor': next_cursor,
+            'message': f'Successfully retrieved {len(rows)} people'
+        }), 200
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve people from database'
+        }), 500
+
+def get_people_by_ids():
+    """GET /people?ids=1,2,3: the listed people, in one query"""
+    try:
+        ids = parse_ids(request.args, 'ids')
+        include_activities = parse_include(request.args)
+        row_format = parse_row_format(request.args)
+        if include_activities and row_format == 'columns':
+            raise ValueError('format=columns cannot be combined with include=activities')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        if include_activities:
+            people = lookup('people_by_ids_with_activities', (ids,), nested=True)
+            found = {person['id'] for person in people}
+        else:
+            columns, rows = lookup('people_by_ids', (ids,))
+            people = tabulate(columns, rows, row_format)
+            found = {row[0] for row in rows}
+        return jsonify({
+            'people': people,
+            'count': len(found),
+            'missing': [person_id for person_id in ids if person_id not in found],
+            'message': f'Successfully retrieved {len(found)} of {len(ids)} people'
         }), 200
     except Exception as e:
         return jsonify({
@@ -90,6 +221,56 @@ def get_people():
             'message': 'Failed to retrieve people from database'
         }), 500
 
+@app.route('/people/export', methods=['GET'])
+def export_people():
+    """Stream every matching person as NDJSON or CSV"""
+    try:
+        fmt, fetch_size = parse_export_args(request.args)
+        conditions, params = parse_filters(request.args, 'g.gender_name', 'p.created_at', PEOPLE_FLAG_FILTERS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    sql = PEOPLE_SELECT
+    if conditions:
+        sql += '\n    WHERE ' + ' AND '.join(conditions)
+    sql += '\n    ORDER BY p.id'
+    try:
+        chunks = primed(stream_export(sql, params, fmt, fetch_size))
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to export people from database'
+        }), 500
+    return Response(chunks, mimetype=EXPORT_FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename=people.{fmt}'
+    })
+
+@app.route('/people/search', methods=['GET'])
+@cached_response('people', 'gender')
+def search_people():
+    """People whose names, email, contact or mother_name match ?q=, best first"""
+    try:
+        text, limit = search.parse_search(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(*search.search_sql(cur, text, limit))
+            columns = [desc[0] for desc in cur.description]
+            people = [dict(zip(columns, row)) for row in cur.fetchall()]
+            cur.close()
+        return jsonify({
+            'people': people,
+            'count': len(people),
+            'query': text,
+            'message': f'Found {len(people)} people matching {text}'
+        }), 200
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to search people in database'
+        }), 500
+
 @app.route('/people', methods=['POST'])
 def add_person():
     try:
@@ -107,154 +288,135 @@ def add_person():
         contact = data.get('contact')
         mother_name = data.get('mother_name')
         
-        # Connect to DB
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        
-        # Get gender_id if gender is provided
-        gender_id = None
-        if gender:
-            cur.execute('SELECT gender_id FROM gender WHERE gender_name = %s', (gender,))
-            gender_result = cur.fetchone()
-            if gender_result:
-                gender_id = gender_result[0]
-        
-        # Insert person
-        cur.execute("""
-            INSERT INTO people (first_name, last_name, email, gender_id, contact, mother_name)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (first_name, last_name, email, gender_id, contact, mother_name))
-        
-        person_id = cur.fetchone()[0]
-        
-        # Insert default activities record
-        cur.execute("""
-            INSERT INTO activities (person_id, activity1, activity2, transport)
-            VALUES (%s, FALSE, FALSE, FALSE)
-        """, (person_id,))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_connection() as conn:
+            cur = conn.cursor()
+            
+            # Get gender_id if gender is provided
+            gender_id = genders.lookup(gender, cur) if gender else None
+            
+            # Insert person
+            cur.execute(INSERT_PERSON, (first_name, last_name, email, gender_id, contact, mother_name))
+            
+            person_id = cur.fetchone()[0]
+            
+            # Insert default activities record
+            cur.execute(INSERT_DEFAULT_ACTIVITIES, (person_id,))
+            
+            conn.commit()
+            cur.close()
         return jsonify({'message': 'Person added successfully', 'person_id': person_id}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/people/bulk', methods=['POST'])
+def bulk_add_people():
+    """Add many people at once from a JSON array, NDJSON or CSV upload"""
+    try:
+        records, errors = parse_upload(request.get_data(as_text=True), request.content_type)
+        chunk_size = int(request.args.get('chunk_size', BULK_CHUNK_SIZE))
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        person_ids, insert_errors = insert_people(records, chunk_size)
+        errors = sorted(errors + insert_errors, key=lambda e: e['row'])
+        inserted = sum(1 for person_id in person_ids if person_id is not None)
+        return jsonify({
+            'message': f'Added {inserted} of {len(records)} people',
+            'inserted': inserted,
+            'failed': len(errors),
+            'person_ids': person_ids,
+            'errors': errors
+        }), 201 if inserted else 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batch', methods=['POST'])
+def apply_batch():
+    """Apply many person/activity updates and person deletes in one transaction"""
+    data = request.get_json(silent=True)
+    items = data.get('operations') if isinstance(data, dict) else data
+    try:
+        operations = batch.validate(items)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'results': getattr(e, 'results', [])}), 400
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            results = batch.apply(cur, operations)
+            conn.commit()
+            cur.close()
+        applied = sum(1 for result in results if result['status'] != 'not_found')
+        return jsonify({
+            'message': f'Applied {applied} of {len(results)} operations',
+            'applied': applied,
+            'not_found': len(results) - applied,
+            'results': results
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/people/<int:person_id>', methods=['PUT'])
 def update_person(person_id):
     """Update a person by ID"""
-    print(f"PUT request received for person_id: {person_id}")
-    print("Headers received:", dict(request.headers))
-    print("Body received:", request.get_data())
-    
     try:
         data = request.get_json()
-        print("Parsed JSON data:", data)
         
         # List of fields you allow to update
         allowed_fields = [
             'first_name', 'last_name', 'email', 'gender', 'contact', 'mother_name'
         ]
         
-        # Build the SET part of the SQL dynamically
-        set_clauses = []
-        values = []
-        
-        for field in allowed_fields:
-            if field in data:
-                value = data[field]
-                # Convert empty strings to None (NULL in SQL)
-                if value == "":
-                    value = None
-                
-                # Handle gender field specially (convert to gender_id)
-                if field == 'gender' and value:
-                    conn = psycopg2.connect(
-                        host=DB_HOST,
-                        port=DB_PORT,
-                        dbname=DB_NAME,
-                        user=DB_USER,
-                        password=DB_PASS
-                    )
-                    cur = conn.cursor()
-                    cur.execute('SELECT gender_id FROM gender WHERE gender_name = %s', (value,))
-                    gender_result = cur.fetchone()
-                    if gender_result:
-                        value = gender_result[0]
-                    else:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            
+            # Build the SET part of the SQL dynamically
+            set_clauses = []
+            values = []
+            
+            for field in allowed_fields:
+                if field in data:
+                    value = data[field]
+                    # Convert empty strings to None (NULL in SQL)
+                    if value == "":
                         value = None
-                    cur.close()
-                    conn.close()
-                    set_clauses.append("gender_id = %s")
-                else:
-                    set_clauses.append(f"{field} = %s")
-                
-                values.append(value)
-        
-        if not set_clauses:
-            return jsonify({'error': 'No valid fields to update'}), 400
-        
-        values.append(person_id)
-        set_clause = ', '.join(set_clauses)
-        sql = f"UPDATE people SET {set_clause} WHERE id = %s"
-        print("Executing SQL:", sql)
-        print("With values:", values)
-        
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute(sql, values)
-        conn.commit()
-        cur.close()
-        conn.close()
+                    
+                    # Handle gender field specially (convert to gender_id)
+                    if field == 'gender' and value:
+                        value = genders.lookup(value, cur)
+                        set_clauses.append("gender_id = %s")
+                    else:
+                        set_clauses.append(f"{field} = %s")
+                    
+                    values.append(value)
+            
+            if not set_clauses:
+                cur.close()
+                return jsonify({'error': 'No valid fields to update'}), 400
+            
+            values.append(person_id)
+            set_clause = ', '.join(set_clauses)
+            sql = f"UPDATE people SET {set_clause} WHERE id = %s"
+            
+            cur.execute(sql, values)
+            conn.commit()
+            cur.close()
         return jsonify({'message': f'Person {person_id} updated successfully'}), 200
     except Exception as e:
-        print("Database error:", str(e))
         return jsonify({'error': str(e)}), 500
 
 @app.route('/people/<int:person_id>', methods=['GET'])
+@cached_response('people', 'gender')
 def get_person(person_id):
     """Get a specific person by ID"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT p.id, p.first_name, p.last_name, p.email, g.gender_name, 
-                   p.contact, p.mother_name, p.created_at
-            FROM people p
-            LEFT JOIN gender g ON p.gender_id = g.gender_id
-            WHERE p.id = %s
-        ''', (person_id,))
+        columns, rows = lookup('person_by_id', (person_id,))
         
-        person_data = cur.fetchone()
-        
-        if not person_data:
-            cur.close()
-            conn.close()
+        if not rows:
             return jsonify({'error': f'Person with ID {person_id} not found'}), 404
         
-        columns = [desc[0] for desc in cur.description]
-        person = dict(zip(columns, person_data))
-        cur.close()
-        conn.close()
+        person = dict(zip(columns, rows[0]))
         
         return jsonify({
             'person': person,
@@ -271,59 +433,72 @@ def get_person(person_id):
 def delete_person(person_id):
     """Delete a person by ID"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        
-        # Check if person exists
-        cur.execute('SELECT id FROM people WHERE id = %s', (person_id,))
-        if not cur.fetchone():
+        with get_connection() as conn:
+            cur = conn.cursor()
+            
+            # Check if person exists
+            prepared.execute(cur, 'person_exists', (person_id,))
+            if not cur.fetchone():
+                cur.close()
+                return jsonify({'error': f'Person with ID {person_id} not found'}), 404
+            
+            # Delete person (activities will be deleted automatically due to CASCADE)
+            cur.execute(DELETE_PERSON, (person_id,))
+            conn.commit()
             cur.close()
-            conn.close()
-            return jsonify({'error': f'Person with ID {person_id} not found'}), 404
-        
-        # Delete person (activities will be deleted automatically due to CASCADE)
-        cur.execute('DELETE FROM people WHERE id = %s', (person_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
         
         return jsonify({'message': f'Person {person_id} deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/activities', methods=['GET'])
+@cached_response('activities', 'people', 'gender')
 def get_activities():
+    if 'person_ids' in request.args:
+        return get_activities_by_people()
+    try:
+        last_id, limit = parse_page(request.args)
+        conditions, params = parse_filters(request.args, 'g.gender_name', 'a.created_at', ACTIVITY_FLAG_FILTERS)
+        row_format = parse_row_format(request.args)
+        fields = parse_fields(request.args, ACTIVITIES_COLUMNS, 'activity_id')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    sql = select_columns(ACTIVITIES_COLUMNS, fields) + ACTIVITIES_FROM
+    if request.args.get('gender'):
+        sql += ACTIVITIES_GENDER_JOIN
+    try:
+        sql, params = paginated_query(sql, 'a.activity_id', conditions, params, last_id, limit)
+        with read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            columns = [desc[0] for desc in cur.description]
+            rows, next_cursor = split_page(cur.fetchall(), limit)
+            cur.close()
+        return jsonify({
+            'activities': tabulate(columns, rows, row_format), 
+            'count': len(rows),
+            'next_cursor': next_cursor,
+            'message': f'Successfully retrieved {len(rows)} activities'
+        }), 200
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve activities from database'
+        }), 500
+
+def get_activities_by_people():
+    """GET /activities?person_ids=1,2,3: the activities of the listed people, in one query"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT a.activity_id, a.person_id, p.first_name, p.last_name,
-                   a.activity1, a.activity2, a.transport, a.created_at
-            FROM activities a
-            JOIN people p ON a.person_id = p.id
-            ORDER BY a.activity_id
-            LIMIT 50
-        ''')
-        columns = [desc[0] for desc in cur.description]
-        activities = [dict(zip(columns, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        person_ids = parse_ids(request.args, 'person_ids')
+        row_format = parse_row_format(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        columns, rows = lookup('activities_by_people', (person_ids,))
         return jsonify({
-            'activities': activities, 
-            'count': len(activities),
-            'message': f'Successfully retrieved {len(activities)} activities'
+            'activities': tabulate(columns, rows, row_format),
+            'count': len(rows),
+            'message': f'Successfully retrieved activities for {len(person_ids)} people'
         }), 200
     except Exception as e:
         return jsonify({
@@ -331,34 +506,45 @@ def get_activities():
             'message': 'Failed to retrieve activities from database'
         }), 500
 
+@app.route('/activities/export', methods=['GET'])
+def export_activities():
+    """Stream every matching activities row as NDJSON or CSV"""
+    try:
+        fmt, fetch_size = parse_export_args(request.args)
+        conditions, params = parse_filters(request.args, 'g.gender_name', 'a.created_at', ACTIVITY_FLAG_FILTERS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    sql = ACTIVITIES_SELECT
+    if request.args.get('gender'):
+        sql += ACTIVITIES_GENDER_JOIN
+    if conditions:
+        sql += '\n    WHERE ' + ' AND '.join(conditions)
+    sql += '\n    ORDER BY a.activity_id'
+    try:
+        chunks = primed(stream_export(sql, params, fmt, fetch_size))
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to export activities from database'
+        }), 500
+    return Response(chunks, mimetype=EXPORT_FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename=activities.{fmt}'
+    })
+
 @app.route('/activities/person/<int:person_id>', methods=['GET'])
+@cached_response('activities', 'people')
 def get_activities_by_person(person_id):
     """Get activities for a specific person"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT a.activity_id, a.person_id, p.first_name, p.last_name,
-                   a.activity1, a.activity2, a.transport, a.created_at
-            FROM activities a
-            JOIN people p ON a.person_id = p.id
-            WHERE a.person_id = %s
-        ''', (person_id,))
-        
-        columns = [desc[0] for desc in cur.description]
-        activities = [dict(zip(columns, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        row_format = parse_row_format(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        columns, rows = lookup('activities_by_person', (person_id,))
         
         return jsonify({
-            'activities': activities,
-            'count': len(activities),
+            'activities': tabulate(columns, rows, row_format),
+            'count': len(rows),
             'message': f'Successfully retrieved activities for person {person_id}'
         }), 200
         
@@ -386,54 +572,50 @@ def update_activities(activity_id):
         if not set_clauses:
             return jsonify({'error': 'No valid fields to update'}), 400
         
+        if writebehind.WRITE_BEHIND_ENABLED:
+            fields = {field: data[field] for field in allowed_fields if field in data}
+            if any(not isinstance(value, bool) for value in fields.values()):
+                return jsonify({'error': 'Activity flags must be true or false'}), 400
+            writebehind.queue.put(activity_id, fields)
+            return jsonify({'message': f'Activities {activity_id} update queued'}), 202
+        
         values.append(activity_id)
         set_clause = ', '.join(set_clauses)
         sql = f"UPDATE activities SET {set_clause} WHERE activity_id = %s"
         
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute(sql, values)
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, values)
+            conn.commit()
+            cur.close()
         
         return jsonify({'message': f'Activities {activity_id} updated successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/activity1', methods=['GET'])
+@cached_response('people', 'activities', 'gender')
 def get_activity1_people():
     """Get all people who have activity1 = true"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT id, first_name, last_name, email, gender, contact, mother_name,
-                   activity1, activity2, transport, created_at
-            FROM activity1
-            ORDER BY id
-            LIMIT 50
-        ''')
-        columns = [desc[0] for desc in cur.description]
-        activity1_people = [dict(zip(columns, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        last_id, limit = parse_page(request.args)
+        conditions, params = parse_filters(request.args, 'gender', 'created_at', VIEW_FLAG_FILTERS)
+        row_format = parse_row_format(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        sql, params = paginated_query(matviews.VIEWS['activity1'].select(), 'id', conditions, params, last_id, limit)
+        with read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            columns = [desc[0] for desc in cur.description]
+            rows, next_cursor = split_page(cur.fetchall(), limit)
+            cur.close()
         return jsonify({
-            'activity1_people': activity1_people, 
-            'count': len(activity1_people),
-            'message': f'Successfully retrieved {len(activity1_people)} people with activity1 = true'
+            'activity1_people': tabulate(columns, rows, row_format), 
+            'count': len(rows),
+            'next_cursor': next_cursor,
+            'message': f'Successfully retrieved {len(rows)} people with activity1 = true'
         }), 200
     except Exception as e:
         return jsonify({
@@ -442,32 +624,28 @@ def get_activity1_people():
         }), 500
 
 @app.route('/transport', methods=['GET'])
+@cached_response('people', 'activities', 'gender')
 def get_transport_people():
     """Get all people who have transport = true"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT id, first_name, last_name, email, gender, contact, mother_name,
-                   activity1, activity2, transport, created_at
-            FROM transport
-            ORDER BY id
-            LIMIT 50
-        ''')
-        columns = [desc[0] for desc in cur.description]
-        transport_people = [dict(zip(columns, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        last_id, limit = parse_page(request.args)
+        conditions, params = parse_filters(request.args, 'gender', 'created_at', VIEW_FLAG_FILTERS)
+        row_format = parse_row_format(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        sql, params = paginated_query(matviews.VIEWS['transport'].select(), 'id', conditions, params, last_id, limit)
+        with read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            columns = [desc[0] for desc in cur.description]
+            rows, next_cursor = split_page(cur.fetchall(), limit)
+            cur.close()
         return jsonify({
-            'transport_people': transport_people, 
-            'count': len(transport_people),
-            'message': f'Successfully retrieved {len(transport_people)} people with transport = true'
+            'transport_people': tabulate(columns, rows, row_format), 
+            'count': len(rows),
+            'next_cursor': next_cursor,
+            'message': f'Successfully retrieved {len(rows)} people with transport = true'
         }), 200
     except Exception as e:
         return jsonify({
@@ -476,25 +654,17 @@ def get_transport_people():
         }), 500
 
 @app.route('/gender', methods=['GET'])
+@cached_response('gender')
 def get_genders():
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
-        cur.execute('SELECT gender_id, gender_name FROM gender ORDER BY gender_id')
-        columns = [desc[0] for desc in cur.description]
-        genders = [dict(zip(columns, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        gender_types = [
+            {'gender_id': gender_id, 'gender_name': gender_name}
+            for gender_id, gender_name in genders.rows()
+        ]
         return jsonify({
-            'genders': genders, 
-            'count': len(genders),
-            'message': f'Successfully retrieved {len(genders)} gender types'
+            'genders': gender_types, 
+            'count': len(gender_types),
+            'message': f'Successfully retrieved {len(gender_types)} gender types'
         }), 200
     except Exception as e:
         return jsonify({
@@ -502,6 +672,82 @@ def get_genders():
             'message': 'Failed to retrieve genders from database'
         }), 500
 
+@app.route('/stats', methods=['GET'])
+@cached_response('people', 'activities', 'gender', 'classes')
+def get_stats():
+    """People per class, gender and created_at bucket, with activity flag counts"""
+    try:
+        bucket = stats.parse_bucket(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with read_connection() as conn:
+            cur = conn.cursor()
+            counts = stats.grouped_counts(cur, bucket, class_names=dict(classes.rows(cur)),
+                                          gender_names=dict(genders.rows(cur)))
+            cur.close()
+        return jsonify({
+            'stats': counts,
+            'bucket': bucket,
+            'message': f"Successfully counted {counts['total']['people']} people"
+        }), 200
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve stats from database'
+        }), 500
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    """One page of the change feed after ``after``; asgi.py streams it as SSE"""
+    try:
+        filters = changes.parse_filters(request.args)
+        after = changes.Position.parse(request.args['after']) if 'after' in request.args else None
+        limit = min(changes.parse_sequence(request.args.get('limit', changes.CHANGES_PAGE_LIMIT), 'limit'),
+                    changes.CHANGES_PAGE_LIMIT)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with read_connection() as conn:
+            cur = conn.cursor()
+            # The position is worked out from the snapshot the rows come from
+            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cur.execute(changes.CHANGES_POSITION, (after.seq if after else 0,))
+            found, head_txid, head_seq, running = cur.fetchone()
+            class_id = None
+            if 'class' in filters:
+                class_id = classes.lookup(filters['class'], cur)
+                if class_id is None:
+                    return jsonify({'error': f"Class {filters['class']} not found"}), 404
+            rows = []
+            if after is not None:
+                cur.execute(*changes.since_query(after, filters, class_id, limit + 1))
+                rows = cur.fetchall()
+            cur.close()
+        running = set(running)
+        position = after or changes.Position()
+        for row in rows[:limit]:
+            position = position.after(row[0], row[1], running)
+        if len(rows) <= limit:
+            position = position.settled(head_txid, head_seq, running)
+        page = [changes.event(row[1:]) for row in rows[:limit]]
+        return jsonify({
+            'changes': page,
+            'count': len(page),
+            'more': len(rows) > limit,
+            # Where to poll from next: pass it back as ``after``
+            'position': str(position),
+            'last_seq': position.seq,
+            # The row ``after`` was pruned: reload, then poll from position
+            'reset': bool(after and after.seq) and not found,
+            'message': f'Successfully retrieved {len(page)} changes'
+        }), 200
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve changes from database'
+        }), 500
+
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({
@@ -509,15 +755,26 @@ def home():
         'endpoints': {
             'home': '/',
             'test': '/test (test database connection)',
+            'healthz': '/healthz (liveness probe)',
+            'readyz': '/readyz (readiness probe, cached database health)',
             'debug': '/debug (debug environment variables)',
-            'people': '/people (get people data)',
+            'people': '/people (get people data; ?ids=1,2,3 for several people at once)',
             'person_by_id': '/people/<id> (get/update/delete specific person)',
-            'activities': '/activities (get activities data)',
+            'people_search': '/people/search?q= (find people by name, email, contact or mother_name)',
+            'people_export': '/people/export (stream people as NDJSON or CSV)',
+            'people_bulk': '/people/bulk (add people from a JSON array, NDJSON or CSV)',
+            'batch': '/batch (update people/activities and delete people in one transaction)',
+            'activities': '/activities (get activities data; ?person_ids=1,2,3 for several people at once)',
+            'activities_export': '/activities/export (stream activities as NDJSON or CSV)',
             'activities_by_person': '/activities/person/<id> (get activities for person)',
             'update_activities': '/activities/<id> (update activities)',
             'activity1': '/activity1 (get people with activity1 = true)',
             'transport': '/transport (get people with transport = true)',
             'gender': '/gender (get gender types)',
+            'stats': '/stats (counts per class, gender, activity flag and created_at bucket)',
+            'changes': '/changes?after= (people/activities changes; streamed as SSE by asgi.py)',
+            'metrics': '/metrics (Prometheus metrics)',
+            'matviews': '/admin/matviews (materialized view status; POST /admin/matviews/refresh to refresh)',
             'routes': '/routes (list all routes)'
         },
         'status': 'API is ready to use'
@@ -538,6 +795,32 @@ def list_routes():
         'routes': routes
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request, query and pool metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/matviews', methods=['GET'])
+def matview_status():
+    """Staleness and refresh history of the materialized flag views"""
+    return jsonify({'matviews': matviews.status()}), 200
+
+@app.route('/admin/matviews/refresh', methods=['POST'])
+def refresh_matviews():
+    """Refresh the materialized flag views now (?view= to pick one)"""
+    name = request.args.get('view')
+    if name is not None and name not in matviews.VIEWS:
+        return jsonify({'error': f"Invalid view: {name} (expected one of {', '.join(matviews.VIEWS)})"}), 400
+    try:
+        if name is None:
+            results = matviews.refresh_all(force=True)
+        else:
+            results = [matviews.VIEWS[name].refresh(force=True)]
+        failed = any('error' in result for result in results)
+        return jsonify({'results': results}), 500 if failed else 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/debug', methods=['GET'])
 def debug_info():
     """Debug endpoint to check environment variables"""
@@ -560,43 +843,46 @@ def debug_info():
     }), 200
 
 @app.route('/<class_name>', methods=['GET'])
+@cached_response('classes', 'people', 'gender', 'activities')
 def get_students_by_class_db(class_name):
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        cur = conn.cursor()
+        include_activities = parse_include(request.args)
+        row_format = parse_row_format(request.args)
+        fields = parse_fields(request.args, CLASS_STUDENTS_COLUMNS, 'id')
+        if include_activities and row_format == 'columns':
+            raise ValueError('format=columns cannot be combined with include=activities')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # Only the full column set is a prepared statement
+    projected = select_columns(CLASS_STUDENTS_COLUMNS, fields) + CLASS_STUDENTS_FROM if fields else None
+    try:
         # Get class_id for the given class_name
-        cur.execute('SELECT class_id FROM classes WHERE class_name = %s', (class_name,))
-        class_row = cur.fetchone()
-        if not class_row:
-            cur.close()
-            conn.close()
+        class_id = classes.lookup(class_name)
+        if class_id is None:
             return jsonify({'error': f'Class {class_name} not found'}), 404
-        class_id = class_row[0]
-        # Get all people in this class
-        cur.execute('''
-            SELECT p.id, p.first_name, p.last_name, p.email, g.gender_name, 
-                   p.contact, p.mother_name, p.created_at, c.class_name
-            FROM people p
-            LEFT JOIN gender g ON p.gender_id = g.gender_id
-            JOIN classes c ON p.class_id = c.class_id
-            WHERE p.class_id = %s
-            ORDER BY p.id
-        ''', (class_id,))
-        columns = [desc[0] for desc in cur.description]
-        students = [dict(zip(columns, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        with read_connection() as conn:
+            cur = conn.cursor()
+            # Get all people in this class
+            if include_activities:
+                if projected:
+                    cur.execute(WITH_ACTIVITIES.format(people=projected), (class_id,))
+                else:
+                    prepared.execute(cur, 'class_students_with_activities', (class_id,))
+                students = rows = nest_activities(cur)
+            else:
+                if projected:
+                    cur.execute(projected, (class_id,))
+                else:
+                    prepared.execute(cur, 'class_students', (class_id,))
+                columns = [desc[0] for desc in cur.description]
+                rows = cur.fetchall()
+                students = tabulate(columns, rows, row_format)
+            cur.close()
         return jsonify({
             'class': class_name,
             'students': students,
-            'count': len(students),
-            'message': f'Successfully retrieved {len(students)} students in class {class_name}'
+            'count': len(rows),
+            'message': f'Successfully retrieved {len(rows)} students in class {class_name}'
         }), 200
     except Exception as e:
         return jsonify({
@@ -609,14 +895,25 @@ if __name__ == '__main__':
     print("Available endpoints:")
     print("- / (home)")
     print("- /test (test database connection)")
-    print("- /people (get people data)")
+    print("- /healthz (liveness probe)")
+    print("- /readyz (readiness probe, cached database health)")
+    print("- /people (get people data; ?ids=1,2,3 for several people at once)")
     print("- /people/<id> (get/update/delete specific person)")
-    print("- /activities (get activities data)")
+    print("- /people/search?q= (find people by name, email, contact or mother_name)")
+    print("- /people/export (stream people as NDJSON or CSV)")
+    print("- /people/bulk (add people from a JSON array, NDJSON or CSV)")
+    print("- /batch (update people/activities and delete people in one transaction)")
+    print("- /activities (get activities data; ?person_ids=1,2,3 for several people at once)")
+    print("- /activities/export (stream activities as NDJSON or CSV)")
     print("- /activities/person/<id> (get activities for person)")
     print("- /activities/<id> (update activities)")
     print("- /activity1 (get people with activity1 = true)")
     print("- /transport (get people with transport = true)")
     print("- /gender (get gender types)")
+    print("- /stats (counts per class, gender, activity flag and created_at bucket)")
+    print("- /changes?after= (people/activities changes; streamed as SSE by asgi.py)")
+    print("- /metrics (Prometheus metrics)")
+    print("- /admin/matviews (materialized view status and refresh)")
     print("- /routes (list all routes)")
     print("- /debug (debug information)")
     port = int(os.environ.get('PORT', 5000))
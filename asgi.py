@@ -0,0 +1,661 @@
+"""Async entry point serving the read routes of app.py over asyncpg.
+
+Run it with uvicorn instead of gunicorn's sync workers:
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Responses have the same JSON shapes as the Flask app, for these GET routes
+and the same query parameters:
+
+    /healthz, /people (?ids=, ?include=activities, ?format=columns,
+    ?fields=), /people/search, /people/<id>, /activities (?person_ids=,
+    ?format=columns, ?fields=), /activities/person/<id>, /activity1,
+    /transport, /gender, /stats and /<class_name>
+
+The other GET routes of app.py (the exports, /readyz, /metrics, /routes,
+/debug, /admin/matviews and /test) answer 404 here, and writes stay on the
+Flask app.
+
+It also serves GET /changes, the change feed of changes.py as Server-Sent
+Events.  Each worker holds one LISTEN connection and fans the changes out
+to its subscribers, so an open stream costs a queue, not a worker thread.
+Each event's id is the feed position after it (see changes.Position): a
+client that reconnects with Last-Event-ID (or ?last_event_id=) gets the
+changes it missed first.  A client too slow to keep up, or resuming from before the retention window,
+gets a ``reset`` event and should reload before reconnecting.
+"""
+import asyncio
+import json
+import os
+import sys
+from contextlib import asynccontextmanager
+from datetime import date
+from decimal import Decimal
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.http import http_date
+
+import changes
+import search
+import stats
+from compression import COMPRESS_GZIP_LEVEL, COMPRESS_MIN_SIZE
+from db import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS, DB_POOL_MIN, DB_POOL_MAX
+from pagination import (
+    paginated_query, parse_fields, parse_filters, parse_ids, parse_include, parse_page, split_page,
+)
+from queries import (
+    ACTIVITIES_BY_PEOPLE, ACTIVITIES_BY_PERSON, ACTIVITIES_COLUMNS, ACTIVITIES_FROM, ACTIVITIES_GENDER_JOIN,
+    ACTIVITY_FLAG_FILTERS, ACTIVITY1_SELECT, CLASS_ID_BY_NAME, CLASS_STUDENTS_COLUMNS, CLASS_STUDENTS_FROM, CLASSES,
+    GENDERS, PEOPLE_BY_IDS, PEOPLE_FLAG_FILTERS, PEOPLE_LIST_COLUMNS, PEOPLE_LIST_FROM, PERSON_BY_ID,
+    TRANSPORT_SELECT, VIEW_FLAG_FILTERS, WITH_ACTIVITIES, nest_activity_rows, numbered, numbered_named,
+    select_columns,
+)
+from serialization import parse_row_format, tabulate
+
+CHANGES_QUEUE = int(os.environ.get('CHANGES_QUEUE', 1000))
+CHANGES_KEEPALIVE = float(os.environ.get('CHANGES_KEEPALIVE', 15))
+CHANGES_RETRY = int(os.environ.get('CHANGES_RETRY', 3000))
+# Rows held back behind a transaction that then rolled back get no
+# notification of their own, so the log is also polled this often
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))
+
+pool = None
+broker = None
+# Whether the database has pg_trgm, checked on the first search
+trigram = None
+
+
+def _json_default(value):
+    # Same conversions as Flask's default JSON provider
+    if isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def jsonify(payload, status_code=200):
+    body = json.dumps(payload, default=_json_default, sort_keys=True, separators=(',', ':'))
+    return Response(body + '\n', status_code=status_code, media_type='application/json')
+
+
+async def fetch_rows(sql, params=()):
+    """(column names, row tuples) of ``sql``; the names are there even when no row is"""
+    async with pool.acquire() as conn:
+        statement = await conn.prepare(numbered(sql))
+        rows = await statement.fetch(*params)
+        columns = [attribute.name for attribute in statement.get_attributes()]
+    return columns, [tuple(row) for row in rows]
+
+
+async def fetch(sql, params=()):
+    return tabulate(*await fetch_rows(sql, params))
+
+
+async def fetch_nested(sql, params=()):
+    """People with nested activities from a WITH_ACTIVITIES query"""
+    return nest_activity_rows(*await fetch_rows(sql, params))
+
+
+def parse_shape(query_params):
+    """?include= and ?format= of the people list endpoints"""
+    include_activities = parse_include(query_params)
+    row_format = parse_row_format(query_params)
+    if include_activities and row_format == 'columns':
+        raise ValueError('format=columns cannot be combined with include=activities')
+    return include_activities, row_format
+
+
+async def fetch_page(select_sql, id_column, query_params, gender_column, created_column, flag_filters,
+                     row_format='records', include_activities=False):
+    """(rows shaped for the response, row count, next cursor) of one page"""
+    last_id, limit = parse_page(query_params)
+    conditions, params = parse_filters(query_params, gender_column, created_column, flag_filters)
+    sql, params = paginated_query(select_sql, id_column, conditions, params, last_id, limit)
+    if include_activities:
+        rows, next_cursor = split_page(await fetch_nested(WITH_ACTIVITIES.format(people=sql), params),
+                                       limit, id_index='id')
+        return rows, len(rows), next_cursor
+    columns, rows = await fetch_rows(sql, params)
+    rows, next_cursor = split_page(rows, limit)
+    return tabulate(columns, rows, row_format), len(rows), next_cursor
+
+
+async def home(request):
+    return jsonify({
+        'message': 'People Management API is running! (async)',
+        'status': 'API is ready to use'
+    })
+
+
+async def healthz(request):
+    return jsonify({'status': 'ok'})
+
+
+async def get_people_by_ids(request):
+    try:
+        ids = parse_ids(request.query_params, 'ids')
+        include_activities, row_format = parse_shape(request.query_params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    try:
+        if include_activities:
+            people = await fetch_nested(WITH_ACTIVITIES.format(people=PEOPLE_BY_IDS), (ids,))
+            found = {person['id'] for person in people}
+        else:
+            columns, rows = await fetch_rows(PEOPLE_BY_IDS, (ids,))
+            people = tabulate(columns, rows, row_format)
+            found = {row[0] for row in rows}
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve people from database'
+        }, 500)
+    return jsonify({
+        'people': people,
+        'count': len(found),
+        'missing': [person_id for person_id in ids if person_id not in found],
+        'message': f'Successfully retrieved {len(found)} of {len(ids)} people'
+    })
+
+
+async def get_people(request):
+    if 'ids' in request.query_params:
+        return await get_people_by_ids(request)
+    try:
+        include_activities, row_format = parse_shape(request.query_params)
+        fields = parse_fields(request.query_params, PEOPLE_LIST_COLUMNS, 'id')
+        people, count, next_cursor = await fetch_page(
+            select_columns(PEOPLE_LIST_COLUMNS, fields) + PEOPLE_LIST_FROM, 'p.id', request.query_params,
+            'g.gender_name', 'p.created_at', PEOPLE_FLAG_FILTERS, row_format, include_activities)
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve people from database'
+        }, 500)
+    return jsonify({
+        'people': people,
+        'count': count,
+        'next_cursor': next_cursor,
+        'message': f'Successfully retrieved {count} people'
+    })
+
+
+async def search_people(request):
+    global trigram
+    try:
+        text, limit = search.parse_search(request.query_params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    try:
+        async with pool.acquire() as conn:
+            if trigram is None:
+                trigram = await conn.fetchval(search.TRIGRAM_SQL)
+            settings, sql, params = search.search_query(text, limit, search.SEARCH_FUZZY and trigram)
+            sql, params = numbered_named(sql, params)
+            # The settings are local to this transaction
+            async with conn.transaction(readonly=True):
+                for setting, setting_params in settings:
+                    await conn.execute(numbered(setting), *setting_params)
+                people = [dict(record) for record in await conn.fetch(sql, *params)]
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to search people in database'
+        }, 500)
+    return jsonify({
+        'people': people,
+        'count': len(people),
+        'query': text,
+        'message': f'Found {len(people)} people matching {text}'
+    })
+
+
+async def get_person(request):
+    person_id = request.path_params['person_id']
+    try:
+        rows = await fetch(PERSON_BY_ID, (person_id,))
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': f'Failed to retrieve person {person_id} from database'
+        }, 500)
+    if not rows:
+        return jsonify({'error': f'Person with ID {person_id} not found'}, 404)
+    return jsonify({
+        'person': rows[0],
+        'message': f'Successfully retrieved person {person_id}'
+    })
+
+
+async def get_activities_by_people(request):
+    try:
+        person_ids = parse_ids(request.query_params, 'person_ids')
+        row_format = parse_row_format(request.query_params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    try:
+        columns, rows = await fetch_rows(ACTIVITIES_BY_PEOPLE, (person_ids,))
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve activities from database'
+        }, 500)
+    return jsonify({
+        'activities': tabulate(columns, rows, row_format),
+        'count': len(rows),
+        'message': f'Successfully retrieved activities for {len(person_ids)} people'
+    })
+
+
+async def get_activities(request):
+    if 'person_ids' in request.query_params:
+        return await get_activities_by_people(request)
+    try:
+        row_format = parse_row_format(request.query_params)
+        fields = parse_fields(request.query_params, ACTIVITIES_COLUMNS, 'activity_id')
+        sql = select_columns(ACTIVITIES_COLUMNS, fields) + ACTIVITIES_FROM
+        if request.query_params.get('gender'):
+            sql += ACTIVITIES_GENDER_JOIN
+        activities, count, next_cursor = await fetch_page(
+            sql, 'a.activity_id', request.query_params, 'g.gender_name', 'a.created_at', ACTIVITY_FLAG_FILTERS,
+            row_format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve activities from database'
+        }, 500)
+    return jsonify({
+        'activities': activities,
+        'count': count,
+        'next_cursor': next_cursor,
+        'message': f'Successfully retrieved {count} activities'
+    })
+
+
+async def get_activities_by_person(request):
+    person_id = request.path_params['person_id']
+    try:
+        row_format = parse_row_format(request.query_params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    try:
+        columns, rows = await fetch_rows(ACTIVITIES_BY_PERSON, (person_id,))
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': f'Failed to retrieve activities for person {person_id}'
+        }, 500)
+    return jsonify({
+        'activities': tabulate(columns, rows, row_format),
+        'count': len(rows),
+        'message': f'Successfully retrieved activities for person {person_id}'
+    })
+
+
+def flag_view(select_sql, key, label):
+    async def endpoint(request):
+        try:
+            row_format = parse_row_format(request.query_params)
+            rows, count, next_cursor = await fetch_page(
+                select_sql, 'id', request.query_params, 'gender', 'created_at', VIEW_FLAG_FILTERS, row_format)
+        except ValueError as e:
+            return jsonify({'error': str(e)}, 400)
+        except Exception as e:
+            return jsonify({
+                'error': str(e),
+                'message': f'Failed to retrieve {label} people from database'
+            }, 500)
+        return jsonify({
+            key: rows,
+            'count': count,
+            'next_cursor': next_cursor,
+            'message': f'Successfully retrieved {count} people with {label} = true'
+        })
+    return endpoint
+
+
+async def get_genders(request):
+    try:
+        genders = await fetch(GENDERS)
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve genders from database'
+        }, 500)
+    return jsonify({
+        'genders': genders,
+        'count': len(genders),
+        'message': f'Successfully retrieved {len(genders)} gender types'
+    })
+
+
+async def get_stats(request):
+    try:
+        bucket = stats.parse_bucket(request.query_params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    try:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(numbered(stats.STATS_QUERY), bucket)
+            class_names = dict(tuple(row) for row in await conn.fetch(CLASSES))
+            gender_names = dict(tuple(row) for row in await conn.fetch(GENDERS))
+        counts = stats.summarize(rows, class_names, gender_names)
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to retrieve stats from database'
+        }, 500)
+    return jsonify({
+        'stats': counts,
+        'bucket': bucket,
+        'message': f"Successfully counted {counts['total']['people']} people"
+    })
+
+
+async def get_students_by_class(request):
+    class_name = request.path_params['class_name']
+    try:
+        include_activities, row_format = parse_shape(request.query_params)
+        fields = parse_fields(request.query_params, CLASS_STUDENTS_COLUMNS, 'id')
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    sql = select_columns(CLASS_STUDENTS_COLUMNS, fields) + CLASS_STUDENTS_FROM
+    try:
+        async with pool.acquire() as conn:
+            class_id = await conn.fetchval(numbered(CLASS_ID_BY_NAME), class_name)
+        if class_id is None:
+            return jsonify({'error': f'Class {class_name} not found'}, 404)
+        if include_activities:
+            students = rows = await fetch_nested(WITH_ACTIVITIES.format(people=sql), (class_id,))
+        else:
+            columns, rows = await fetch_rows(sql, (class_id,))
+            students = tabulate(columns, rows, row_format)
+    except Exception as e:
+        return jsonify({
+            'error': str(e),
+            'message': f'Failed to retrieve students for class {class_name}'
+        }, 500)
+    return jsonify({
+        'class': class_name,
+        'students': students,
+        'count': len(rows),
+        'message': f'Successfully retrieved {len(rows)} students in class {class_name}'
+    })
+
+
+async def served_by_flask(request):
+    """Routes only the Flask app serves, so they are not taken for class names"""
+    return jsonify({
+        'error': f'{request.method} {request.url.path} is not served by the async app',
+        'message': 'Send this request to the Flask app (gunicorn app:app)'
+    }, 404)
+
+
+class Subscriber:
+    """One open /changes stream: its filters and a bounded queue of events"""
+
+    def __init__(self, filters, class_id):
+        self.filters = filters
+        self.class_id = class_id
+        self.queue = asyncio.Queue(CHANGES_QUEUE)
+
+    def send(self, change, position):
+        """Queue ``change`` and the position after it if it passes the
+        filters; False if the queue is full"""
+        if not changes.matches(change, self.filters, self.class_id):
+            return True
+        try:
+            self.queue.put_nowait((change, position))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def reset(self, position):
+        """Replace whatever is queued with a single reset"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait((None, position))
+
+
+class ChangeBroker:
+    """This worker's LISTEN connection on CHANGES_CHANNEL and its subscribers.
+
+    Each notification wakes it to read the log from the position of the
+    last change it saw (a changes.Position) and offer each new row once to
+    every subscriber.  After the connection
+    is lost it reconnects and carries on from the same position.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.position = None
+        self._task = None
+        # waiting_on: older transactions still running whose rows are yet to come
+        self.stats = {'notifications': 0, 'changes': 0, 'dropped_subscribers': 0, 'reconnects': 0,
+                      'waiting_on': 0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def subscribe(self, subscriber):
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def _publish(self, rows, running):
+        """Offer the changes in ``rows`` (from changes.since_query) to every subscriber"""
+        for row in rows:
+            change = changes.event(tuple(row)[1:])
+            self.stats['changes'] += 1
+            self.position = self.position.after(row['txid'], row['seq'], running)
+            position = str(self.position)
+            for subscriber in list(self.subscribers):
+                if subscriber.send(change, position):
+                    continue
+                # Too slow to keep up: it has to reload, not replay
+                subscriber.reset(position)
+                self.unsubscribe(subscriber)
+                self.stats['dropped_subscribers'] += 1
+
+    async def _read(self, conn, position):
+        """(head txid, head seq, running txids, rows after ``position``), in one snapshot"""
+        async with conn.transaction(isolation='repeatable_read', readonly=True):
+            _, head_txid, head_seq, running = await conn.fetchrow(numbered(changes.CHANGES_POSITION), 0)
+            rows = []
+            if position is not None:
+                sql, params = changes.since_query(position, {})
+                rows = await conn.fetch(numbered(sql), *params)
+        return head_txid, head_seq, set(running), rows
+
+    async def _catch_up(self, conn):
+        while True:
+            head_txid, head_seq, running, rows = await self._read(conn, self.position)
+            self._publish(rows, running)
+            if len(rows) < changes.CHANGES_PAGE_LIMIT:
+                self.position = self.position.settled(head_txid, head_seq, running)
+                self.stats['waiting_on'] = len(self.position.gaps)
+                return
+
+    async def _listen(self):
+        notifications = asyncio.Queue()
+        conn = await asyncpg.connect(**CONNECT_ARGS)
+        try:
+            await conn.add_listener(
+                changes.CHANGES_CHANNEL, lambda conn, pid, channel, payload: notifications.put_nowait(payload))
+            conn.add_termination_listener(lambda conn: notifications.put_nowait(None))
+            if self.position is None:
+                head_txid, head_seq, running, _ = await self._read(conn, None)
+                self.position = changes.Position().settled(head_txid, head_seq, running)
+            while True:
+                # Listening already, so nothing committed meanwhile is missed
+                await self._catch_up(conn)
+                try:
+                    payloads = [await asyncio.wait_for(notifications.get(), CHANGES_POLL_INTERVAL)]
+                except asyncio.TimeoutError:
+                    continue
+                while not notifications.empty():
+                    payloads.append(notifications.get_nowait())
+                if None in payloads:
+                    raise ConnectionError('change listener connection closed')
+                self.stats['notifications'] += len(payloads)
+        finally:
+            conn.terminate()
+
+    async def _run(self):
+        delay = 1
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'change listener failed, reconnecting in {delay}s: {e}', file=sys.stderr)
+                self.stats['reconnects'] += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+def sse(event, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event}', 'data: ' + json.dumps(data, default=_json_default, separators=(',', ':'))]
+    return '\n'.join(lines) + '\n\n'
+
+
+def broker_position():
+    """Where the broker is in the log, as text; None until it has read it"""
+    return str(broker.position) if broker.position is not None else None
+
+
+async def stream_changes(subscriber, after):
+    """The SSE body of one /changes stream; unsubscribes when the client leaves"""
+    try:
+        yield f'retry: {CHANGES_RETRY}\n\n'
+        sent = set()
+        if after is None:
+            position = broker_position()
+            yield sse('ready', {'position': position}, position)
+        else:
+            # Subscribed before reading the log, so nothing committed in
+            # between is missed; what arrives twice is skipped by seq
+            async with pool.acquire() as conn:
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    found, _, _, running = await conn.fetchrow(numbered(changes.CHANGES_POSITION), after.seq)
+                    sql, params = changes.since_query(after, subscriber.filters, subscriber.class_id)
+                    rows = await conn.fetch(numbered(sql), *params)
+            if (after.seq and not found) or len(rows) >= changes.CHANGES_PAGE_LIMIT:
+                position = broker_position()
+                yield sse('reset', {'position': position}, position)
+                return
+            position = after
+            for row in rows:
+                position = position.after(row['txid'], row['seq'], set(running))
+                change = changes.event(tuple(row)[1:])
+                sent.add(change['seq'])
+                yield sse('change', change, str(position))
+        while True:
+            try:
+                change, position = await asyncio.wait_for(subscriber.queue.get(), CHANGES_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if change is None:
+                yield sse('reset', {'position': position}, position)
+                return
+            if change['seq'] not in sent:
+                yield sse('change', change, position)
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+async def get_changes(request):
+    try:
+        filters = changes.parse_filters(request.query_params)
+        after = request.headers.get('last-event-id', request.query_params.get('last_event_id'))
+        after = changes.Position.parse(after, 'last_event_id') if after else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}, 400)
+    class_id = None
+    if 'class' in filters:
+        try:
+            async with pool.acquire() as conn:
+                class_id = await conn.fetchval(numbered(CLASS_ID_BY_NAME), filters['class'])
+        except Exception as e:
+            return jsonify({
+                'error': str(e),
+                'message': 'Failed to retrieve changes from database'
+            }, 500)
+        if class_id is None:
+            return jsonify({'error': f"Class {filters['class']} not found"}, 404)
+    subscriber = Subscriber(filters, class_id)
+    broker.subscribe(subscriber)
+    return StreamingResponse(stream_changes(subscriber, after), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no',
+    })
+
+
+CONNECT_ARGS = {
+    'host': DB_HOST,
+    'port': int(DB_PORT),
+    'database': DB_NAME,
+    'user': DB_USER,
+    'password': DB_PASS,
+}
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool, broker
+    pool = await asyncpg.create_pool(**CONNECT_ARGS, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX)
+    broker = ChangeBroker()
+    broker.start()
+    try:
+        yield
+    finally:
+        await broker.stop()
+        await pool.close()
+
+
+# GET routes of app.py with no async counterpart; without these they would be
+# looked up as class names
+FLASK_ONLY = ('/test', '/readyz', '/people/export', '/activities/export', '/routes', '/metrics',
+              '/admin/matviews', '/debug')
+
+# Starlette's gzip streams too and leaves the SSE feed alone
+middleware = [Middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=COMPRESS_GZIP_LEVEL)]
+
+app = Starlette(lifespan=lifespan, middleware=middleware, routes=[
+    Route('/', home),
+    Route('/healthz', healthz),
+    Route('/people', get_people),
+    Route('/people/search', search_people),
+    Route('/people/{person_id:int}', get_person),
+    Route('/activities', get_activities),
+    Route('/activities/person/{person_id:int}', get_activities_by_person),
+    Route('/activity1', flag_view(ACTIVITY1_SELECT, 'activity1_people', 'activity1')),
+    Route('/transport', flag_view(TRANSPORT_SELECT, 'transport_people', 'transport')),
+    Route('/gender', get_genders),
+    Route('/stats', get_stats),
+    Route('/changes', get_changes),
+    *[Route(path, served_by_flask, methods=['GET']) for path in FLASK_ONLY],
+    Route('/{class_name}', get_students_by_class),
+])
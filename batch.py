@@ -0,0 +1,152 @@
+import os
+
+from psycopg2.extras import execute_values
+
+from refdata import genders
+
+# Upper bound on operations accepted by one POST /batch
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 5000))
+
+# Updatable columns and the SQL type used to cast them inside VALUES lists
+PERSON_FIELDS = {
+    'first_name': 'text',
+    'last_name': 'text',
+    'email': 'text',
+    'gender': 'int',
+    'contact': 'text',
+    'mother_name': 'text',
+}
+ACTIVITY_FIELDS = {
+    'activity1': 'boolean',
+    'activity2': 'boolean',
+    'transport': 'boolean',
+}
+OPERATIONS = ('update_person', 'update_activities', 'delete_person')
+
+
+def _item_id(item, key):
+    value = item.get(key)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f'{key} must be an integer')
+    return value
+
+
+def validate(items):
+    """Check every operation before anything is written.
+
+    Returns a list of ``(op, id, fields)`` tuples, or raises ValueError with
+    per-item ``results`` attached when any item is unusable.
+    """
+    if not isinstance(items, list):
+        raise ValueError('Expected a list of operations')
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f'Too many operations: {len(items)} (limit is {BATCH_MAX_ITEMS})')
+    parsed = []
+    results = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('Expected an object')
+            op = item.get('op')
+            if op == 'update_activities':
+                target = _item_id(item, 'activity_id')
+                fields = {f: item[f] for f in ACTIVITY_FIELDS if f in item}
+                if any(not isinstance(v, bool) for v in fields.values()):
+                    raise ValueError('activity flags must be true or false')
+            elif op == 'update_person':
+                target = _item_id(item, 'id')
+                # Convert empty strings to None (NULL in SQL), as PUT /people/<id> does
+                fields = {f: (item[f] if item[f] != '' else None) for f in PERSON_FIELDS if f in item}
+                if any(v is not None and not isinstance(v, str) for v in fields.values()):
+                    raise ValueError('person fields must be strings or null')
+            elif op == 'delete_person':
+                target = _item_id(item, 'id')
+                fields = {}
+            else:
+                raise ValueError(f"Invalid op: {op} (expected one of {', '.join(OPERATIONS)})")
+            if op != 'delete_person' and not fields:
+                raise ValueError('No valid fields to update')
+        except ValueError as e:
+            results.append({'index': index, 'status': 'invalid', 'error': str(e)})
+            continue
+        parsed.append((op, target, fields))
+        results.append({'index': index, 'status': 'valid'})
+    if len(parsed) != len(items):
+        error = ValueError('Invalid operations in batch')
+        error.results = results
+        raise error
+    return parsed
+
+
+def _merge(parsed, op):
+    """Fold repeated updates of the same row together, later fields winning"""
+    merged = {}
+    for item_op, target, fields in parsed:
+        if item_op == op:
+            merged.setdefault(target, {}).update(fields)
+    return merged
+
+
+def _update(cur, table, id_column, types, merged):
+    """Apply merged updates with one UPDATE ... FROM (VALUES ...) per field set.
+
+    Returns the set of ids that matched a row.
+    """
+    groups = {}
+    for target, fields in merged.items():
+        groups.setdefault(tuple(sorted(fields)), []).append(target)
+    updated = set()
+    for columns, targets in groups.items():
+        names = [('gender_id' if c == 'gender' else c) for c in columns]
+        set_clause = ', '.join(f'{name} = v.{name}' for name in names)
+        template = '(' + ', '.join(['%s::int'] + [f'%s::{types[c]}' for c in columns]) + ')'
+        rows = [(target,) + tuple(merged[target][c] for c in columns) for target in targets]
+        returned = execute_values(cur, f'''
+            UPDATE {table} AS t SET {set_clause}
+            FROM (VALUES %s) AS v({id_column}, {', '.join(names)})
+            WHERE t.{id_column} = v.{id_column}
+            RETURNING t.{id_column}
+        ''', rows, template=template, page_size=len(rows), fetch=True)
+        updated.update(row[0] for row in returned)
+    return updated
+
+
+def update_people(cur, merged):
+    """Apply ``{id: {field: value}}`` to people; returns the ids that matched"""
+    return _update(cur, 'people', 'id', PERSON_FIELDS, merged)
+
+
+def update_activities(cur, merged):
+    """Apply ``{activity_id: {field: value}}`` to activities; returns the ids that matched"""
+    return _update(cur, 'activities', 'activity_id', ACTIVITY_FIELDS, merged)
+
+
+def apply(cur, parsed):
+    """Run validated operations on ``cur`` and build per-item results.
+
+    The caller owns the transaction: nothing here commits.
+    """
+    people = _merge(parsed, 'update_person')
+    for fields in people.values():
+        if fields.get('gender'):
+            fields['gender'] = genders.lookup(fields['gender'], cur)
+    activities = _merge(parsed, 'update_activities')
+    deletes = sorted({target for op, target, _ in parsed if op == 'delete_person'})
+
+    updated_people = update_people(cur, people) if people else set()
+    updated_activities = update_activities(cur, activities) if activities else set()
+    deleted = set()
+    if deletes:
+        cur.execute('DELETE FROM people WHERE id = ANY(%s) RETURNING id', (deletes,))
+        deleted = {row[0] for row in cur.fetchall()}
+
+    results = []
+    for index, (op, target, _) in enumerate(parsed):
+        if op == 'update_person':
+            status = 'updated' if target in updated_people else 'not_found'
+        elif op == 'update_activities':
+            status = 'updated' if target in updated_activities else 'not_found'
+        else:
+            status = 'deleted' if target in deleted else 'not_found'
+        results.append({'index': index, 'op': op, 'id': target, 'status': status})
+    return results
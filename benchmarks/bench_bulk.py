@@ -0,0 +1,67 @@
+"""Compare rows/second of POST /people in a loop against POST /people/bulk.
+
+Inserts synthetic people into the database configured in the environment
+and deletes them again afterwards.
+
+    python benchmarks/bench_bulk.py --rows 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from db import get_connection  # noqa: E402
+
+
+def make_people(count, tag):
+    return [{
+        'first_name': f'bench{i}',
+        'last_name': tag,
+        'email': f'bench{i}.{tag}@example.com',
+        'gender': 'female' if i % 2 else 'male',
+        'contact': f'0600{i:06d}',
+        'mother_name': f'mother{i}',
+    } for i in range(count)]
+
+
+def cleanup(tag):
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM people WHERE last_name = %s', (tag,))
+        conn.commit()
+        cur.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--loop-rows', type=int, default=200,
+                        help='rows to insert one request at a time (the slow path)')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+    client = app.test_client()
+    tag = f'bench-{os.getpid()}'
+
+    try:
+        people = make_people(args.loop_rows, tag)
+        start = time.perf_counter()
+        for person in people:
+            assert client.post('/people', json=person).status_code == 201
+        loop_rate = len(people) / (time.perf_counter() - start)
+        print(f'POST /people loop: {loop_rate:10.1f} rows/s')
+
+        people = make_people(args.rows, tag)
+        start = time.perf_counter()
+        response = client.post(f'/people/bulk?chunk_size={args.chunk_size}', json=people)
+        bulk_rate = len(people) / (time.perf_counter() - start)
+        assert response.status_code == 201, response.get_json()
+        print(f'POST /people/bulk: {bulk_rate:10.1f} rows/s ({bulk_rate / loop_rate:.1f}x)')
+    finally:
+        cleanup(tag)
+
+
+if __name__ == '__main__':
+    main()
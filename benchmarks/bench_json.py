@@ -0,0 +1,69 @@
+"""Microbenchmark of JSON response encoding on a 10k-row class listing.
+
+Compares Flask's default provider with the orjson provider (HTTP and ISO
+dates), for both the usual list of objects and ``format=columns``.  Needs
+no database: rows are synthetic tuples shaped like CLASS_STUDENTS results.
+
+    python benchmarks/bench_json.py --rows 10000
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+from serialization import OrjsonProvider, orjson, tabulate  # noqa: E402
+
+COLUMNS = ['id', 'first_name', 'last_name', 'email', 'gender_name',
+           'contact', 'mother_name', 'created_at', 'class_name']
+
+
+def make_rows(count):
+    start = datetime(2024, 9, 1, 8, 0, 0)
+    return [
+        (i, f'first{i}', f'last{i}', f'person{i}@example.com', 'female' if i % 2 else 'male',
+         f'0600{i:06d}', f'mother{i}', start + timedelta(seconds=i), 'cp1')
+        for i in range(count)
+    ]
+
+
+def bench(provider, rows, fmt, number):
+    app = Flask(__name__)
+    app.json = provider(app)
+    with app.app_context():
+        def encode():
+            payload = tabulate(COLUMNS, rows, fmt)
+            return app.json.response({'students': payload, 'count': len(rows)}).get_data()
+        size = len(encode())
+        seconds = min(timeit.repeat(encode, number=number, repeat=3)) / number
+    return seconds, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=10)
+    args = parser.parse_args()
+    rows = make_rows(args.rows)
+
+    providers = [('default', DefaultJSONProvider)]
+    if orjson is not None:
+        providers.append(('orjson/http', OrjsonProvider))
+        providers.append(('orjson/iso', lambda app: OrjsonProvider(app, date_format='iso')))
+
+    baseline = None
+    for name, provider in providers:
+        for fmt in ('records', 'columns'):
+            seconds, size = bench(provider, rows, fmt, args.number)
+            baseline = baseline or seconds
+            print(f'{name:>12} {fmt:>8}: {seconds * 1000:8.2f} ms  {size / 1024:8.1f} KiB  '
+                  f'{baseline / seconds:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
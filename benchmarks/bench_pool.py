@@ -0,0 +1,90 @@
+"""Compare GET /people latency with and without connection pooling.
+
+Runs the Flask app in-process through its test client against the database
+configured in the environment (DB_HOST, DB_PORT, ...), first with connections
+closed after every request (the old behaviour) and then with pooled reuse.
+The response cache, materialized views, request coalescing and read
+replicas are turned off so every request checks out a connection from the
+pool being measured.
+
+    python benchmarks/bench_pool.py --requests 500 --threads 8
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+os.environ['RESPONSE_CACHE_ENABLED'] = '0'
+os.environ['MATVIEWS_ENABLED'] = '0'
+os.environ['SINGLE_FLIGHT_ENABLED'] = '0'
+os.environ['DB_REPLICAS'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from db import pool  # noqa: E402
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(path, requests, threads):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = requests // threads
+
+    def worker():
+        client = app.test_client()
+        local = []
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            response = client.get(path)
+            local.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def report(label, latencies, errors, elapsed):
+    print(f"{label:>10}: n={len(latencies)} errors={len(errors)} "
+          f"rps={len(latencies) / elapsed:8.1f} "
+          f"p50={percentile(latencies, 50) * 1000:7.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:7.2f}ms "
+          f"mean={statistics.mean(latencies) * 1000:7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='/people')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=10)
+    args = parser.parse_args()
+
+    pool.maxconn = max(pool.maxconn, args.threads)
+    for label, reuse in (('no pool', False), ('pool', True)):
+        pool.closeall()
+        pool.reuse = reuse
+        run(args.path, args.warmup, 1)
+        latencies, errors, elapsed = run(args.path, args.requests, args.threads)
+        report(label, latencies, errors, elapsed)
+    print('pool stats:', pool.stats())
+
+
+if __name__ == '__main__':
+    main()
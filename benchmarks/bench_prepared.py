@@ -0,0 +1,105 @@
+"""Measure what prepared statements save on GET /people/<id>.
+
+First asks Postgres itself: EXPLAIN ANALYZE reports the planning time of the
+plain PERSON_BY_ID text and of EXECUTE on the prepared statement.  Then drives
+GET /people/<id> through the Flask test client from several threads over
+random ids, with prepared statements off and on.  The response cache is
+disabled so every request reaches the database.
+
+    python benchmarks/bench_prepared.py --requests 5000 --threads 8
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+os.environ['RESPONSE_CACHE_ENABLED'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prepared  # noqa: E402
+from app import app  # noqa: E402
+from bench_pool import percentile  # noqa: E402
+from db import connect, pool  # noqa: E402
+from queries import PERSON_BY_ID, numbered  # noqa: E402
+
+TIMING = re.compile(r'(Planning|Execution) Time: ([\d.]+) ms')
+
+
+def explain_times(cur, sql, params):
+    cur.execute('EXPLAIN (ANALYZE, TIMING OFF, SUMMARY) ' + sql, params)
+    times = dict(TIMING.search(row[0]).groups() for row in cur.fetchall() if TIMING.search(row[0]))
+    return float(times['Planning']), float(times['Execution'])
+
+
+def planner(ids, samples):
+    """Mean (planning, execution) ms for the plain and the prepared statement"""
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(f'PREPARE bench_person_by_id AS {numbered(PERSON_BY_ID)}')
+    results = {}
+    for label, sql in (('plain', PERSON_BY_ID), ('prepared', 'EXECUTE bench_person_by_id (%s)')):
+        times = [explain_times(cur, sql, (random.choice(ids),)) for _ in range(samples)]
+        results[label] = tuple(sum(column) / len(column) for column in zip(*times))
+    conn.close()
+    return results
+
+
+def run(ids, requests, threads):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        local = []
+        for _ in range(requests // threads):
+            start = time.perf_counter()
+            response = client.get(f'/people/{random.choice(ids)}')
+            local.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--samples', type=int, default=200, help='EXPLAIN ANALYZE runs per variant')
+    args = parser.parse_args()
+
+    conn = connect()
+    with conn.cursor() as cur:
+        cur.execute('SELECT id FROM people ORDER BY random() LIMIT 10000')
+        ids = [row[0] for row in cur.fetchall()]
+    conn.close()
+
+    for label, (planning, execution) in planner(ids, args.samples).items():
+        print(f'{label:>10}: planning={planning:.4f}ms execution={execution:.4f}ms (server side)')
+
+    pool.maxconn = max(pool.maxconn, args.threads)
+    for label, enabled in (('plain', False), ('prepared', True)):
+        prepared.PREPARED_STATEMENTS_ENABLED = enabled
+        run(ids, args.threads * 20, args.threads)
+        latencies, errors, elapsed = run(ids, args.requests, args.threads)
+        print(f'{label:>10}: n={len(latencies)} errors={len(errors)} '
+              f'rps={len(latencies) / elapsed:8.1f} '
+              f'p50={percentile(latencies, 50) * 1000:7.2f}ms '
+              f'p99={percentile(latencies, 99) * 1000:7.2f}ms')
+    print('prepared statements:', prepared.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""HTTP load generator for the API.
+
+Opens ``--concurrency`` keep-alive connections that each issue requests
+back to back for ``--duration`` seconds, then prints one JSON object with
+throughput, latency percentiles and error rates, overall and per route.
+Uses only the standard library so it can run anywhere the app does.
+
+With a URL path and no ``--scenario`` every request goes to that URL, which
+is how the sync (gunicorn) and async (uvicorn) apps were compared::
+
+    gunicorn app:app -w 4 -b 127.0.0.1:8000 &
+    uvicorn asgi:app --workers 4 --port 8001 &
+    python benchmarks/loadtest.py http://127.0.0.1:8000/people --concurrency 500
+    python benchmarks/loadtest.py http://127.0.0.1:8001/people --concurrency 500
+
+A scenario drives a weighted mix of routes against the base URL instead.
+Ids, class names and names to search for are discovered through the API
+first, and the random choices are seeded so runs are repeatable::
+
+    python seed.py --reset --people 1000000 --classes 200
+    python benchmarks/loadtest.py http://127.0.0.1:8000 --scenario mixed \\
+        --concurrency 64 --duration 60 --output run.json
+    python benchmarks/loadtest.py http://127.0.0.1:8000 --scenario mixed \\
+        --concurrency 64 --duration 60 --compare run.json
+
+``--mix route=weight,...`` overrides scenario weights; routes are the keys
+of ROUTES.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import date, timedelta
+from urllib.parse import quote, urlsplit
+
+# Requests per route, given the discovered ids/classes and a random source
+ROUTES = {
+    'people_list': lambda ctx, rng: ('GET', '/people?limit=50', None),
+    'people_list_filtered': lambda ctx, rng: ('GET', '/people?limit=50&gender=female&activity1=true', None),
+    'people_with_activities': lambda ctx, rng: ('GET', f'/people?limit=50&after={ctx.person(rng)}'
+                                                       '&include=activities', None),
+    'person': lambda ctx, rng: ('GET', f'/people/{ctx.person(rng)}', None),
+    'activities_list': lambda ctx, rng: ('GET', '/activities?limit=50', None),
+    'activities_by_person': lambda ctx, rng: ('GET', f'/activities/person/{ctx.person(rng)}', None),
+    'activity1': lambda ctx, rng: ('GET', '/activity1?limit=50', None),
+    'transport': lambda ctx, rng: ('GET', '/transport?limit=50', None),
+    'gender': lambda ctx, rng: ('GET', '/gender', None),
+    'class': lambda ctx, rng: ('GET', f'/{rng.choice(ctx.classes)}', None),
+    'people_search': lambda ctx, rng: ('GET', f'/people/search?q={ctx.search_term(rng)}', None),
+    'people_by_ids': lambda ctx, rng: ('GET', '/people?ids=' + ','.join(
+        str(ctx.person(rng)) for _ in range(20)), None),
+    'stats': lambda ctx, rng: ('GET', f"/stats?bucket={rng.choice(('month', 'quarter', 'year'))}", None),
+    'people_export': lambda ctx, rng: ('GET', '/people/export?format=ndjson&' + ctx.one_day(rng), None),
+    'changes': lambda ctx, rng: ('GET', '/changes' + (f'?after={ctx.position}' if ctx.position else ''), None),
+    'people_create': lambda ctx, rng: ('POST', '/people', {
+        'first_name': 'load', 'last_name': f'test{rng.randrange(10 ** 9)}',
+        'email': 'load@example.com', 'gender': rng.choice(('male', 'female')),
+    }),
+    'people_update': lambda ctx, rng: ('PUT', f'/people/{ctx.person(rng)}', {
+        'contact': f'06{rng.randrange(10 ** 8):08d}'}),
+    'activities_update': lambda ctx, rng: ('PUT', f'/activities/{ctx.person(rng)}', {
+        'activity2': rng.random() < 0.5}),
+    'people_delete': lambda ctx, rng: ctx.delete_created(rng),
+    'batch': lambda ctx, rng: ('POST', '/batch', [
+        {'op': 'update_activities', 'activity_id': ctx.person(rng), 'transport': rng.random() < 0.1}
+        for _ in range(10)
+    ]),
+    'people_bulk': lambda ctx, rng: ('POST', '/people/bulk', [
+        {'first_name': 'load', 'last_name': f'bulk{rng.randrange(10 ** 9)}', 'email': 'load@example.com',
+         'gender': rng.choice(('male', 'female'))}
+        for _ in range(100)
+    ]),
+}
+
+# 'read' only uses routes the async app serves too; the export, the JSON
+# change feed and the writes are the Flask app's
+SCENARIOS = {
+    'read': {
+        'people_list': 12, 'people_list_filtered': 5, 'people_with_activities': 5, 'person': 25,
+        'activities_list': 8, 'activities_by_person': 13, 'activity1': 5, 'transport': 5,
+        'gender': 4, 'class': 5, 'people_search': 6, 'people_by_ids': 5, 'stats': 2,
+    },
+    'mixed': {
+        'people_list': 10, 'people_list_filtered': 3, 'people_with_activities': 3, 'person': 20,
+        'activities_list': 6, 'activities_by_person': 10, 'activity1': 3, 'transport': 3,
+        'gender': 3, 'class': 3, 'people_search': 5, 'people_by_ids': 4, 'stats': 2, 'people_export': 1,
+        'changes': 4, 'people_create': 6, 'people_update': 6, 'activities_update': 4, 'people_delete': 2,
+        'batch': 1, 'people_bulk': 1,
+    },
+}
+
+
+class Context:
+    """What the scenario routes need to know about the data set"""
+
+    def __init__(self, min_id, max_id, classes, names):
+        self.min_id = min_id
+        self.max_id = max_id
+        self.classes = classes
+        self.names = names
+        # People created by this run, which are the only ones it deletes
+        self.created = []
+        # Where the change feed was last polled up to
+        self.position = None
+
+    def person(self, rng):
+        return rng.randint(self.min_id, self.max_id)
+
+    def search_term(self, rng):
+        """A known name, or a prefix of one half the time"""
+        name = rng.choice(self.names)
+        if rng.random() < 0.5:
+            name = name[:rng.randint(min(3, len(name)), len(name))]
+        return quote(name)
+
+    def one_day(self, rng):
+        """created_after/created_before bounds of one day in the last two years
+        (seed.py spreads created_at over 730 days), so an export stays small"""
+        day = date.today() - timedelta(days=rng.randrange(730))
+        return f'created_after={day.isoformat()}&created_before={(day + timedelta(days=1)).isoformat()}'
+
+    def delete_created(self, rng):
+        if not self.created:
+            return ROUTES['people_create'](self, rng)
+        return ('DELETE', f'/people/{self.created.pop(rng.randrange(len(self.created)))}', None)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response.
+
+    Returns its status code, its body and whether the server keeps the
+    connection open (gunicorn's sync workers close it after every response).
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    status = int(status_line.split()[1])
+    length = None
+    chunked = False
+    keep_alive = True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value.lower():
+            chunked = True
+        elif name == 'connection' and 'close' in value.lower():
+            keep_alive = False
+    body = b''
+    if chunked:
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            chunks.append((await reader.readexactly(size + 2))[:-2])
+            if size == 0:
+                break
+        body = b''.join(chunks)
+    elif length:
+        body = await reader.readexactly(length)
+    return status, body, keep_alive
+
+
+def encode_request(target, method, path, body):
+    head = f'{method} {path} HTTP/1.1\r\nHost: {target.netloc}\r\n'
+    if body is None:
+        return (head + '\r\n').encode()
+    payload = json.dumps(body).encode()
+    head += f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n'
+    return head.encode() + payload
+
+
+async def request(connection, target, method, path, body=None):
+    reader, writer = connection
+    writer.write(encode_request(target, method, path, body))
+    await writer.drain()
+    return await read_response(reader)
+
+
+async def client(target, pick, deadline, results, ctx):
+    connection = None
+    while time.perf_counter() < deadline:
+        route, method, path, body = pick()
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(target.hostname, target.port or 80)
+            status, payload, keep_alive = await request(connection, target, method, path, body)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            errors = results[route]['errors']
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            if connection is not None:
+                connection[1].close()
+            connection = None
+            continue
+        stats = results[route]
+        stats['latencies'].append(time.perf_counter() - start)
+        if not keep_alive:
+            connection[1].close()
+            connection = None
+        stats['status'][status] = stats['status'].get(status, 0) + 1
+        if route in ('people_create', 'people_delete') and method == 'POST' and status == 201:
+            ctx.created.append(json.loads(payload)['person_id'])
+        elif route == 'changes' and status == 200:
+            ctx.position = json.loads(payload)['position']
+    if connection is not None:
+        connection[1].close()
+
+
+async def discover(target):
+    """Find the people id range and some class names through the API"""
+    async def get(path):
+        connection = await asyncio.open_connection(target.hostname, target.port or 80)
+        try:
+            return (await request(connection, target, 'GET', path))[:2]
+        finally:
+            connection[1].close()
+
+    status, body = await get('/people?limit=500')
+    if status != 200:
+        raise SystemExit(f'GET /people returned {status}; is the database seeded?')
+    people = json.loads(body)['people']
+    if not people:
+        raise SystemExit('No people found; seed the database first (python seed.py)')
+    min_id = people[0]['id']
+    classes = sorted({person['class'] for person in people if person.get('class')}) or ['class1']
+    names = sorted({person[key] for person in people for key in ('first_name', 'last_name') if person.get(key)})
+    # Grow then bisect to the highest id that still exists
+    low, step = min_id, 1
+    while (await get(f'/people/{low + step}'))[0] == 200:
+        low, step = low + step, step * 2
+    high = low + step
+    while high - low > 1:
+        middle = (low + high) // 2
+        if (await get(f'/people/{middle}'))[0] == 200:
+            low = middle
+        else:
+            high = middle
+    return Context(min_id, low, classes, names)
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        route, _, weight = item.partition('=')
+        if route not in ROUTES:
+            raise SystemExit(f"Unknown route in --mix: {route} (expected one of {', '.join(ROUTES)})")
+        mix[route] = float(weight or 1)
+    return mix
+
+
+async def run(url, concurrency, duration, scenario=None, mix=None, seed=0):
+    target = urlsplit(url)
+    if scenario is None and not mix:
+        path = target.path + (f'?{target.query}' if target.query else '')
+        routes, weights, ctx = [path], [1], None
+        pick = lambda: (path, 'GET', path, None)  # noqa: E731
+    else:
+        weights_by_route = dict(SCENARIOS[scenario or 'mixed'])
+        weights_by_route.update(mix or {})
+        routes = [route for route, weight in weights_by_route.items() if weight > 0]
+        weights = [weights_by_route[route] for route in routes]
+        ctx = await discover(target)
+        rng = random.Random(seed)
+
+        def pick():
+            route = rng.choices(routes, weights)[0]
+            return (route, *ROUTES[route](ctx, rng))
+
+    results = {route: {'latencies': [], 'status': {}, 'errors': {}} for route in routes}
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(client(target, pick, deadline, results, ctx) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    overall = {'latencies': [], 'status': {}, 'errors': {}}
+    for stats in results.values():
+        overall['latencies'].extend(stats['latencies'])
+        for key in ('status', 'errors'):
+            for name, count in stats[key].items():
+                overall[key][name] = overall[key].get(name, 0) + count
+    summary = {'url': url, 'concurrency': concurrency}
+    summary.update(summarize(elapsed, overall))
+    if ctx is not None:
+        summary['scenario'] = {'name': scenario or 'mixed', 'seed': seed,
+                               'weights': dict(zip(routes, weights)),
+                               'people_id_range': [ctx.min_id, ctx.max_id]}
+        summary['routes'] = {route: summarize(elapsed, stats) for route, stats in results.items()}
+    return summary
+
+
+def summarize(elapsed, results):
+    latencies = results['latencies']
+    failed = sum(count for status, count in results['status'].items() if status >= 400)
+    failed += sum(results['errors'].values())
+    total = len(latencies) + sum(results['errors'].values())
+    return {
+        'duration_s': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            name: round(percentile(latencies, pct) * 1000, 2) if latencies else None
+            for name, pct in (('p50', 50), ('p95', 95), ('p99', 99))
+        },
+        'error_rate': round(failed / total, 4) if total else 0.0,
+        'status': {str(k): v for k, v in sorted(results['status'].items())},
+        'errors': results['errors'],
+    }
+
+
+def compare(baseline, current):
+    """Relative change of throughput and latency per route against a previous run"""
+    def delta(old, new):
+        return round((new - old) / old, 4) if old and new is not None else None
+
+    pairs = [('overall', baseline, current)]
+    pairs += [(route, baseline.get('routes', {}).get(route), stats)
+              for route, stats in current.get('routes', {}).items()]
+    changes = {}
+    for name, old, new in pairs:
+        if not old:
+            continue
+        changes[name] = {'throughput_rps': delta(old['throughput_rps'], new['throughput_rps'])}
+        changes[name].update({f'latency_{pct}': delta(old['latency_ms'][pct], new['latency_ms'][pct])
+                              for pct in ('p50', 'p95', 'p99')})
+        changes[name]['error_rate'] = round(new['error_rate'] - old['error_rate'], 4)
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--mix', type=parse_mix, help='route=weight,... added to the scenario')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the request mix')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+    summary = asyncio.run(run(args.url, args.concurrency, args.duration, args.scenario, args.mix, args.seed))
+    if args.compare:
+        with open(args.compare) as f:
+            summary['change'] = compare(json.load(f), summary)
+    text = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
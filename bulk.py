@@ -0,0 +1,149 @@
+import csv
+import io
+import json
+import os
+
+import psycopg2
+
+from db import get_connection
+from refdata import genders
+
+# Rows inserted and committed per transaction, and the upload size cap
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 100000))
+
+PERSON_REQUIRED_FIELDS = ['first_name', 'last_name', 'email']
+
+
+def parse_upload(body, content_type):
+    """Split an upload into per-row records.
+
+    Accepts a JSON array, NDJSON (one object per line) or CSV with a header
+    row.  Returns ``(records, errors)`` where a record that could not be
+    decoded is ``None`` and its problem is listed in ``errors``.
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    errors = []
+    if content_type == 'text/csv':
+        records = list(csv.DictReader(io.StringIO(body)))
+    elif content_type in ('application/x-ndjson', 'application/jsonl'):
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError as e:
+                errors.append({'row': len(records), 'error': f'Invalid JSON: {e}'})
+                records.append(None)
+    else:
+        try:
+            records = json.loads(body)
+        except ValueError as e:
+            raise ValueError(f'Invalid JSON: {e}')
+        if not isinstance(records, list):
+            raise ValueError('Expected a JSON array of people')
+    if len(records) > BULK_MAX_ROWS:
+        raise ValueError(f'Too many rows: {len(records)} (limit is {BULK_MAX_ROWS})')
+    return records, errors
+
+
+def validate_person(record):
+    """Return an error message for an unusable record, or None"""
+    if not isinstance(record, dict):
+        return 'Expected an object'
+    for field in PERSON_REQUIRED_FIELDS:
+        if not record.get(field):
+            return f'Missing required field: {field}'
+    return None
+
+
+# One array per column keeps this to a single statement per table.  The ids
+# are drawn before the insert so each can be returned with its row's
+# ordinal: RETURNING gives no guarantee about the order of its rows.
+BULK_INSERT_PEOPLE = '''
+    WITH input AS (
+        SELECT nextval(pg_get_serial_sequence('people', 'id')) AS id, u.*
+        FROM unnest(%s::text[], %s::text[], %s::text[], %s::int[], %s::text[], %s::text[])
+            WITH ORDINALITY AS u (first_name, last_name, email, gender_id, contact, mother_name, ord)
+    ), inserted AS (
+        INSERT INTO people (id, first_name, last_name, email, gender_id, contact, mother_name)
+        SELECT id, first_name, last_name, email, gender_id, contact, mother_name FROM input
+        RETURNING id
+    )
+    SELECT input.ord, inserted.id FROM inserted JOIN input USING (id)
+'''
+
+BULK_INSERT_ACTIVITIES = '''
+    INSERT INTO activities (person_id, activity1, activity2, transport)
+    SELECT person_id, FALSE, FALSE, FALSE FROM unnest(%s::int[]) AS person_id
+'''
+
+
+def _insert_rows(cur, rows):
+    """Insert ``rows`` and their default activities; returns their ids in order"""
+    cur.execute(BULK_INSERT_PEOPLE, [list(column) for column in zip(*rows)])
+    ids = [None] * len(rows)
+    for ordinal, person_id in cur.fetchall():
+        ids[ordinal - 1] = person_id
+    cur.execute(BULK_INSERT_ACTIVITIES, (ids,))
+    return ids
+
+
+def insert_people(records, chunk_size=BULK_CHUNK_SIZE):
+    """Insert valid records with default activities, committing per chunk.
+
+    Returns ``(person_ids, errors)``: ``person_ids`` is aligned with
+    ``records`` and holds ``None`` for rows that were not inserted.  Gender
+    names resolve through the cached gender table.  A chunk that the
+    database rejects is retried row by row, each under its own savepoint,
+    so only the offending rows are reported and the rest still go in.
+    """
+    person_ids = [None] * len(records)
+    errors = []
+    valid = []
+    for index, record in enumerate(records):
+        if record is None:
+            continue
+        problem = validate_person(record)
+        if problem:
+            errors.append({'row': index, 'error': problem})
+        else:
+            valid.append(index)
+    if not valid:
+        return person_ids, errors
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            rows = []
+            for index in chunk:
+                record = records[index]
+                rows.append((
+                    record['first_name'], record['last_name'], record['email'],
+                    genders.lookup(record['gender'], cur) if record.get('gender') else None,
+                    record.get('contact') or None, record.get('mother_name') or None,
+                ))
+            try:
+                ids = _insert_rows(cur, rows)
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+            else:
+                for index, person_id in zip(chunk, ids):
+                    person_ids[index] = person_id
+                continue
+            for index, row in zip(chunk, rows):
+                cur.execute('SAVEPOINT bulk_row')
+                try:
+                    person_ids[index] = _insert_rows(cur, [row])[0]
+                except psycopg2.Error as e:
+                    cur.execute('ROLLBACK TO SAVEPOINT bulk_row')
+                    errors.append({'row': index, 'error': str(e).strip()})
+                else:
+                    cur.execute('RELEASE SAVEPOINT bulk_row')
+            conn.commit()
+        cur.close()
+    errors.sort(key=lambda e: e['row'])
+    return person_ids, errors
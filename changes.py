@@ -0,0 +1,261 @@
+"""Change feed of inserts, updates and deletes on people and activities.
+
+Statement-level triggers (migration 8) append one ``change_log`` row per
+changed row, numbered by ``seq``, and announce the range they wrote on
+CHANGES_CHANNEL as ``txid:first_seq:last_seq``.  A statement touching more
+than 1000 rows is logged as a single summary row with no ids, which tells
+clients to reload rather than apply deltas.
+
+``seq`` is taken when a row is inserted, not when its transaction commits,
+so a transaction can commit rows numbered below some already visible.
+Readers therefore go through the log in ``(txid, seq)`` order and return
+every committed row, and a reader's Position also lists each older
+transaction that was still running when it got there: their rows are
+returned once they commit, so a long transaction holds up nothing but its
+own rows and a client never skips a row that was yet to appear.  Clients
+get positions as text, the ``seq`` of the last row they got followed by
+``~txid-seq`` for each such transaction; a bare ``seq`` lists none.
+
+Rows older than CHANGES_RETENTION seconds are pruned every
+CHANGES_PRUNE_INTERVAL seconds by a background thread in each Flask worker
+(see health.warm_up), so a client can resume from any sequence id within
+that window; a client whose position was pruned is told to reload.
+
+asgi.py streams the feed as Server-Sent Events at GET /changes; app.py
+serves the same rows as JSON pages for clients that poll.
+
+    python changes.py prune     delete rows older than the retention window
+"""
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+
+from db import PoolTimeout, get_connection
+
+CHANGES_CHANNEL = 'row_changed'
+CHANGES_RETENTION = int(os.environ.get('CHANGES_RETENTION', 24 * 3600))
+CHANGES_PAGE_LIMIT = int(os.environ.get('CHANGES_PAGE_LIMIT', 1000))
+CHANGES_PRUNE_INTERVAL = float(os.environ.get('CHANGES_PRUNE_INTERVAL', 600))
+# Rows deleted per pruning transaction, so no delete holds its locks for long
+CHANGES_PRUNE_BATCH = int(os.environ.get('CHANGES_PRUNE_BATCH', 10000))
+TABLES = ('people', 'activities')
+
+CHANGES_SELECT = '''
+    SELECT c.txid, c.seq, c.table_name, c.op, c.row_id, c.person_id, c.class_id, c.row_count, c.changed_at
+    FROM change_log c'''
+
+# The (txid, seq) position of the newest committed row
+CHANGES_HEAD = '''
+    SELECT txid, seq FROM change_log
+    ORDER BY txid DESC, seq DESC
+    LIMIT 1'''
+
+# Whether a client's position is still in the log, where the log ends and
+# which transactions are still running, all in one snapshot
+CHANGES_POSITION = f'''
+    SELECT EXISTS (SELECT 1 FROM change_log WHERE seq = %s), head.txid, head.seq,
+           ARRAY(SELECT txid_snapshot_xip(txid_current_snapshot()))
+    FROM (SELECT 1) one
+    LEFT JOIN ({CHANGES_HEAD}) head ON TRUE'''
+
+PRUNE_SQL = '''
+    DELETE FROM change_log WHERE seq IN (
+        SELECT seq FROM change_log
+        WHERE changed_at < now() - %s * interval '1 second'
+        LIMIT %s)'''
+
+
+def parse_filters(args):
+    """``table``, ``class`` (a class name) and ``person_id`` from the query string"""
+    filters = {}
+    table = args.get('table')
+    if table:
+        if table not in TABLES:
+            raise ValueError(f"Invalid value for table: {table} (expected one of {', '.join(TABLES)})")
+        filters['table'] = table
+    if args.get('class'):
+        filters['class'] = args['class']
+    person_id = args.get('person_id')
+    if person_id:
+        try:
+            filters['person_id'] = int(person_id)
+        except ValueError:
+            raise ValueError(f'Invalid value for person_id: {person_id}')
+    return filters
+
+
+def parse_sequence(value, name='after'):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid value for {name}: {value}')
+
+
+class Position:
+    """A reader's place in the log.
+
+    ``seq`` is the last row it got in (txid, seq) order, and ``txid`` that
+    row's transaction when known.  ``gaps`` maps each older transaction
+    that was still running when the reader got there, or whose rows it is
+    partway through, to the last seq it got from it (0 for none).
+    """
+
+    def __init__(self, seq=0, gaps=None, txid=None):
+        self.seq = seq
+        self.gaps = gaps or {}
+        self.txid = txid
+
+    def __str__(self):
+        return str(self.seq) + ''.join(f'~{txid}-{seq}' for txid, seq in sorted(self.gaps.items()))
+
+    @classmethod
+    def parse(cls, value, name='after'):
+        """The position a client sent back, as given by ``str()``"""
+        seq, *gaps = value.split('~')
+        try:
+            return cls(int(seq), {int(txid): int(last) for txid, last in (gap.split('-') for gap in gaps)})
+        except ValueError:
+            raise ValueError(f'Invalid value for {name}: {value}')
+
+    def after(self, txid, seq, running):
+        """The position once the row ``(txid, seq)`` from since_query() is
+        read, in a snapshot where the transactions ``running`` were not done"""
+        # Once past a finished transaction, every row it wrote has been read
+        gaps = {gap: last for gap, last in self.gaps.items() if gap >= txid or gap in running}
+        if txid in self.gaps:
+            gaps[txid] = seq
+            return Position(self.seq, gaps, self.txid)
+        gaps.update((other, 0) for other in running if other < txid and other not in gaps)
+        return Position(seq, gaps, txid)
+
+    def settled(self, head_txid, head_seq, running):
+        """The position once every row up to the log's head (from
+        CHANGES_POSITION, None for an empty log) has been read"""
+        gaps = {gap: last for gap, last in self.gaps.items() if gap in running}
+        if head_seq is None:
+            return Position(self.seq, gaps, self.txid)
+        gaps.update((other, 0) for other in running if other < head_txid and other not in gaps)
+        return Position(head_seq, gaps, head_txid)
+
+
+def since_query(position, filters, class_id=None, limit=CHANGES_PAGE_LIMIT):
+    """(sql, params) for the committed changes after ``position`` (a
+    Position; ``Position()`` for the start of the log) that pass ``filters``,
+    in log order, each led by its txid.
+
+    Only the gaps' rows are returned if the position's own row is gone; see
+    CHANGES_POSITION.  Summary rows have no ids, so they pass the class and
+    person filters.
+    """
+    conditions = []
+    params = []
+    if 'table' in filters:
+        conditions.append('c.table_name = %s')
+        params.append(filters['table'])
+    if 'class' in filters:
+        conditions.append('(c.class_id = %s OR c.row_id IS NULL)')
+        params.append(class_id)
+    if 'person_id' in filters:
+        conditions.append('(c.person_id = %s OR c.row_id IS NULL)')
+        params.append(filters['person_id'])
+    if not position.seq:
+        after, after_params = ['TRUE'], []
+    elif position.txid is not None:
+        after, after_params = ['(c.txid, c.seq) > (%s, %s)'], [position.txid, position.seq]
+    else:
+        after = ['(c.txid, c.seq) > ((SELECT txid FROM change_log WHERE seq = %s), %s)']
+        after_params = [position.seq, position.seq]
+    sql = CHANGES_SELECT + ' WHERE ' + ' AND '.join(after + conditions) + ' ORDER BY c.txid, c.seq LIMIT %s'
+    if not position.gaps or not position.seq:
+        return sql, after_params + params + [limit]
+    # Every gap is older than the position's own row, so no row is in both parts
+    gap_sql = CHANGES_SELECT + '''
+    JOIN unnest(%s::bigint[], %s::bigint[]) AS g (txid, seq) ON g.txid = c.txid AND c.seq > g.seq
+    WHERE ''' + ' AND '.join(['TRUE'] + conditions) + ' ORDER BY c.txid, c.seq LIMIT %s'
+    gaps = sorted(position.gaps.items())
+    gap_params = [[txid for txid, _ in gaps], [seq for _, seq in gaps]] + params + [limit]
+    return (f'SELECT * FROM (({gap_sql}) UNION ALL ({sql})) c ORDER BY txid, seq LIMIT %s',
+            gap_params + after_params + params + [limit, limit])
+
+
+def event(row):
+    """The JSON shape of one change_log row"""
+    seq, table, op, row_id, person_id, class_id, row_count, changed_at = row
+    return {'seq': seq, 'table': table, 'op': op, 'id': row_id, 'person_id': person_id,
+            'class_id': class_id, 'count': row_count, 'changed_at': changed_at.isoformat()}
+
+
+def matches(change, filters, class_id=None):
+    """Whether ``change`` (from event()) passes ``filters``; see since_query"""
+    if filters.get('table', change['table']) != change['table']:
+        return False
+    if change['id'] is None:
+        return True
+    if 'class' in filters and change['class_id'] != class_id:
+        return False
+    return filters.get('person_id', change['person_id']) == change['person_id']
+
+
+def prune(retention=CHANGES_RETENTION, batch=CHANGES_PRUNE_BATCH):
+    """Delete log rows older than ``retention`` seconds, ``batch`` rows per
+    transaction; returns how many.  Skipped while another process prunes."""
+    deleted = 0
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('change_log_prune'))")
+                if not cur.fetchone()[0]:
+                    break
+                cur.execute(PRUNE_SQL, (retention, batch))
+                deleted += cur.rowcount
+                conn.commit()
+                if cur.rowcount < batch:
+                    break
+        conn.rollback()
+    return deleted
+
+
+class Pruner:
+    """Background thread pruning the change log every ``interval`` seconds"""
+
+    def __init__(self, interval=CHANGES_PRUNE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {'runs': 0, 'deleted': 0, 'failures': 0}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                deleted = prune()
+            except (psycopg2.Error, PoolTimeout) as e:
+                print(f'pruning the change log failed: {e}', file=sys.stderr)
+                self.stats['failures'] += 1
+                continue
+            self.stats['runs'] += 1
+            self.stats['deleted'] += deleted
+
+    def ensure_running(self):
+        """Start this process's pruner if it is not running yet"""
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='change-log-pruner', daemon=True).start()
+            self._pid = os.getpid()
+
+
+pruner = Pruner()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['prune']:
+        print(f'Pruned {prune()} change log rows')
+    else:
+        print('usage: python changes.py prune')
+        sys.exit(2)
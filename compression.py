@@ -0,0 +1,112 @@
+"""Negotiated gzip/brotli compression of Flask responses.
+
+JSON, NDJSON, CSV and plain-text responses are compressed with the best
+encoding the client accepts (brotli when the Brotli package is installed,
+then gzip).  Bodies smaller than COMPRESS_MIN_SIZE bytes are sent as they
+are.  Bodies already in memory are compressed in one call and keep their
+Content-Length; streamed responses (the exports) are compressed chunk by
+chunk as they are sent, and closing the compressed stream closes the
+export's own, so a client that disconnects releases its cursor and
+connection.
+"""
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') not in ('0', 'false', 'False', '')
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+# Brotli's higher qualities cost far more CPU than they save in transfer time
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+stats = {'compressed': 0, 'streamed': 0, 'too_small': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+ENCODINGS = {'gzip': _Gzip}
+if brotli is not None:
+    ENCODINGS = {'br': _Brotli, **ENCODINGS}
+
+
+def _compressed(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            stats['bytes_in'] += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                stats['bytes_out'] += len(data)
+                yield data
+        data = compressor.finish()
+        stats['bytes_out'] += len(data)
+        yield data
+    finally:
+        # The WSGI server only closes the outer iterator
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _compress_body(body, compressor):
+    data = compressor.compress(body) + compressor.finish()
+    stats['bytes_in'] += len(body)
+    stats['bytes_out'] += len(data)
+    return data
+
+
+def compress(response, accept_encodings):
+    """After a request: compress ``response`` if the client accepts it and it
+    is worth it; ``accept_encodings`` is the request's Accept-Encoding"""
+    if (not COMPRESS_ENABLED or response.mimetype not in COMPRESSIBLE_TYPES
+            or not 200 <= response.status_code < 300 or response.status_code == 204
+            or 'Content-Encoding' in response.headers
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accept_encodings.best_match(list(ENCODINGS))
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        stats['streamed'] += 1
+        response.response = _compressed(response.response, ENCODINGS[encoding]())
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            stats['too_small'] += 1
+            return response
+        response.set_data(_compress_body(body, ENCODINGS[encoding]()))
+    stats['compressed'] += 1
+    response.headers['Content-Encoding'] = encoding
+    if response.is_streamed:
+        response.headers.pop('Content-Length', None)
+    # The compressed body is a different representation of the same resource
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
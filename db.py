@@ -0,0 +1,511 @@
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+
+# PostgreSQL connection details (use environment variables for security)
+DB_HOST = os.environ.get('DB_HOST') or os.environ.get('DATABASE_HOST', 'centerbeam.proxy.rlwy.net')
+DB_PORT = os.environ.get('DB_PORT') or os.environ.get('DATABASE_PORT', '43742')
+DB_NAME = os.environ.get('DB_NAME') or os.environ.get('DATABASE_NAME', 'railway')
+DB_USER = os.environ.get('DB_USER') or os.environ.get('DATABASE_USER', 'postgres')
+DB_PASS = os.environ.get('DB_PASS') or os.environ.get('DATABASE_PASSWORD', 'HPrpLUmYHcScrLfeZZDjAXUcpKHpfHJs')
+
+# Pool sizing and behaviour
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', 30))
+DB_POOL_ENABLED = os.environ.get('DB_POOL_ENABLED', '1') not in ('0', 'false', 'False', '')
+
+# Seconds libpq may spend establishing a new connection
+DB_CONNECT_TIMEOUT = float(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+# Consecutive connection failures, pool timeouts or failed statements that
+# open a pool's circuit, and how long it stays open before one trial request
+DB_BREAKER_FAILURES = int(os.environ.get('DB_BREAKER_FAILURES', 5))
+DB_BREAKER_RESET = float(os.environ.get('DB_BREAKER_RESET', 10))
+
+# (statement_timeout ms, connect timeout s) of the request being served;
+# set per route by the admission module
+_request_limits = contextvars.ContextVar('db_request_limits', default=None)
+# Called with the exception when a request could not get a connection
+_unavailable_hooks = []
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout"""
+
+
+class CircuitOpen(PoolTimeout):
+    """Raised instead of trying the database while its circuit is open"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops trying a database that keeps failing.
+
+    After ``failures`` consecutive failures the circuit opens and callers
+    fail immediately for ``reset_after`` seconds; then a single trial is let
+    through, and its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, failures=DB_BREAKER_FAILURES, reset_after=DB_BREAKER_RESET):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failed = 0
+        self._opened_at = None
+        self._trial = False
+        self._trial_at = None
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    def check(self):
+        """Raise CircuitOpen unless a request may use the database now"""
+        if self.failures <= 0:
+            return
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            retry_after = self._opened_at + self.reset_after - now
+            # A trial that never reported back does not block the next one
+            if retry_after <= 0 and (not self._trial or now - self._trial_at > self.reset_after):
+                self._trial = True
+                self._trial_at = now
+                return
+            self._stats['rejected'] += 1
+        raise CircuitOpen('Database circuit is open after repeated failures', max(retry_after, 1))
+
+    def success(self):
+        with self._lock:
+            self._failed = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self._trial or (self._opened_at is None and self._failed >= self.failures > 0):
+                if self._opened_at is None or self._trial:
+                    self._stats['opened'] += 1
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                state = 'closed'
+            elif self._trial:
+                state = 'half_open'
+            else:
+                state = 'open'
+            return {'state': state, 'consecutive_failures': self._failed, **self._stats}
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that times statements and fetches for the metrics module.
+
+    Each statement is prefixed with a comment naming the route that issued
+    it, so it can be traced in pg_stat_activity and the server logs.
+    """
+
+    def execute(self, query, vars=None):
+        route = metrics.current_route()
+        if route is not None and isinstance(query, str):
+            query = f'/* route={route} */ {query}'
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            metrics.add_time('fetch', time.perf_counter() - start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            metrics.add_time('fetch', time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            metrics.add_time('fetch', time.perf_counter() - start)
+
+
+class Connection(psycopg2.extensions.connection):
+    """Connection that remembers which named statements it has prepared.
+
+    A reconnect yields a new object with empty sets, so statements are
+    prepared again on the new session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        # Prepared, but with a cached plan the server rejected after DDL
+        self.stale_prepared = set()
+        # Session statement_timeout in ms, None while it is the server default
+        self.statement_timeout = None
+
+
+def connect(dsn=None, connect_timeout=DB_CONNECT_TIMEOUT):
+    """Open a new, unpooled connection to the primary, or to ``dsn`` if given"""
+    cursor_factory = TimedCursor if metrics.METRICS_ENABLED else None
+    # libpq takes whole seconds, and 0 means wait forever
+    connect_timeout = max(math.ceil(connect_timeout), 1) if connect_timeout else 0
+    if dsn is not None:
+        return psycopg2.connect(dsn, connection_factory=Connection, cursor_factory=cursor_factory,
+                                connect_timeout=connect_timeout)
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASS,
+        connect_timeout=connect_timeout,
+        connection_factory=Connection,
+        cursor_factory=cursor_factory
+    )
+
+
+class ConnectionPool:
+    """Thread-safe, fork-aware pool of psycopg2 connections.
+
+    Connections are opened lazily up to ``maxconn``; callers beyond that wait
+    up to ``timeout`` seconds for one to be returned.  A connection that has
+    been idle for more than ``check_idle`` seconds is pinged before it is
+    handed out again.  When ``reuse`` is false every connection is closed on
+    release, which reproduces the old connect-per-request behaviour.  Each
+    pool has its own circuit breaker.
+    """
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 check_idle=DB_POOL_CHECK_IDLE, reuse=DB_POOL_ENABLED, connect=connect):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.reuse = reuse
+        self._connect = connect
+        self.breaker = CircuitBreaker()
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # Called at construction and in a forked child.  Connections inherited
+        # from the parent share its sockets, so they are forgotten rather than
+        # closed (closing would terminate the parent's sessions).
+        self._pid = os.getpid()
+        self._idle = []
+        self._in_use = 0
+        self._opened = 0
+        self._stats = {
+            'acquired': 0,
+            'created': 0,
+            'discarded': 0,
+            'health_checks': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _after_fork(self):
+        # The parent's lock may have been held by another thread at fork time
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _ping(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._opened -= 1
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        """Take a connection from the pool, opening one if there is room.
+
+        ``timeout`` bounds the wait for a free slot and the connect itself
+        (default: the pool's timeout and DB_CONNECT_TIMEOUT).
+        """
+        self.breaker.check()
+        start = time.monotonic()
+        deadline = start + (self.timeout if timeout is None else timeout)
+        while True:
+            with self._cond:
+                self._check_pid()
+                while True:
+                    ping = False
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        if conn.closed:
+                            self._discard(conn)
+                            continue
+                        ping = time.monotonic() - idle_since >= self.check_idle
+                        if ping:
+                            self._stats['health_checks'] += 1
+                        break
+                    if self._opened < self.maxconn:
+                        # Reserve the slot, then connect outside the lock
+                        self._opened += 1
+                        conn = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        self.breaker.failure()
+                        raise PoolTimeout(f'No database connection available after {deadline - start:g}s')
+                    self._cond.wait(remaining)
+                self._in_use += 1
+            # Long idle connections are pinged outside the lock too, holding
+            # their slot meanwhile
+            if not ping or self._ping(conn):
+                break
+            with self._cond:
+                self._in_use -= 1
+                self._discard(conn)
+                self._cond.notify()
+
+        if conn is None:
+            try:
+                if timeout is None:
+                    conn = self._connect()
+                else:
+                    conn = self._connect(connect_timeout=max(deadline - time.monotonic(), 0.001))
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                self.breaker.failure()
+                raise
+            with self._cond:
+                self._stats['created'] += 1
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._stats['acquired'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        return conn
+
+    def putconn(self, conn, broken=False):
+        """Return a connection to the pool, closing it if it is unusable"""
+        if self._pid != os.getpid():
+            # Handed out before a fork; the parent still owns the socket
+            return
+        # Rolled back before taking the lock, like the ping in getconn
+        if not broken and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if broken or conn.closed or not self.reuse:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def prefill(self):
+        """Open connections until ``minconn`` are idle in the pool"""
+        with self._cond:
+            self._check_pid()
+            missing = self.minconn - self._opened
+        for _ in range(max(missing, 0)):
+            self.putconn(self.getconn())
+
+    def closeall(self):
+        """Close every idle connection"""
+        with self._cond:
+            self._check_pid()
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self):
+        """Snapshot of pool usage counters"""
+        with self._cond:
+            self._check_pid()
+            stats = dict(self._stats)
+            acquired = stats['acquired']
+            stats.update({
+                'breaker': self.breaker.state(),
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'size': self._opened,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'reuse': self.reuse,
+                'wait_time_avg': stats['wait_time_total'] / acquired if acquired else 0.0,
+            })
+            return stats
+
+
+pool = ConnectionPool()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pool._after_fork)
+
+
+def _pool_metrics():
+    stats = pool.stats()
+    lines = []
+    for name, key, kind, help_text in (
+        ('db_pool_size', 'size', 'gauge', 'Open connections in this worker\'s pool'),
+        ('db_pool_in_use', 'in_use', 'gauge', 'Connections currently checked out'),
+        ('db_pool_idle', 'idle', 'gauge', 'Connections waiting in the pool'),
+        ('db_pool_acquired_total', 'acquired', 'counter', 'Connections handed out'),
+        ('db_pool_created_total', 'created', 'counter', 'Connections opened'),
+        ('db_pool_timeouts_total', 'timeouts', 'counter', 'Acquires that gave up waiting'),
+        ('db_pool_wait_seconds_total', 'wait_time_total', 'counter', 'Time spent acquiring connections'),
+    ):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {stats[key]}']
+    return lines
+
+
+metrics.add_collector(_pool_metrics)
+
+
+def set_request_limits(statement_timeout=None, connect_timeout=None):
+    """Bound the statements (ms) and connection waits (s) of the current
+    request; returns a token for reset_request_limits"""
+    return _request_limits.set((statement_timeout, connect_timeout))
+
+
+def reset_request_limits(token):
+    _request_limits.reset(token)
+
+
+def on_unavailable(hook):
+    """Call ``hook(exception)`` whenever a connection cannot be had or is
+    lost, or a statement runs into its timeout"""
+    _unavailable_hooks.append(hook)
+
+
+def _apply_statement_timeout(conn, milliseconds):
+    """Give the session the wanted statement_timeout (None: server default),
+    skipping the round trip when it already has it"""
+    if conn.statement_timeout == milliseconds:
+        return
+    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if milliseconds is None:
+                cur.execute('SET statement_timeout = DEFAULT')
+            else:
+                cur.execute('SET statement_timeout = %s', (int(milliseconds),))
+    finally:
+        conn.autocommit = False
+    conn.statement_timeout = milliseconds
+
+
+def acquire(source=None, report_unavailable=True):
+    """Take a connection from ``source`` (default: the primary pool), timed as 'acquire'.
+
+    Inside a request the connection wait and the session statement_timeout
+    follow the limits set with set_request_limits.  A caller that has a
+    fallback for a failure passes ``report_unavailable=False`` so the
+    on_unavailable hooks are not told about it.
+    """
+    source = source or pool
+    statement_timeout, connect_timeout = _request_limits.get() or (None, None)
+    start = time.perf_counter()
+    try:
+        conn = source.getconn(connect_timeout)
+    except (PoolTimeout, psycopg2.OperationalError) as e:
+        if report_unavailable:
+            for hook in _unavailable_hooks:
+                hook(e)
+        raise
+    try:
+        if hasattr(conn, 'statement_timeout'):
+            _apply_statement_timeout(conn, statement_timeout)
+    except psycopg2.Error:
+        source.putconn(conn, broken=True)
+        raise
+    metrics.add_time('acquire', time.perf_counter() - start)
+    return conn
+
+
+@contextmanager
+def borrowed(conn, source=None):
+    """Return ``conn`` to ``source`` when the ``with`` block exits.
+
+    Connection errors and statement timeouts count against the pool's
+    circuit breaker; getting through the block cleanly resets it.
+    """
+    source = source or pool
+    broken = False
+    try:
+        yield conn
+    except psycopg2.errors.QueryCanceled as e:
+        # The session is fine, only the statement was cancelled
+        source.breaker.failure()
+        for hook in _unavailable_hooks:
+            hook(e)
+        raise
+    except psycopg2.OperationalError as e:
+        broken = True
+        source.breaker.failure()
+        for hook in _unavailable_hooks:
+            hook(e)
+        raise
+    else:
+        source.breaker.success()
+    finally:
+        source.putconn(conn, broken=broken)
+
+
+@contextmanager
+def get_connection():
+    """Borrow a pooled connection for the duration of a ``with`` block.
+
+    Uncommitted work is rolled back when the block exits, so callers must
+    ``conn.commit()`` their writes explicitly, exactly as with a fresh
+    ``psycopg2.connect()``.
+    """
+    with borrowed(acquire()) as conn:
+        yield conn
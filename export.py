@@ -0,0 +1,99 @@
+import csv
+import io
+import json
+import os
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from db import get_connection
+
+# Rows fetched per round trip from the server-side cursor
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))
+EXPORT_MAX_FETCH_SIZE = int(os.environ.get('EXPORT_MAX_FETCH_SIZE', 50000))
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def parse_export_args(args):
+    """Read ``format`` and ``fetch_size`` from the query string"""
+    fmt = args.get('format', 'ndjson').lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Invalid format: {fmt} (expected one of {', '.join(EXPORT_FORMATS)})")
+    fetch_size = args.get('fetch_size', EXPORT_FETCH_SIZE)
+    try:
+        fetch_size = int(fetch_size)
+    except ValueError:
+        raise ValueError(f'Invalid value for fetch_size: {fetch_size}')
+    if fetch_size < 1:
+        raise ValueError('fetch_size must be at least 1')
+    return fmt, min(fetch_size, EXPORT_MAX_FETCH_SIZE)
+
+
+def _encode_ndjson(columns, rows):
+    return ''.join(
+        json.dumps(dict(zip(columns, row)), default=_json_default, separators=(',', ':')) + '\n'
+        for row in rows
+    )
+
+
+def _encode_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def stream_export(sql, params, fmt, fetch_size):
+    """Yield the result of ``sql`` encoded as NDJSON or CSV, one batch at a time.
+
+    The query runs through a named (server-side) cursor, so only
+    ``fetch_size`` rows are held in memory at once.  The pooled connection is
+    kept for the lifetime of the generator and returned when it is exhausted
+    or closed by the server after a client disconnect.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+        cur.itersize = fetch_size
+        try:
+            cur.execute(sql, params)
+            rows = cur.fetchmany(fetch_size)
+            columns = [desc[0] for desc in cur.description]
+            if fmt == 'csv':
+                yield _encode_csv([columns])
+            while rows:
+                if fmt == 'csv':
+                    yield _encode_csv(rows)
+                else:
+                    yield _encode_ndjson(columns, rows)
+                rows = cur.fetchmany(fetch_size)
+        finally:
+            cur.close()
+
+
+def primed(chunks):
+    """Run a generator up to its first chunk before the response starts.
+
+    Errors raised while opening the cursor then surface while the view can
+    still return a 500, instead of as a truncated 200 stream.
+    """
+    first = next(chunks, '')
+
+    def generate():
+        try:
+            yield first
+            yield from chunks
+        finally:
+            chunks.close()
+
+    return generate()
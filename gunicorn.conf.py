@@ -0,0 +1,37 @@
+"""Gunicorn settings, picked up automatically from the working directory.
+
+    WEB_CONCURRENCY         worker processes (default 2)
+    GUNICORN_WORKER_CLASS   sync (default) or gthread
+    GUNICORN_THREADS        threads per gthread worker (default 1)
+    GUNICORN_PRELOAD        import the app once in the master (default 1)
+    GUNICORN_TIMEOUT        seconds before a silent worker is restarted
+
+With preload the app is imported before forking, so workers start from a
+shared, already-imported copy; pools, caches and background threads are
+per process and are set up again in post_fork.
+
+Every worker opens its own pools in post_fork, so the worker count is kept
+low by default: WEB_CONCURRENCY x (DB_POOL_MAX + one listener connection,
+plus the replicas' pools) must stay under the server's max_connections.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') not in ('0', 'false', 'False', '')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+
+def post_fork(server, worker):
+    # Connect, fill the caches and replay orphaned write-behind segments
+    # before the worker takes its first request
+    import health
+    health.warm_up()
+
+
+def worker_exit(server, worker):
+    # Write queued activity toggles before the worker goes away
+    import writebehind
+    writebehind.queue.shutdown()
@@ -0,0 +1,137 @@
+"""Liveness and readiness probes, and worker warm-up.
+
+GET /healthz only says the process is serving requests.  GET /readyz
+reports the database health seen by a background checker that runs at most
+every HEALTH_CHECK_INTERVAL seconds per worker, however often it is probed,
+with a pooled connection rather than a new one.  The worker is ready while
+the last check succeeded less than HEALTH_MAX_AGE seconds ago and the
+pool's circuit breaker is not open.
+
+warm_up() is called from gunicorn's post_fork hook (see gunicorn.conf.py)
+so a new worker opens its pools, loads its caches and recovers orphaned
+write-behind segments before its first request.
+"""
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+
+import writebehind
+from changes import pruner
+from db import DB_CONNECT_TIMEOUT, PoolTimeout, get_connection, pool
+from listener import LISTEN_ENABLED, ensure_listener, listening
+from refdata import classes, genders
+from replicas import replicas
+from response_cache import version_folder
+from stats import folder
+
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 5))
+# A checker stuck on a hung connection stops refreshing, so old results expire
+HEALTH_MAX_AGE = float(os.environ.get('HEALTH_MAX_AGE', 3 * HEALTH_CHECK_INTERVAL))
+
+
+class HealthChecker:
+    """The outcome of the latest ``SELECT 1``, refreshed by a background thread"""
+
+    def __init__(self, interval=HEALTH_CHECK_INTERVAL, max_age=HEALTH_MAX_AGE):
+        self.interval = interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._pid = None
+        self._ok_at = None
+        self._checked_at = None
+        self._latency = None
+        self._error = None
+        self.stats = {'checks': 0, 'failures': 0}
+
+    def check(self):
+        started = time.monotonic()
+        try:
+            with get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                    cur.fetchone()
+                conn.rollback()
+        except (psycopg2.Error, PoolTimeout) as e:
+            with self._lock:
+                self._checked_at = time.monotonic()
+                self._error = str(e).strip()
+                self.stats['checks'] += 1
+                self.stats['failures'] += 1
+            return False
+        with self._lock:
+            self._checked_at = self._ok_at = time.monotonic()
+            self._latency = self._checked_at - started
+            self._error = None
+            self.stats['checks'] += 1
+        return True
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def ensure_running(self):
+        """Start this process's checker if it is not running yet"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Results inherited across fork() are the parent's
+            self._ok_at = self._checked_at = self._latency = self._error = None
+            threading.Thread(target=self._run, name='health-checker', daemon=True).start()
+            self._pid = os.getpid()
+
+    def status(self):
+        """(ready, details) without touching the database"""
+        self.ensure_running()
+        now = time.monotonic()
+        breaker = pool.breaker.state()
+        with self._lock:
+            fresh = self._ok_at is not None and now - self._ok_at < self.max_age
+            details = {
+                'database': 'ok' if fresh and self._error is None else 'unavailable',
+                'checked_seconds_ago': round(now - self._checked_at, 3) if self._checked_at is not None else None,
+                'latency_ms': round(self._latency * 1000, 2) if self._latency is not None else None,
+                'error': self._error,
+                'breaker': breaker,
+                **self.stats,
+            }
+        ready = details['database'] == 'ok' and breaker['state'] != 'open'
+        return ready, details
+
+
+checker = HealthChecker()
+
+
+def warm_up():
+    """Open the pools' idle connections, start the background threads and
+    load the reference-data caches; a database that is down only delays them
+    until the first request"""
+    checker.ensure_running()
+    if writebehind.WRITE_BEHIND_ENABLED:
+        # Replays the segments of dead workers without waiting for a toggle
+        try:
+            writebehind.queue.start()
+        except OSError as e:
+            print(f'write-behind start failed: {e}', file=sys.stderr)
+    try:
+        pool.prefill()
+        for replica in replicas.replicas:
+            replica.pool.prefill()
+        ensure_listener()
+        replicas.ensure_checker()
+        pruner.ensure_running()
+        folder.ensure_running()
+        version_folder.ensure_running()
+        # The listener drops the caches when it connects, so load them after
+        deadline = time.monotonic() + DB_CONNECT_TIMEOUT
+        while LISTEN_ENABLED and not listening() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        genders.rows()
+        classes.rows()
+    except (psycopg2.Error, PoolTimeout) as e:
+        print(f'worker warm-up failed: {e}', file=sys.stderr)
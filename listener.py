@@ -0,0 +1,103 @@
+import os
+import select
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from db import connect
+
+LISTEN_ENABLED = os.environ.get('DB_LISTEN', os.environ.get('REFDATA_LISTEN', '1')) not in ('0', 'false', 'False', '')
+
+# channel -> list of callbacks taking the notification payload
+_handlers = {}
+# callbacks run whenever notifications may have been missed
+_reset_hooks = []
+
+
+def subscribe(channel, on_notify, on_reset=None):
+    """Call ``on_notify(payload)`` for every NOTIFY on ``channel``.
+
+    ``on_reset()`` runs after the listener (re)connects and after it loses
+    its connection, i.e. whenever notifications may have been missed.
+    Subscriptions must be made at import time, before the listener starts.
+    """
+    _handlers.setdefault(channel, []).append(on_notify)
+    if on_reset is not None:
+        _reset_hooks.append(on_reset)
+
+
+def _reset_all():
+    for hook in _reset_hooks:
+        hook()
+
+
+class ChangeListener(threading.Thread):
+    """Background thread that LISTENs on every subscribed channel.
+
+    Each worker process runs one listener on a dedicated connection (not one
+    from the pool) and dispatches notifications to the subscribers.
+    """
+
+    def __init__(self, poll_interval=1.0, retry_interval=5.0):
+        super().__init__(name='db-listener', daemon=True)
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.connected = False
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except (psycopg2.Error, OSError) as e:
+                print(f'database listener disconnected: {e}', file=sys.stderr)
+            self.connected = False
+            _reset_all()
+            time.sleep(self.retry_interval)
+
+    def _listen(self):
+        conn = connect()
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                for channel in _handlers:
+                    cur.execute(f'LISTEN {channel}')
+            # Anything cached before LISTEN took effect may already be stale
+            _reset_all()
+            self.connected = True
+            while True:
+                if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    for handler in _handlers.get(notify.channel, ()):
+                        handler(notify.payload)
+        finally:
+            conn.close()
+
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def ensure_listener():
+    """Start this process's listener if it is not running yet"""
+    global _listener, _listener_pid
+    if not LISTEN_ENABLED or _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        # A listener inherited across fork() is not running in this process
+        _listener = ChangeListener()
+        _listener.start()
+        _listener_pid = os.getpid()
+
+
+def listening():
+    """Whether this process is currently receiving notifications"""
+    return _listener is not None and _listener_pid == os.getpid() and _listener.connected
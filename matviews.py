@@ -0,0 +1,275 @@
+import os
+import sys
+import threading
+import time
+
+from db import get_connection
+from listener import ensure_listener, listening, subscribe
+from queries import FLAG_VIEW_SELECT
+from response_cache import DATA_CHANNEL, skip_cache, versions
+
+MATVIEWS_ENABLED = os.environ.get('MATVIEWS_ENABLED', '1') not in ('0', 'false', 'False', '')
+# Seconds a materialized view may lag behind the tables it is built from
+# before reads fall back to the plain view; MATVIEW_MAX_STALENESS_<VIEW>
+# overrides it per endpoint
+MATVIEW_MAX_STALENESS = float(os.environ.get('MATVIEW_MAX_STALENESS', 5))
+# Writes within this many seconds of each other are folded into one refresh
+MATVIEW_DEBOUNCE = float(os.environ.get('MATVIEW_DEBOUNCE', 1))
+# Also refresh stale views every this many seconds (0 disables the schedule)
+MATVIEW_REFRESH_INTERVAL = float(os.environ.get('MATVIEW_REFRESH_INTERVAL', 0))
+MATVIEW_CHANNEL = 'matview_refreshed'
+
+# Tables the flag views are built from, in the order their versions are stored
+DEPENDENCIES = ('people', 'activities', 'gender')
+
+
+class MaterializedView:
+    """A materialized copy of one of the activity flag views (see migration 5).
+
+    Freshness is tracked with the table versions from response_cache: each
+    refresh records the versions it was built from in ``matview_refreshes``
+    and announces them on MATVIEW_CHANNEL.  Reads use the materialized view
+    while it is current or has been stale for at most ``max_staleness``
+    seconds, and the plain view otherwise.
+    """
+
+    def __init__(self, name, max_staleness=None):
+        self.name = name
+        self.table = f'{name}_mat'
+        if max_staleness is None:
+            max_staleness = float(os.environ.get(f'MATVIEW_MAX_STALENESS_{name.upper()}',
+                                                 MATVIEW_MAX_STALENESS))
+        self.max_staleness = max_staleness
+        self.live_select = FLAG_VIEW_SELECT.format(view=name)
+        self.mat_select = FLAG_VIEW_SELECT.format(view=self.table)
+        self._lock = threading.Lock()
+        self._refreshed = None
+        self._synced = False
+        self._dirty_since = None
+        self._last_refresh = None
+        self._stats = {'fresh': 0, 'stale': 0, 'live': 0, 'refreshes': 0, 'skipped': 0}
+
+    def _read_refreshed(self):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT versions FROM matview_refreshes WHERE view_name = %s', (self.name,))
+                row = cur.fetchone()
+        return tuple(row[0]) if row is not None else None
+
+    def refreshed_versions(self):
+        """Table versions the materialized view was last built from"""
+        with self._lock:
+            if self._synced and listening():
+                return self._refreshed
+        try:
+            refreshed = self._read_refreshed()
+        except Exception:
+            # Not installed or no database: use the plain view
+            return None
+        with self._lock:
+            if refreshed is not None and (self._refreshed is None or refreshed > self._refreshed):
+                self._refreshed = refreshed
+            self._synced = listening()
+            return self._refreshed
+
+    def select(self):
+        """SELECT to read the flag view with, given the staleness bound"""
+        if not MATVIEWS_ENABLED:
+            return self.live_select
+        ensure_listener()
+        ensure_refresher()
+        current = versions.get(DEPENDENCIES)
+        refreshed = self.refreshed_versions()
+        if current is None or refreshed is None:
+            if current is not None:
+                # Created but never refreshed through this module
+                request_refresh()
+            self._count('live')
+            return self.live_select
+        now = time.monotonic()
+        with self._lock:
+            if all(r >= c for r, c in zip(refreshed, current)):
+                self._dirty_since = None
+                self._stats['fresh'] += 1
+                return self.mat_select
+            if self._dirty_since is None:
+                self._dirty_since = now
+            stale_for = now - self._dirty_since
+        request_refresh()
+        if stale_for <= self.max_staleness:
+            self._count('stale')
+            # Stale rows must not be cached under the tables' current versions
+            skip_cache()
+            return self.mat_select
+        self._count('live')
+        return self.live_select
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def mark_dirty(self):
+        with self._lock:
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+
+    def on_refreshed(self, refreshed):
+        with self._lock:
+            if self._refreshed is None or refreshed > self._refreshed:
+                self._refreshed = refreshed
+        current = versions.get(DEPENDENCIES)
+        with self._lock:
+            if current is not None and all(r >= c for r, c in zip(self._refreshed, current)):
+                self._dirty_since = None
+
+    def reset(self):
+        with self._lock:
+            self._synced = False
+
+    def refresh(self, force=False):
+        """Rebuild the materialized view concurrently if it is behind.
+
+        Only one process refreshes a view at a time; others skip unless
+        ``force`` is set, in which case they wait and refresh regardless.
+        """
+        start = time.perf_counter()
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                if force:
+                    cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (self.table,))
+                    locked = True
+                else:
+                    cur.execute('SELECT pg_try_advisory_xact_lock(hashtext(%s))', (self.table,))
+                    locked = cur.fetchone()[0]
+                if not locked:
+                    conn.rollback()
+                    self._count('skipped')
+                    return {'view': self.name, 'refreshed': False, 'reason': 'refresh in progress'}
+                cur.execute('SELECT table_name, version FROM table_versions WHERE table_name = ANY(%s)',
+                            (list(DEPENDENCIES),))
+                found = dict(cur.fetchall())
+                current = tuple(found[table] for table in DEPENDENCIES)
+                cur.execute('SELECT versions FROM matview_refreshes WHERE view_name = %s', (self.name,))
+                row = cur.fetchone()
+                if not force and row is not None and all(r >= c for r, c in zip(row[0], current)):
+                    conn.rollback()
+                    return {'view': self.name, 'refreshed': False, 'reason': 'up to date'}
+                # The refresh's snapshot is taken after the versions were read,
+                # so the view holds at least every write they count
+                cur.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {self.table}')
+                duration_ms = (time.perf_counter() - start) * 1000
+                cur.execute('''
+                    INSERT INTO matview_refreshes (view_name, versions, refreshed_at, duration_ms)
+                    VALUES (%s, %s, now(), %s)
+                    ON CONFLICT (view_name) DO UPDATE
+                    SET versions = EXCLUDED.versions, refreshed_at = EXCLUDED.refreshed_at,
+                        duration_ms = EXCLUDED.duration_ms
+                ''', (self.name, list(current), duration_ms))
+                cur.execute('SELECT pg_notify(%s, %s)',
+                            (MATVIEW_CHANNEL, f"{self.name}:{','.join(map(str, current))}"))
+            conn.commit()
+        self.on_refreshed(current)
+        with self._lock:
+            self._stats['refreshes'] += 1
+            self._last_refresh = {'duration_ms': round(duration_ms, 3), 'at': time.time(),
+                                  'versions': list(current)}
+        return {'view': self.name, 'refreshed': True, 'duration_ms': round(duration_ms, 3)}
+
+    def status(self):
+        with self._lock:
+            stale_for = time.monotonic() - self._dirty_since if self._dirty_since is not None else 0.0
+            return dict(self._stats, max_staleness=self.max_staleness, stale_for=round(stale_for, 3),
+                        last_refresh=self._last_refresh)
+
+
+VIEWS = {name: MaterializedView(name) for name in ('activity1', 'transport')}
+
+def refresh_all(force=False):
+    results = []
+    for view in VIEWS.values():
+        try:
+            results.append(view.refresh(force))
+        except Exception as e:
+            results.append({'view': view.name, 'refreshed': False, 'error': str(e)})
+    return results
+
+
+def status():
+    return {name: view.status() for name, view in VIEWS.items()}
+
+
+class Refresher(threading.Thread):
+    """Background thread that refreshes stale views after a debounce delay"""
+
+    def __init__(self, debounce=MATVIEW_DEBOUNCE, interval=MATVIEW_REFRESH_INTERVAL):
+        super().__init__(name='matview-refresher', daemon=True)
+        self.debounce = debounce
+        self.interval = interval or None
+        self.wake = threading.Event()
+
+    def run(self):
+        while True:
+            if self.wake.wait(self.interval):
+                # Let a burst of writes settle into a single refresh
+                time.sleep(self.debounce)
+            self.wake.clear()
+            for result in refresh_all():
+                if 'error' in result:
+                    print(f"materialized view refresh failed: {result['view']}: {result['error']}",
+                          file=sys.stderr)
+
+
+_refresher = None
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+
+def ensure_refresher():
+    """Start this process's refresher if it is not running yet"""
+    global _refresher, _refresher_pid
+    if _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher = Refresher()
+        _refresher.start()
+        _refresher_pid = os.getpid()
+
+
+def request_refresh():
+    if _refresher is not None and _refresher_pid == os.getpid():
+        _refresher.wake.set()
+
+
+def _on_data_changed(payload):
+    table = payload.rpartition(':')[0]
+    if table in DEPENDENCIES:
+        for view in VIEWS.values():
+            view.mark_dirty()
+        request_refresh()
+
+
+def _on_refreshed(payload):
+    name, _, refreshed = payload.partition(':')
+    view = VIEWS.get(name)
+    if view is not None:
+        view.on_refreshed(tuple(int(version) for version in refreshed.split(',')))
+
+
+def _reset_all():
+    for view in VIEWS.values():
+        view.reset()
+
+
+subscribe(DATA_CHANNEL, _on_data_changed)
+subscribe(MATVIEW_CHANNEL, _on_refreshed, on_reset=_reset_all)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['refresh']:
+        for result in refresh_all(force=True):
+            print(result)
+    else:
+        print('usage: python matviews.py refresh')
+        sys.exit(2)
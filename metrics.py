@@ -0,0 +1,183 @@
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') not in ('0', 'false', 'False', '')
+# Statements slower than this are logged with their route and SQL
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 500))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('acquire', 'execute', 'fetch', 'serialize')
+
+slow_query_log = logging.getLogger('app.slow_query')
+
+# Timings of the request being handled on this thread
+_current = ContextVar('request_metrics', default=None)
+
+
+class Histogram:
+    """Cumulative Prometheus histogram with labels"""
+
+    def __init__(self, name, help_text, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, [list(s[0]), s[1], s[2]]) for labels, s in self._series.items())
+        for labels, (counts, total, count) in items:
+            base = _labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le=bound)} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{base} {total}')
+            lines.append(f'{self.name}_count{base} {count}')
+        return lines
+
+
+class Counter:
+    """Monotonic Prometheus counter with labels"""
+
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(f'{self.name}{_labels(self.labelnames, labels)} {value}' for labels, value in items)
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, le=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+request_duration = register(Histogram(
+    'http_request_duration_seconds', 'Total time to handle a request', ('route', 'method', 'status')))
+request_phase = register(Histogram(
+    'http_request_phase_seconds', 'Time per request spent in each phase', ('route', 'phase')))
+query_duration = register(Histogram(
+    'db_query_duration_seconds', 'Execution time of each SQL statement', ('route',)))
+slow_queries = register(Counter(
+    'db_slow_queries_total', 'Statements slower than SLOW_QUERY_MS', ('route',)))
+
+# Extra exporters (e.g. pool gauges) registered by other modules
+_collectors = []
+
+
+def add_collector(collect):
+    """Register ``collect()`` returning extra exposition lines for /metrics"""
+    _collectors.append(collect)
+
+
+def start_request(route):
+    """Begin collecting timings for the request handled on this thread"""
+    if not METRICS_ENABLED:
+        return None
+    return _current.set({'route': route, 'start': time.perf_counter(),
+                         'acquire': 0.0, 'execute': 0.0, 'fetch': 0.0, 'serialize': 0.0})
+
+
+def finish_request(token, method, status):
+    """Record the timings of the current request and stop collecting"""
+    timings = _current.get()
+    if timings is None:
+        return
+    _current.reset(token)
+    route = timings['route']
+    request_duration.observe(time.perf_counter() - timings['start'], route, method, status)
+    for phase in PHASES:
+        request_phase.observe(timings[phase], route, phase)
+
+
+def current_route():
+    timings = _current.get()
+    return timings['route'] if timings is not None else None
+
+
+def add_time(phase, seconds):
+    """Add ``seconds`` to ``phase`` of the current request, if there is one"""
+    timings = _current.get()
+    if timings is not None:
+        timings[phase] += seconds
+
+
+def observe_query(sql, seconds):
+    route = current_route() or 'none'
+    add_time('execute', seconds)
+    query_duration.observe(seconds, route)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc(route)
+        slow_query_log.warning('slow query on %s: %.1f ms: %s', route, seconds * 1000,
+                               ' '.join(str(sql).split())[:500])
+
+
+def time_json_responses(provider):
+    """Count time spent in ``provider.response`` (jsonify) as the serialize phase"""
+    respond = provider.response
+
+    def response(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return respond(*args, **kwargs)
+        finally:
+            add_time('serialize', time.perf_counter() - start)
+
+    provider.response = response
+    return provider
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        lines.extend(collect())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,895 @@
+"""Versioned schema migrations and query-plan checks.
+
+    python migrations.py migrate            apply pending migrations
+    python migrations.py status             list applied and pending versions
+    python migrations.py check [--rows N]   EXPLAIN every route statement and
+                                            fail on sequential scans of tables
+                                            with more than N rows
+
+Each migration runs in its own transaction and is recorded in
+``schema_migrations``; an advisory lock keeps concurrent deploys from
+applying the same version twice.  The schema statements are idempotent so
+the first migration adopts databases created before this module existed.
+"""
+import argparse
+import json
+import sys
+
+from changes import CHANGES_POSITION, Position, since_query
+from db import get_connection
+from matviews import VIEWS
+from pagination import paginated_query, parse_filters
+from queries import (
+    ACTIVITIES_BY_PEOPLE, ACTIVITIES_BY_PERSON, ACTIVITIES_GENDER_JOIN, ACTIVITIES_SELECT, ACTIVITY_FLAG_FILTERS,
+    CLASS_ID_BY_NAME, CLASS_STUDENTS, DELETE_PERSON, GENDERS, INSERT_DEFAULT_ACTIVITIES, INSERT_PERSON,
+    PEOPLE_BY_IDS, PEOPLE_FLAG_FILTERS, PEOPLE_LIST_SELECT, PERSON_BY_ID, PERSON_EXISTS, VIEW_FLAG_FILTERS,
+    WITH_ACTIVITIES,
+)
+from search import search_sql
+from stats import STATS_QUERY
+
+# Sequential scans of relations estimated above this many rows fail the check
+PLAN_CHECK_MAX_SEQ_ROWS = 10000
+# Summary tables that are meant to be read whole
+PLAN_CHECK_FULL_SCAN_TABLES = ('stats_rollup', 'stats_deltas')
+
+# Relations with no row estimate: reltuples is -1 until the first ANALYZE
+# (0 before PostgreSQL 14, even with rows in the table)
+UNANALYZED_SQL = '''
+    SELECT oid::regclass::text FROM pg_class
+    WHERE relkind IN ('r', 'm') AND pg_table_is_visible(oid) AND relnamespace <> 'pg_catalog'::regnamespace
+      AND (reltuples < 0 OR (reltuples = 0 AND pg_relation_size(oid) > 0))'''
+
+SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS gender (
+    gender_id SERIAL PRIMARY KEY,
+    gender_name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS classes (
+    class_id SERIAL PRIMARY KEY,
+    class_name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS people (
+    id SERIAL PRIMARY KEY,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    gender_id INT REFERENCES gender (gender_id),
+    contact TEXT,
+    mother_name TEXT,
+    class_id INT REFERENCES classes (class_id),
+    created_at TIMESTAMP DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS activities (
+    activity_id SERIAL PRIMARY KEY,
+    person_id INT REFERENCES people (id) ON DELETE CASCADE,
+    activity1 BOOLEAN DEFAULT FALSE,
+    activity2 BOOLEAN DEFAULT FALSE,
+    transport BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT now()
+);
+''' + ''.join(f'''
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('{flag}') AND relkind <> 'v') THEN
+        RAISE EXCEPTION '{flag} already exists and is not a view; rename or drop it, then migrate again';
+    END IF;
+END
+$$;
+-- An existing view may have other columns, which CREATE OR REPLACE cannot
+-- change; it holds no data, so it is dropped and recreated
+DROP VIEW IF EXISTS {flag};
+CREATE VIEW {flag} AS
+    SELECT p.id, p.first_name, p.last_name, p.email, g.gender_name AS gender,
+           p.contact, p.mother_name, a.activity1, a.activity2, a.transport, p.created_at
+    FROM people p
+    JOIN activities a ON a.person_id = p.id
+    LEFT JOIN gender g ON g.gender_id = p.gender_id
+    WHERE a.{flag};
+''' for flag in ('activity1', 'transport'))
+
+# Columns every hot query filters or joins on
+INDEXED_COLUMNS = (
+    ('people', 'gender_id'),
+    ('people', 'class_id'),
+    ('activities', 'person_id'),
+    ('classes', 'class_name'),
+    ('gender', 'gender_name'),
+)
+
+
+def ensure_index_sql(table, column):
+    """Create an index on ``table.column`` unless one already leads with it"""
+    return f'''
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = '{table}'::regclass AND a.attname = '{column}'
+    ) THEN
+        CREATE INDEX {table}_{column}_idx ON {table} ({column});
+    END IF;
+END
+$$;
+'''
+
+
+# Everything a migration runs is frozen here as it was when the migration
+# was added, so later changes to the modules cannot alter what an applied
+# version did or what a fresh database gets.
+
+# Statement-level triggers that announce changes to the reference tables (refdata)
+NOTIFY_TRIGGERS_SQL = '''
+CREATE OR REPLACE FUNCTION notify_refdata_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('refdata_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS gender_refdata_changed ON gender;
+CREATE TRIGGER gender_refdata_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON gender
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_refdata_changed();
+
+DROP TRIGGER IF EXISTS classes_refdata_changed ON classes;
+CREATE TRIGGER classes_refdata_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON classes
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_refdata_changed();
+'''
+
+# Per-table write counters, bumped once per writing statement and announced
+# on data_changed as '<table>:<version>' when the transaction commits (response_cache)
+VERSION_TRIGGERS_SQL = '''
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO table_versions (table_name)
+VALUES ('people'), ('activities'), ('gender'), ('classes')
+ON CONFLICT (table_name) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    UPDATE table_versions SET version = version + 1
+    WHERE table_name = TG_TABLE_NAME
+    RETURNING version INTO new_version;
+    PERFORM pg_notify('data_changed', TG_TABLE_NAME || ':' || new_version);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS people_bump_version ON people;
+CREATE TRIGGER people_bump_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON people
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS activities_bump_version ON activities;
+CREATE TRIGGER activities_bump_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON activities
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS gender_bump_version ON gender;
+CREATE TRIGGER gender_bump_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON gender
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS classes_bump_version ON classes;
+CREATE TRIGGER classes_bump_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON classes
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+'''
+
+# The materialized activity flag views and their refresh log (matviews)
+MATVIEWS_SQL = '''
+CREATE TABLE IF NOT EXISTS matview_refreshes (
+    view_name TEXT PRIMARY KEY,
+    versions BIGINT[] NOT NULL,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    duration_ms DOUBLE PRECISION
+);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS activity1_mat AS
+    SELECT p.id, a.activity_id, p.first_name, p.last_name, p.email,
+           g.gender_name AS gender, p.contact, p.mother_name,
+           a.activity1, a.activity2, a.transport, p.created_at
+    FROM people p
+    JOIN activities a ON a.person_id = p.id
+    LEFT JOIN gender g ON g.gender_id = p.gender_id
+    WHERE a.activity1;
+CREATE UNIQUE INDEX IF NOT EXISTS activity1_mat_id ON activity1_mat (id, activity_id);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS transport_mat AS
+    SELECT p.id, a.activity_id, p.first_name, p.last_name, p.email,
+           g.gender_name AS gender, p.contact, p.mother_name,
+           a.activity1, a.activity2, a.transport, p.created_at
+    FROM people p
+    JOIN activities a ON a.person_id = p.id
+    LEFT JOIN gender g ON g.gender_id = p.gender_id
+    WHERE a.transport;
+CREATE UNIQUE INDEX IF NOT EXISTS transport_mat_id ON transport_mat (id, activity_id);
+'''
+
+# The grouped stats rollup and the triggers that keep it current (stats)
+STATS_SQL = '''
+CREATE TABLE IF NOT EXISTS stats_rollup (
+    class_id INT NOT NULL,
+    gender_id INT NOT NULL,
+    bucket DATE NOT NULL,
+    activity1 BOOLEAN NOT NULL,
+    activity2 BOOLEAN NOT NULL,
+    transport BOOLEAN NOT NULL,
+    people BIGINT NOT NULL,
+    PRIMARY KEY (class_id, gender_id, bucket, activity1, activity2, transport)
+);
+
+CREATE OR REPLACE FUNCTION stats_bucket(created_at TIMESTAMP) RETURNS DATE AS $$
+    SELECT coalesce(date_trunc('month', created_at), 'epoch')::date
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Add sign to the rollup for each of rows, with their current activity flags
+-- or, for new people, none: activities inserted by the same statement move
+-- them on from there in stats_reflag, whichever trigger fires first
+CREATE OR REPLACE FUNCTION stats_count_people(rows people[], sign INT, flagged BOOLEAN) RETURNS void AS $$
+    INSERT INTO stats_rollup AS r (class_id, gender_id, bucket, activity1, activity2, transport, people)
+    SELECT coalesce(p.class_id, 0), coalesce(p.gender_id, 0), stats_bucket(p.created_at),
+           coalesce(f.activity1, FALSE), coalesce(f.activity2, FALSE), coalesce(f.transport, FALSE),
+           sign * count(*)
+    FROM unnest(rows) p
+    LEFT JOIN (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM activities
+        WHERE person_id IN (SELECT id FROM unnest(rows))
+        GROUP BY person_id
+    ) f ON f.person_id = p.id AND flagged
+    GROUP BY 1, 2, 3, 4, 5, 6
+    ON CONFLICT (class_id, gender_id, bucket, activity1, activity2, transport)
+    DO UPDATE SET people = r.people + EXCLUDED.people
+$$ LANGUAGE sql;
+
+-- Move the people owning changed activities rows from the flags they had
+-- before the statement to the ones they have now.  The state before is the
+-- current rows minus the statement's new ones plus its old ones.
+CREATE OR REPLACE FUNCTION stats_reflag(person_ids INT[], new_ids INT[], old_rows activities[])
+RETURNS void AS $$
+    WITH ids AS (
+        SELECT DISTINCT unnest(person_ids) AS id
+    ), affected AS (
+        SELECT p.id, p.class_id, p.gender_id, p.created_at
+        FROM people p JOIN ids ON ids.id = p.id
+    ), current AS (
+        SELECT a.activity_id, a.person_id, a.activity1, a.activity2, a.transport
+        FROM activities a JOIN ids ON ids.id = a.person_id
+    ), before AS (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM (
+            SELECT person_id, activity1, activity2, transport FROM current c
+            WHERE NOT EXISTS (SELECT 1 FROM unnest(new_ids) AS n (id) WHERE n.id = c.activity_id)
+            UNION ALL
+            SELECT person_id, activity1, activity2, transport FROM unnest(old_rows)
+        ) s
+        GROUP BY person_id
+    ), after AS (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM current
+        GROUP BY person_id
+    ), deltas AS (
+        SELECT a.class_id, a.gender_id, a.created_at,
+               coalesce(b.activity1, FALSE) AS activity1, coalesce(b.activity2, FALSE) AS activity2,
+               coalesce(b.transport, FALSE) AS transport, -1 AS people
+        FROM affected a LEFT JOIN before b ON b.person_id = a.id
+        UNION ALL
+        SELECT a.class_id, a.gender_id, a.created_at,
+               coalesce(n.activity1, FALSE), coalesce(n.activity2, FALSE), coalesce(n.transport, FALSE), 1
+        FROM affected a LEFT JOIN after n ON n.person_id = a.id
+    )
+    INSERT INTO stats_rollup AS r (class_id, gender_id, bucket, activity1, activity2, transport, people)
+    SELECT coalesce(class_id, 0), coalesce(gender_id, 0), stats_bucket(created_at),
+           activity1, activity2, transport, sum(people)
+    FROM deltas
+    GROUP BY 1, 2, 3, 4, 5, 6
+    HAVING sum(people) <> 0
+    ON CONFLICT (class_id, gender_id, bucket, activity1, activity2, transport)
+    DO UPDATE SET people = r.people + EXCLUDED.people
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION stats_rebuild() RETURNS void AS $$
+    DELETE FROM stats_rollup;
+    INSERT INTO stats_rollup (class_id, gender_id, bucket, activity1, activity2, transport, people)
+    SELECT coalesce(p.class_id, 0), coalesce(p.gender_id, 0), stats_bucket(p.created_at),
+           coalesce(f.activity1, FALSE), coalesce(f.activity2, FALSE), coalesce(f.transport, FALSE),
+           count(*)
+    FROM people p
+    LEFT JOIN (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM activities
+        GROUP BY person_id
+    ) f ON f.person_id = p.id
+    GROUP BY 1, 2, 3, 4, 5, 6;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION stats_people_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stats_count_people(ARRAY(SELECT n::people FROM new_rows n), 1, FALSE);
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Only moves between rollup keys matter, not edits to names or contacts
+        PERFORM stats_count_people(ARRAY(
+            SELECT o::people FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE (o.class_id, o.gender_id, stats_bucket(o.created_at))
+                  IS DISTINCT FROM (n.class_id, n.gender_id, stats_bucket(n.created_at))), -1, TRUE);
+        PERFORM stats_count_people(ARRAY(
+            SELECT n::people FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE (o.class_id, o.gender_id, stats_bucket(o.created_at))
+                  IS DISTINCT FROM (n.class_id, n.gender_id, stats_bucket(n.created_at))), 1, TRUE);
+    ELSIF TG_OP = 'DELETE' THEN
+        -- Before the row goes, while its activities (removed by the cascade
+        -- afterwards) still tell which flags it was counted under
+        PERFORM stats_count_people(ARRAY[OLD], -1, TRUE);
+        RETURN OLD;
+    ELSE
+        PERFORM stats_rebuild();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_activities_changed() RETURNS trigger AS $$
+BEGIN
+    -- People already gone (a cascade from DELETE FROM people) are skipped
+    -- by stats_reflag: their delete trigger took them out of the rollup
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stats_reflag(ARRAY(SELECT person_id FROM new_rows),
+                             ARRAY(SELECT activity_id FROM new_rows), '{}');
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM stats_reflag(ARRAY(SELECT person_id FROM new_rows UNION SELECT person_id FROM old_rows),
+                             ARRAY(SELECT activity_id FROM new_rows), ARRAY(SELECT o::activities FROM old_rows o));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM stats_reflag(ARRAY(SELECT person_id FROM old_rows), '{}', ARRAY(SELECT o::activities FROM old_rows o));
+    ELSE
+        PERFORM stats_rebuild();
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS people_stats_insert ON people;
+CREATE TRIGGER people_stats_insert AFTER INSERT ON people
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_people_changed();
+DROP TRIGGER IF EXISTS people_stats_update ON people;
+CREATE TRIGGER people_stats_update AFTER UPDATE ON people
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_people_changed();
+DROP TRIGGER IF EXISTS people_stats_delete ON people;
+CREATE TRIGGER people_stats_delete BEFORE DELETE ON people
+    FOR EACH ROW EXECUTE FUNCTION stats_people_changed();
+DROP TRIGGER IF EXISTS people_stats_truncate ON people;
+CREATE TRIGGER people_stats_truncate AFTER TRUNCATE ON people
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_people_changed();
+
+DROP TRIGGER IF EXISTS activities_stats_insert ON activities;
+CREATE TRIGGER activities_stats_insert AFTER INSERT ON activities
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_activities_changed();
+DROP TRIGGER IF EXISTS activities_stats_update ON activities;
+CREATE TRIGGER activities_stats_update AFTER UPDATE ON activities
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_activities_changed();
+DROP TRIGGER IF EXISTS activities_stats_delete ON activities;
+CREATE TRIGGER activities_stats_delete AFTER DELETE ON activities
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_activities_changed();
+DROP TRIGGER IF EXISTS activities_stats_truncate ON activities;
+CREATE TRIGGER activities_stats_truncate AFTER TRUNCATE ON activities
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_activities_changed();
+SELECT stats_rebuild();
+'''
+
+# People search indexes; the trigram one only where pg_trgm can be installed (search)
+SEARCH_SQL = '''
+CREATE INDEX IF NOT EXISTS people_search_vector ON people USING GIN ((
+    setweight(to_tsvector('simple', coalesce(first_name, '') || ' ' || coalesce(last_name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(email, '') || ' ' || coalesce(contact, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(mother_name, '')), 'C')));
+DO $$
+BEGIN
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN OTHERS THEN
+        RAISE NOTICE 'pg_trgm is not available (%), people search will not match typos', SQLERRM;
+        RETURN;
+    END;
+    EXECUTE $sql$CREATE INDEX IF NOT EXISTS people_search_trigram ON people
+                 USING GIN (lower(
+    coalesce(first_name, '') || ' ' || coalesce(last_name, '') || ' ' || coalesce(email, '') || ' ' ||
+    coalesce(contact, '') || ' ' || coalesce(mother_name, '')) gin_trgm_ops)$sql$;
+END
+$$;
+'''
+
+# The change feed log and its statement-level triggers (changes)
+CHANGES_SQL = '''
+CREATE TABLE IF NOT EXISTS change_log (
+    seq BIGSERIAL PRIMARY KEY,
+    txid BIGINT NOT NULL DEFAULT txid_current(),
+    table_name TEXT NOT NULL,
+    op TEXT NOT NULL,
+    row_id INT,
+    person_id INT,
+    class_id INT,
+    row_count INT NOT NULL DEFAULT 1,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS change_log_changed_at ON change_log (changed_at);
+
+CREATE OR REPLACE FUNCTION log_changes(tbl TEXT, op TEXT, ids INT[], person_ids INT[], class_ids INT[])
+RETURNS void AS $$
+DECLARE
+    first_seq BIGINT;
+    last_seq BIGINT;
+BEGIN
+    -- Statements that changed nothing still fire statement triggers
+    IF coalesce(cardinality(ids), 0) = 0 THEN
+        RETURN;
+    END IF;
+    IF cardinality(ids) > 1000 THEN
+        INSERT INTO change_log (table_name, op, row_count)
+        VALUES (tbl, op, cardinality(ids))
+        RETURNING seq INTO first_seq;
+        last_seq := first_seq;
+    ELSE
+        WITH logged AS (
+            INSERT INTO change_log (table_name, op, row_id, person_id, class_id)
+            SELECT tbl, op, u.row_id, u.person_id, u.class_id
+            FROM unnest(ids, person_ids, class_ids) AS u (row_id, person_id, class_id)
+            RETURNING seq
+        )
+        SELECT min(seq), max(seq) INTO first_seq, last_seq FROM logged;
+    END IF;
+    PERFORM pg_notify('row_changed', txid_current() || ':' || first_seq || ':' || last_seq);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION people_log_changes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO change_log (table_name, op, row_count) VALUES ('people', 'truncate', 0);
+        PERFORM pg_notify('row_changed', txid_current() || ':' || currval('change_log_seq_seq') || ':' ||
+                          currval('change_log_seq_seq'));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM log_changes('people', 'delete', ARRAY(SELECT id FROM old_rows ORDER BY id),
+                            ARRAY(SELECT id FROM old_rows ORDER BY id),
+                            ARRAY(SELECT class_id FROM old_rows ORDER BY id));
+    ELSE
+        PERFORM log_changes('people', lower(TG_OP), ARRAY(SELECT id FROM new_rows ORDER BY id),
+                            ARRAY(SELECT id FROM new_rows ORDER BY id),
+                            ARRAY(SELECT class_id FROM new_rows ORDER BY id));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION activities_log_changes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO change_log (table_name, op, row_count) VALUES ('activities', 'truncate', 0);
+        PERFORM pg_notify('row_changed', txid_current() || ':' || currval('change_log_seq_seq') || ':' ||
+                          currval('change_log_seq_seq'));
+    ELSIF TG_OP = 'DELETE' THEN
+        -- The owner's class, unless the owner is being deleted as well
+        PERFORM log_changes('activities', 'delete', array_agg(o.activity_id ORDER BY o.activity_id),
+                            array_agg(o.person_id ORDER BY o.activity_id),
+                            array_agg(p.class_id ORDER BY o.activity_id))
+        FROM old_rows o LEFT JOIN people p ON p.id = o.person_id;
+    ELSE
+        PERFORM log_changes('activities', lower(TG_OP), array_agg(n.activity_id ORDER BY n.activity_id),
+                            array_agg(n.person_id ORDER BY n.activity_id),
+                            array_agg(p.class_id ORDER BY n.activity_id))
+        FROM new_rows n LEFT JOIN people p ON p.id = n.person_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS people_log_insert ON people;
+CREATE TRIGGER people_log_insert AFTER INSERT ON people
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION people_log_changes();
+DROP TRIGGER IF EXISTS people_log_update ON people;
+CREATE TRIGGER people_log_update AFTER UPDATE ON people
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION people_log_changes();
+DROP TRIGGER IF EXISTS people_log_delete ON people;
+CREATE TRIGGER people_log_delete AFTER DELETE ON people
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION people_log_changes();
+DROP TRIGGER IF EXISTS people_log_truncate ON people;
+CREATE TRIGGER people_log_truncate AFTER TRUNCATE ON people
+    FOR EACH STATEMENT EXECUTE FUNCTION people_log_changes();
+
+DROP TRIGGER IF EXISTS activities_log_insert ON activities;
+CREATE TRIGGER activities_log_insert AFTER INSERT ON activities
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION activities_log_changes();
+DROP TRIGGER IF EXISTS activities_log_update ON activities;
+CREATE TRIGGER activities_log_update AFTER UPDATE ON activities
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION activities_log_changes();
+DROP TRIGGER IF EXISTS activities_log_delete ON activities;
+CREATE TRIGGER activities_log_delete AFTER DELETE ON activities
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION activities_log_changes();
+DROP TRIGGER IF EXISTS activities_log_truncate ON activities;
+CREATE TRIGGER activities_log_truncate AFTER TRUNCATE ON activities
+    FOR EACH STATEMENT EXECUTE FUNCTION activities_log_changes();
+'''
+
+# The change feed is read in (txid, seq) order (changes)
+CHANGE_LOG_ORDER_SQL = '''
+CREATE INDEX IF NOT EXISTS change_log_txid_seq ON change_log (txid, seq);
+'''
+
+# Writers append their stats differences to stats_deltas instead of updating
+# the shared stats_rollup rows, which queued every concurrent writer of a
+# class and month behind one row lock; stats_fold() moves them over (stats)
+STATS_DELTAS_SQL = '''
+CREATE TABLE IF NOT EXISTS stats_deltas (
+    class_id INT NOT NULL,
+    gender_id INT NOT NULL,
+    bucket DATE NOT NULL,
+    activity1 BOOLEAN NOT NULL,
+    activity2 BOOLEAN NOT NULL,
+    transport BOOLEAN NOT NULL,
+    people BIGINT NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION stats_count_people(rows people[], sign INT, flagged BOOLEAN) RETURNS void AS $$
+    INSERT INTO stats_deltas (class_id, gender_id, bucket, activity1, activity2, transport, people)
+    SELECT coalesce(p.class_id, 0), coalesce(p.gender_id, 0), stats_bucket(p.created_at),
+           coalesce(f.activity1, FALSE), coalesce(f.activity2, FALSE), coalesce(f.transport, FALSE),
+           sign * count(*)
+    FROM unnest(rows) p
+    LEFT JOIN (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM activities
+        WHERE person_id IN (SELECT id FROM unnest(rows))
+        GROUP BY person_id
+    ) f ON f.person_id = p.id AND flagged
+    GROUP BY 1, 2, 3, 4, 5, 6
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION stats_reflag(person_ids INT[], new_ids INT[], old_rows activities[])
+RETURNS void AS $$
+    WITH ids AS (
+        SELECT DISTINCT unnest(person_ids) AS id
+    ), affected AS (
+        SELECT p.id, p.class_id, p.gender_id, p.created_at
+        FROM people p JOIN ids ON ids.id = p.id
+    ), current AS (
+        SELECT a.activity_id, a.person_id, a.activity1, a.activity2, a.transport
+        FROM activities a JOIN ids ON ids.id = a.person_id
+    ), before AS (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM (
+            SELECT person_id, activity1, activity2, transport FROM current c
+            WHERE NOT EXISTS (SELECT 1 FROM unnest(new_ids) AS n (id) WHERE n.id = c.activity_id)
+            UNION ALL
+            SELECT person_id, activity1, activity2, transport FROM unnest(old_rows)
+        ) s
+        GROUP BY person_id
+    ), after AS (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM current
+        GROUP BY person_id
+    ), deltas AS (
+        SELECT a.class_id, a.gender_id, a.created_at,
+               coalesce(b.activity1, FALSE) AS activity1, coalesce(b.activity2, FALSE) AS activity2,
+               coalesce(b.transport, FALSE) AS transport, -1 AS people
+        FROM affected a LEFT JOIN before b ON b.person_id = a.id
+        UNION ALL
+        SELECT a.class_id, a.gender_id, a.created_at,
+               coalesce(n.activity1, FALSE), coalesce(n.activity2, FALSE), coalesce(n.transport, FALSE), 1
+        FROM affected a LEFT JOIN after n ON n.person_id = a.id
+    )
+    INSERT INTO stats_deltas (class_id, gender_id, bucket, activity1, activity2, transport, people)
+    SELECT coalesce(class_id, 0), coalesce(gender_id, 0), stats_bucket(created_at),
+           activity1, activity2, transport, sum(people)
+    FROM deltas
+    GROUP BY 1, 2, 3, 4, 5, 6
+    HAVING sum(people) <> 0
+$$ LANGUAGE sql;
+
+-- Move every committed delta into the rollup; returns how many were folded.
+-- A concurrent fold skips the rows this one deletes, so none is counted twice.
+CREATE OR REPLACE FUNCTION stats_fold() RETURNS BIGINT AS $$
+    WITH folded AS (
+        DELETE FROM stats_deltas
+        RETURNING class_id, gender_id, bucket, activity1, activity2, transport, people
+    ), merged AS (
+        INSERT INTO stats_rollup AS r (class_id, gender_id, bucket, activity1, activity2, transport, people)
+        SELECT class_id, gender_id, bucket, activity1, activity2, transport, sum(people)
+        FROM folded
+        GROUP BY 1, 2, 3, 4, 5, 6
+        HAVING sum(people) <> 0
+        ON CONFLICT (class_id, gender_id, bucket, activity1, activity2, transport)
+        DO UPDATE SET people = r.people + EXCLUDED.people
+    )
+    SELECT count(*) FROM folded
+$$ LANGUAGE sql;
+
+-- Writers are held off while it runs, so no delta is counted both in the
+-- recount and in stats_deltas
+CREATE OR REPLACE FUNCTION stats_rebuild() RETURNS void AS $$
+    LOCK TABLE stats_deltas IN EXCLUSIVE MODE;
+    DELETE FROM stats_deltas;
+    DELETE FROM stats_rollup;
+    INSERT INTO stats_rollup (class_id, gender_id, bucket, activity1, activity2, transport, people)
+    SELECT coalesce(p.class_id, 0), coalesce(p.gender_id, 0), stats_bucket(p.created_at),
+           coalesce(f.activity1, FALSE), coalesce(f.activity2, FALSE), coalesce(f.transport, FALSE),
+           count(*)
+    FROM people p
+    LEFT JOIN (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM activities
+        GROUP BY person_id
+    ) f ON f.person_id = p.id
+    GROUP BY 1, 2, 3, 4, 5, 6;
+$$ LANGUAGE sql;
+'''
+
+# Writers append a row per writing statement instead of updating the shared
+# table_versions row, which made every writer to a table wait for the one
+# before it to commit.  table_versions becomes a view adding the pending
+# rows to the folded base, so its readers are unchanged (response_cache)
+TABLE_VERSION_DELTAS_SQL = '''
+CREATE TABLE IF NOT EXISTS table_version_deltas (
+    table_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS table_version_deltas_table_name ON table_version_deltas (table_name);
+
+ALTER TABLE table_versions RENAME TO table_version_base;
+CREATE VIEW table_versions AS
+    SELECT b.table_name,
+           b.version + (SELECT count(*) FROM table_version_deltas d WHERE d.table_name = b.table_name) AS version
+    FROM table_version_base b;
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO table_version_deltas (table_name) VALUES (TG_TABLE_NAME);
+    PERFORM pg_notify('data_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Move every committed delta into the base; returns how many were folded.
+-- Readers see the rows gone and the base raised in the same snapshot.
+CREATE OR REPLACE FUNCTION table_versions_fold() RETURNS BIGINT AS $$
+    WITH folded AS (
+        DELETE FROM table_version_deltas
+        RETURNING table_name
+    ), counted AS (
+        SELECT table_name, count(*) AS writes
+        FROM folded
+        GROUP BY table_name
+    ), raised AS (
+        UPDATE table_version_base b SET version = b.version + c.writes
+        FROM counted c
+        WHERE c.table_name = b.table_name
+    )
+    SELECT coalesce(sum(writes), 0)::BIGINT FROM counted
+$$ LANGUAGE sql;
+'''
+
+
+# (version, name, sql); append new migrations, never edit applied ones
+MIGRATIONS = [
+    (1, 'base schema', SCHEMA_SQL),
+    (2, 'lookup and foreign key indexes', ''.join(ensure_index_sql(*column) for column in INDEXED_COLUMNS)),
+    (3, 'reference data notify triggers', NOTIFY_TRIGGERS_SQL),
+    (4, 'table version triggers', VERSION_TRIGGERS_SQL),
+    (5, 'materialized flag views', MATVIEWS_SQL),
+    (6, 'stats rollup', STATS_SQL),
+    (7, 'people search indexes', SEARCH_SQL),
+    (8, 'change log triggers', CHANGES_SQL),
+    (9, 'change log visibility order', CHANGE_LOG_ORDER_SQL),
+    (10, 'stats deltas', STATS_DELTAS_SQL),
+    (11, 'table version deltas', TABLE_VERSION_DELTAS_SQL),
+]
+
+MIGRATIONS_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)'''
+
+
+def applied_versions(cur):
+    cur.execute(MIGRATIONS_TABLE_SQL)
+    cur.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(log=print):
+    """Apply every pending migration in order; returns the versions applied"""
+    applied = []
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+            try:
+                done = applied_versions(cur)
+                conn.commit()
+                for version, name, sql in MIGRATIONS:
+                    if version in done:
+                        continue
+                    cur.execute(sql)
+                    cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                                (version, name))
+                    conn.commit()
+                    applied.append(version)
+                    log(f'applied {version:04d} {name}')
+            finally:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+                conn.commit()
+    return applied
+
+
+def status():
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            done = applied_versions(cur)
+        conn.commit()
+    return [{'version': version, 'name': name, 'applied': version in done}
+            for version, name, _ in MIGRATIONS]
+
+
+def route_statements(cur):
+    """(name, sql, params) for each statement the routes issue.
+
+    Parameters are realistic values from the database so the planner sees
+    the same selectivity as in production.
+    """
+    cur.execute('SELECT max(id), min(id) FROM people')
+    max_id, min_id = cur.fetchone()
+    middle = (max_id + min_id) // 2 if max_id is not None else 1
+    cur.execute('SELECT activity_id FROM activities WHERE person_id = %s LIMIT 1', (middle,))
+    row = cur.fetchone()
+    activity_id = row[0] if row else 1
+    cur.execute('SELECT class_id, class_name FROM classes ORDER BY class_id LIMIT 1')
+    class_id, class_name = cur.fetchone() or (1, 'cp1')
+    cur.execute('SELECT gender_name FROM gender ORDER BY gender_id LIMIT 1')
+    gender = (cur.fetchone() or ('female',))[0]
+
+    filters = {'gender': gender, 'created_after': '2024-01-01', 'activity1': 'true'}
+    people_filters = parse_filters(filters, 'g.gender_name', 'p.created_at', PEOPLE_FLAG_FILTERS)
+    activity_filters = parse_filters(filters, 'g.gender_name', 'a.created_at', ACTIVITY_FLAG_FILTERS)
+    view_filters = parse_filters(filters, 'gender', 'created_at', VIEW_FLAG_FILTERS)
+
+    statements = [
+        ('people page', *paginated_query(PEOPLE_LIST_SELECT, 'p.id', [], [], middle, 50)),
+        ('people page filtered', *paginated_query(PEOPLE_LIST_SELECT, 'p.id', *people_filters, middle, 50)),
+        ('people page with activities', WITH_ACTIVITIES.format(
+            people=paginated_query(PEOPLE_LIST_SELECT, 'p.id', [], [], middle, 50)[0]), [middle, 51]),
+        ('person by id', PERSON_BY_ID, [middle]),
+        ('people by ids', PEOPLE_BY_IDS, [list(range(middle, middle + 50))]),
+        ('person exists', PERSON_EXISTS, [middle]),
+        ('insert person', INSERT_PERSON, ['a', 'b', 'c', None, None, None]),
+        ('insert default activities', INSERT_DEFAULT_ACTIVITIES, [middle]),
+        ('update person', 'UPDATE people SET contact = %s WHERE id = %s', ['0600000000', middle]),
+        ('delete person', DELETE_PERSON, [middle]),
+        ('delete people', 'DELETE FROM people WHERE id = ANY(%s) RETURNING id', [[middle, middle + 1]]),
+        # Run by the ON DELETE CASCADE foreign key, so it never shows up in the DELETE's plan
+        ('delete cascade to activities', 'DELETE FROM activities WHERE person_id = ANY(%s)', [[middle]]),
+        ('activities page', *paginated_query(ACTIVITIES_SELECT, 'a.activity_id', [], [], activity_id, 50)),
+        ('activities page filtered', *paginated_query(ACTIVITIES_SELECT + ACTIVITIES_GENDER_JOIN,
+                                                      'a.activity_id', *activity_filters, activity_id, 50)),
+        ('activities by person', ACTIVITIES_BY_PERSON, [middle]),
+        ('activities by people', ACTIVITIES_BY_PEOPLE, [list(range(middle, middle + 50))]),
+        ('update activities', 'UPDATE activities SET activity1 = %s WHERE activity_id = %s', [True, activity_id]),
+        ('batch update activities', '''
+            UPDATE activities AS t SET activity1 = v.activity1
+            FROM (VALUES (%s::int, %s::boolean), (%s::int, %s::boolean)) AS v(activity_id, activity1)
+            WHERE t.activity_id = v.activity_id''', [activity_id, True, activity_id + 1, False]),
+        ('class by name', CLASS_ID_BY_NAME, [class_name]),
+        ('class students', CLASS_STUDENTS, [class_id]),
+        ('class students with activities', WITH_ACTIVITIES.format(people=CLASS_STUDENTS), [class_id]),
+        ('genders', GENDERS, []),
+        ('grouped stats', STATS_QUERY, ['month']),
+        ('people search', *search_sql(cur, 'first12 last', 20)),
+        ('changes since', *since_query(Position(1), {'table': 'people', 'person_id': middle}, limit=1000)),
+        ('changes since with gaps', *since_query(Position(1, {1: 0}), {}, limit=1000)),
+        ('changes position', CHANGES_POSITION, [1]),
+        ('changes after position', *since_query(Position(1, txid=1), {}, limit=1000)),
+    ]
+    for view in VIEWS.values():
+        for source, sql in ((view.name, view.live_select), (view.table, view.mat_select)):
+            statements.append((f'{source} page', *paginated_query(sql, 'id', [], [], middle, 50)))
+            statements.append((f'{source} page filtered', *paginated_query(sql, 'id', *view_filters, middle, 50)))
+    return statements
+
+
+def _seq_scans(plan):
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', ()):
+        yield from _seq_scans(child)
+
+
+def check_plans(max_seq_rows=PLAN_CHECK_MAX_SEQ_ROWS):
+    """EXPLAIN every route statement; returns a result per statement.
+
+    A statement fails when its plan sequentially scans a relation that the
+    planner estimates to hold more than ``max_seq_rows`` rows.  Relations
+    never analyzed have no estimate (and plans made without statistics),
+    so they are analyzed first; a fresh database is checked as it will be
+    planned once autovacuum gets to it.
+    """
+    results = []
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(UNANALYZED_SQL)
+            for (relation,) in cur.fetchall():
+                cur.execute(f'ANALYZE {relation}')
+            conn.commit()
+            cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'm')")
+            sizes = dict(cur.fetchall())
+            for name, sql, params in route_statements(cur):
+                cur.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cur.fetchone()[0][0]['Plan']
+                scans = sorted(set(_seq_scans(plan)))
+                too_big = [table for table in scans if sizes.get(table, 0) > max_seq_rows
+                           and table not in PLAN_CHECK_FULL_SCAN_TABLES]
+                results.append({'statement': name, 'seq_scans': scans, 'failed': too_big,
+                                'total_cost': plan['Total Cost']})
+        conn.rollback()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('migrate')
+    commands.add_parser('status')
+    check = commands.add_parser('check')
+    check.add_argument('--rows', type=int, default=PLAN_CHECK_MAX_SEQ_ROWS,
+                       help='largest table a sequential scan may read')
+    check.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        if not migrate():
+            print('schema is up to date')
+    elif args.command == 'status':
+        for migration in status():
+            state = 'applied' if migration['applied'] else 'pending'
+            print(f"{migration['version']:04d} {state:8} {migration['name']}")
+    else:
+        results = check_plans(args.rows)
+        failed = [result for result in results if result['failed']]
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            for result in results:
+                mark = 'FAIL' if result['failed'] else 'ok'
+                scans = f" seq scan on {', '.join(result['seq_scans'])}" if result['seq_scans'] else ''
+                print(f"{mark:4} {result['statement']}{scans}")
+            print(f'{len(results) - len(failed)} of {len(results)} statements passed '
+                  f'(sequential scans allowed up to {args.rows} rows)')
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import base64
+import json
+import os
+from datetime import datetime
+
+# Page size bounds for the list endpoints
+PAGE_DEFAULT_LIMIT = int(os.environ.get('PAGE_DEFAULT_LIMIT', 50))
+PAGE_MAX_LIMIT = int(os.environ.get('PAGE_MAX_LIMIT', 500))
+# Most ids one ?ids= / ?person_ids= lookup may ask for
+MULTI_GET_MAX_IDS = int(os.environ.get('MULTI_GET_MAX_IDS', PAGE_MAX_LIMIT))
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+
+def encode_cursor(last_id):
+    """Turn the last id of a page into an opaque cursor string"""
+    raw = json.dumps({'id': last_id}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Recover the id encoded by encode_cursor (plain integers are accepted too)"""
+    if cursor.isdigit():
+        return int(cursor)
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded))['id']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    if not isinstance(last_id, int):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return last_id
+
+
+def parse_bool(name, value):
+    lowered = value.lower()
+    if lowered in TRUE_VALUES:
+        return True
+    if lowered in FALSE_VALUES:
+        return False
+    raise ValueError(f'Invalid value for {name}: {value} (expected true or false)')
+
+
+def parse_datetime(name, value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid value for {name}: {value} (expected an ISO 8601 date)')
+
+
+def parse_page(args):
+    """Read ``after`` and ``limit`` from the query string"""
+    after = args.get('after')
+    last_id = decode_cursor(after) if after else None
+    limit = args.get('limit', PAGE_DEFAULT_LIMIT)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError(f'Invalid value for limit: {limit}')
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    return last_id, min(limit, PAGE_MAX_LIMIT)
+
+
+def parse_ids(args, name):
+    """The comma-separated ids of ``name`` in the query string, deduplicated and sorted"""
+    ids = set()
+    for value in args.get(name, '').split(','):
+        if value.strip():
+            try:
+                ids.add(int(value))
+            except ValueError:
+                raise ValueError(f'Invalid value in {name}: {value}')
+    if not ids:
+        raise ValueError(f'{name} must list at least one id')
+    if len(ids) > MULTI_GET_MAX_IDS:
+        raise ValueError(f'{name} can list at most {MULTI_GET_MAX_IDS} ids')
+    return sorted(ids)
+
+
+def parse_fields(args, columns, key):
+    """The column names of ``fields`` in the query string, ``key`` first; None for all.
+
+    ``key`` is always selected: pages are cut and activities nested on it.
+    """
+    fields = [field.strip() for field in args.get('fields', '').split(',') if field.strip()]
+    if not fields:
+        return None
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise ValueError(f"Invalid fields: {', '.join(unknown)} (expected any of {', '.join(columns)})")
+    return list(dict.fromkeys([key] + fields))
+
+
+def parse_include(args):
+    """Whether ?include=activities asks for nested activities"""
+    include = args.get('include')
+    if include and include != 'activities':
+        raise ValueError(f'Invalid value for include: {include} (expected activities)')
+    return include == 'activities'
+
+
+def parse_filters(args, gender_column, created_column, flag_conditions):
+    """Translate query-string filters into SQL conditions and parameters.
+
+    Supported filters are ``gender``, ``created_after``, ``created_before`` and
+    one boolean per entry of ``flag_conditions``, which maps the flag name to
+    a condition with a single ``%s`` placeholder.
+    """
+    conditions = []
+    params = []
+    if args.get('gender'):
+        conditions.append(f'{gender_column} = %s')
+        params.append(args['gender'])
+    if args.get('created_after'):
+        conditions.append(f'{created_column} >= %s')
+        params.append(parse_datetime('created_after', args['created_after']))
+    if args.get('created_before'):
+        conditions.append(f'{created_column} < %s')
+        params.append(parse_datetime('created_before', args['created_before']))
+    for flag, condition in flag_conditions.items():
+        if args.get(flag):
+            conditions.append(condition)
+            params.append(parse_bool(flag, args[flag]))
+    return conditions, params
+
+
+def paginated_query(select_sql, id_column, conditions, params, last_id, limit):
+    """Append a keyset range, ordering and limit to a SELECT statement.
+
+    One extra row is requested so the caller can tell whether another page
+    exists without running a COUNT.
+    """
+    conditions = list(conditions)
+    params = list(params)
+    if last_id is not None:
+        conditions.append(f'{id_column} > %s')
+        params.append(last_id)
+    sql = select_sql
+    if conditions:
+        sql += '\nWHERE ' + ' AND '.join(conditions)
+    sql += f'\nORDER BY {id_column}\nLIMIT %s'
+    params.append(limit + 1)
+    return sql, params
+
+
+def split_page(rows, limit, id_index=0):
+    """Trim the look-ahead row and compute the cursor for the next page.
+
+    ``id_index`` is the position (for tuples) or key (for mappings) of the
+    id in each row.
+    """
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1][id_index])
+    return rows, None
@@ -0,0 +1,86 @@
+import os
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from queries import (
+    ACTIVITIES_BY_PEOPLE, ACTIVITIES_BY_PERSON, CLASS_STUDENTS, PEOPLE_BY_IDS, PERSON_BY_ID, PERSON_EXISTS,
+    WITH_ACTIVITIES, numbered,
+)
+
+PREPARED_STATEMENTS_ENABLED = os.environ.get('PREPARED_STATEMENTS_ENABLED', '1') not in ('0', 'false', 'False', '')
+
+# Hot statements whose text never changes, by the name they are prepared under
+STATEMENTS = {
+    'person_by_id': PERSON_BY_ID,
+    'people_by_ids': PEOPLE_BY_IDS,
+    'people_by_ids_with_activities': WITH_ACTIVITIES.format(people=PEOPLE_BY_IDS),
+    'person_exists': PERSON_EXISTS,
+    'activities_by_person': ACTIVITIES_BY_PERSON,
+    'activities_by_people': ACTIVITIES_BY_PEOPLE,
+    'class_students': CLASS_STUDENTS,
+    'class_students_with_activities': WITH_ACTIVITIES.format(people=CLASS_STUDENTS),
+}
+
+# A pooler or DISCARD dropped the statement (26000), or DDL changed the
+# shape of its result (0A000 "cached plan must not change result type")
+STALE_STATEMENT_CODES = ('26000', '0A000')
+
+_lock = threading.Lock()
+stats = {'prepared': 0, 'executed': 0, 'reprepared': 0}
+
+
+def _count(key):
+    with _lock:
+        stats[key] += 1
+
+
+def _run(cur, name, params):
+    conn = cur.connection
+    if name in conn.stale_prepared:
+        cur.execute(f'DEALLOCATE {name}')
+        conn.prepared.discard(name)
+        conn.stale_prepared.discard(name)
+    if name not in conn.prepared:
+        cur.execute(f'PREPARE {name} AS {numbered(STATEMENTS[name])}')
+        # Not undone by a rollback: the statement lives as long as the session
+        conn.prepared.add(name)
+        _count('prepared')
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+    _count('executed')
+
+
+def execute(cur, name, params=()):
+    """Run registered statement ``name`` on ``cur`` like ``cur.execute``.
+
+    The statement is PREPAREd the first time a connection runs it and
+    EXECUTEd from then on, so Postgres parses it once per session and can
+    reuse a generic plan.  If the server no longer has it or its result
+    shape changed, it is prepared again, transparently when the failed
+    EXECUTE was the first statement of its transaction.
+    """
+    conn = cur.connection
+    if not PREPARED_STATEMENTS_ENABLED or not hasattr(conn, 'prepared'):
+        cur.execute(STATEMENTS[name], params)
+        return
+    fresh_transaction = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        _run(cur, name, params)
+    except psycopg2.Error as e:
+        if e.pgcode not in STALE_STATEMENT_CODES:
+            raise
+        if e.pgcode == '0A000':
+            conn.stale_prepared.add(name)
+        else:
+            conn.prepared.discard(name)
+        if not fresh_transaction:
+            # Earlier work in this transaction is lost with it, so let the
+            # caller fail; the statement is prepared again on next use
+            raise
+        conn.rollback()
+        _count('reprepared')
+        _run(cur, name, params)
@@ -0,0 +1,174 @@
+"""SQL shared by the route handlers (sync and async) and the maintenance tools.
+
+Statements use psycopg2's ``%s`` placeholders; ``numbered()`` rewrites them
+to ``$1, $2, ...`` for asyncpg.
+"""
+import re
+
+
+def select_columns(columns, fields=None):
+    """The SELECT list of ``fields`` (default: all) from a column map.
+
+    The list endpoints keep their columns as ``{output name: expression}``
+    so ?fields= can narrow the SELECT itself; the planner then drops LEFT
+    JOINs to gender and classes when none of their columns are asked for.
+    """
+    return '\n    SELECT ' + ', '.join(columns[field] for field in (fields or columns))
+
+
+PEOPLE_COLUMNS = {
+    'id': 'p.id',
+    'first_name': 'p.first_name',
+    'last_name': 'p.last_name',
+    'email': 'p.email',
+    'gender_name': 'g.gender_name',
+    'contact': 'p.contact',
+    'mother_name': 'p.mother_name',
+    'created_at': 'p.created_at',
+}
+PEOPLE_FROM = '''
+    FROM people p
+    LEFT JOIN gender g ON p.gender_id = g.gender_id'''
+PEOPLE_SELECT = select_columns(PEOPLE_COLUMNS) + PEOPLE_FROM
+
+# The /people list also reports each person's class
+PEOPLE_LIST_COLUMNS = {**PEOPLE_COLUMNS, 'class': 'c.class_name AS "class"'}
+PEOPLE_LIST_FROM = PEOPLE_FROM + '''
+    LEFT JOIN classes c ON p.class_id = c.class_id'''
+PEOPLE_LIST_SELECT = select_columns(PEOPLE_LIST_COLUMNS) + PEOPLE_LIST_FROM
+
+PERSON_BY_ID = PEOPLE_SELECT + '''
+    WHERE p.id = %s'''
+
+PEOPLE_BY_IDS = PEOPLE_SELECT + '''
+    WHERE p.id = ANY(%s)
+    ORDER BY p.id'''
+
+PERSON_EXISTS = 'SELECT id FROM people WHERE id = %s'
+
+INSERT_PERSON = '''
+    INSERT INTO people (first_name, last_name, email, gender_id, contact, mother_name)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    RETURNING id'''
+
+INSERT_DEFAULT_ACTIVITIES = '''
+    INSERT INTO activities (person_id, activity1, activity2, transport)
+    VALUES (%s, FALSE, FALSE, FALSE)'''
+
+DELETE_PERSON = 'DELETE FROM people WHERE id = %s'
+
+ACTIVITIES_COLUMNS = {
+    'activity_id': 'a.activity_id',
+    'person_id': 'a.person_id',
+    'first_name': 'p.first_name',
+    'last_name': 'p.last_name',
+    'activity1': 'a.activity1',
+    'activity2': 'a.activity2',
+    'transport': 'a.transport',
+    'created_at': 'a.created_at',
+}
+ACTIVITIES_FROM = '''
+    FROM activities a
+    JOIN people p ON a.person_id = p.id'''
+ACTIVITIES_SELECT = select_columns(ACTIVITIES_COLUMNS) + ACTIVITIES_FROM
+
+# Only joined when the activities list is filtered by gender
+ACTIVITIES_GENDER_JOIN = '''
+    LEFT JOIN gender g ON p.gender_id = g.gender_id'''
+
+ACTIVITIES_BY_PERSON = ACTIVITIES_SELECT + '''
+    WHERE a.person_id = %s'''
+
+ACTIVITIES_BY_PEOPLE = ACTIVITIES_SELECT + '''
+    WHERE a.person_id = ANY(%s)
+    ORDER BY a.person_id, a.activity_id'''
+
+FLAG_VIEW_SELECT = '''
+    SELECT id, first_name, last_name, email, gender, contact, mother_name,
+           activity1, activity2, transport, created_at
+    FROM {view}'''
+
+ACTIVITY1_SELECT = FLAG_VIEW_SELECT.format(view='activity1')
+TRANSPORT_SELECT = FLAG_VIEW_SELECT.format(view='transport')
+
+CLASS_STUDENTS_COLUMNS = {**PEOPLE_COLUMNS, 'class_name': 'c.class_name'}
+# Everything after the SELECT list, including the class filter
+CLASS_STUDENTS_FROM = PEOPLE_FROM + '''
+    JOIN classes c ON p.class_id = c.class_id
+    WHERE p.class_id = %s
+    ORDER BY p.id'''
+CLASS_STUDENTS = select_columns(CLASS_STUDENTS_COLUMNS) + CLASS_STUDENTS_FROM
+
+# Wraps a people query (which must select p.id first and may carry its own
+# ORDER BY/LIMIT) so each person row is followed by its activities rows.
+# The ordered LATERAL subquery is not flattened, so activities are always
+# probed through activities.person_id instead of hash-joined after a
+# sequential scan, which the planner favours for a few thousand people.
+ACTIVITY_FIELDS = ('activity_id', 'activity1', 'activity2', 'transport', 'created_at')
+WITH_ACTIVITIES = '''
+    SELECT page.*, a.activity_id, a.activity1, a.activity2, a.transport, a.created_at
+    FROM ({people}
+    ) page
+    LEFT JOIN LATERAL (
+        SELECT activity_id, activity1, activity2, transport, created_at
+        FROM activities
+        WHERE person_id = page.id
+        ORDER BY activity_id
+    ) a ON TRUE
+    ORDER BY page.id, a.activity_id'''
+
+CLASS_ID_BY_NAME = 'SELECT class_id FROM classes WHERE class_name = %s'
+
+GENDERS = 'SELECT gender_id, gender_name FROM gender ORDER BY gender_id'
+CLASSES = 'SELECT class_id, class_name FROM classes ORDER BY class_id'
+
+# Activity flag filters for the list endpoints, keyed by query parameter
+ACTIVITY_FLAGS = ('activity1', 'activity2', 'transport')
+PEOPLE_FLAG_FILTERS = {
+    flag: f'EXISTS (SELECT 1 FROM activities a WHERE a.person_id = p.id AND a.{flag} = %s)'
+    for flag in ACTIVITY_FLAGS
+}
+ACTIVITY_FLAG_FILTERS = {flag: f'a.{flag} = %s' for flag in ACTIVITY_FLAGS}
+VIEW_FLAG_FILTERS = {flag: f'{flag} = %s' for flag in ACTIVITY_FLAGS}
+
+
+def numbered(sql):
+    """Rewrite ``%s`` placeholders as ``$1, $2, ...`` for asyncpg"""
+    parts = sql.split('%s')
+    out = [parts[0]]
+    for index, part in enumerate(parts[1:], start=1):
+        out.append(f'${index}')
+        out.append(part)
+    return ''.join(out)
+
+
+def numbered_named(sql, params):
+    """numbered() for ``%(name)s`` placeholders: (sql, positional params)"""
+    names = list(dict.fromkeys(re.findall(r'%\((\w+)\)s', sql)))
+    sql = re.sub(r'%\((\w+)\)s', lambda match: f'${names.index(match.group(1)) + 1}', sql)
+    return sql.replace('%%', '%'), [params[name] for name in names]
+
+
+def nest_activities(cur):
+    """Group the rows of a WITH_ACTIVITIES query into people with nested activities"""
+    return nest_activity_rows([desc[0] for desc in cur.description], cur.fetchall())
+
+
+def nest_activity_rows(columns, rows):
+    """nest_activities() for rows already fetched, with their column names.
+
+    Rows arrive ordered by person id, so each person dict is built once in
+    a single pass and its activities are appended as they come.
+    """
+    width = len(columns) - len(ACTIVITY_FIELDS)
+    person_columns = columns[:width]
+    people = []
+    person = None
+    for row in rows:
+        if person is None or person['id'] != row[0]:
+            person = dict(zip(person_columns, row[:width]))
+            person['activities'] = []
+            people.append(person)
+        if row[width] is not None:
+            person['activities'].append(dict(zip(ACTIVITY_FIELDS, row[width:])))
+    return people
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+from db import get_connection
+from listener import ensure_listener, subscribe
+
+# Seconds a cached table is trusted without a change notification
+REFDATA_TTL = float(os.environ.get('REFDATA_TTL', 300))
+# Announced by the reference tables' triggers (migration 3)
+REFDATA_CHANNEL = 'refdata_changed'
+
+
+class ReferenceTable:
+    """Whole-table cache of a small ``(id, name)`` lookup table.
+
+    The table is reloaded when it is older than ``ttl`` seconds or after
+    ``invalidate()``, which the change listener calls when the database
+    announces a write.  Because the whole table is cached, lookups for names
+    that do not exist are answered without a query as well.
+    """
+
+    def __init__(self, table, id_column, name_column, ttl=REFDATA_TTL):
+        self.table = table
+        self.id_column = id_column
+        self.name_column = name_column
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rows = None
+        self._by_name = {}
+        self._loaded_at = 0.0
+        self._stats = {'hits': 0, 'misses': 0, 'loads': 0, 'invalidations': 0}
+
+    def _fresh(self):
+        return self._rows is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _load(self, cur=None):
+        sql = (f'SELECT {self.id_column}, {self.name_column} FROM {self.table} '
+               f'ORDER BY {self.id_column}')
+        if cur is None:
+            with get_connection() as conn:
+                with conn.cursor() as own_cur:
+                    own_cur.execute(sql)
+                    rows = own_cur.fetchall()
+        else:
+            cur.execute(sql)
+            rows = cur.fetchall()
+        self._stats['loads'] += 1
+        self._rows = rows
+        self._by_name = {name: row_id for row_id, name in rows}
+        self._loaded_at = time.monotonic()
+        return rows
+
+    def rows(self, cur=None):
+        """All ``(id, name)`` pairs ordered by id.
+
+        ``cur`` lets a caller that already holds a connection reuse it for
+        the reload instead of borrowing a second one from the pool.
+        """
+        ensure_listener()
+        with self._lock:
+            if self._fresh():
+                self._stats['hits'] += 1
+                return self._rows
+            self._stats['misses'] += 1
+            return self._load(cur)
+
+    def lookup(self, name, cur=None):
+        """Id for ``name``, or None if there is no such row"""
+        ensure_listener()
+        with self._lock:
+            if self._fresh():
+                self._stats['hits'] += 1
+                return self._by_name.get(name)
+            self._stats['misses'] += 1
+            self._load(cur)
+            return self._by_name.get(name)
+
+    def invalidate(self):
+        """Drop the cached rows so the next access reloads them"""
+        with self._lock:
+            self._rows = None
+            self._by_name = {}
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        return dict(self._stats, cached=self._rows is not None, size=len(self._by_name))
+
+
+genders = ReferenceTable('gender', 'gender_id', 'gender_name')
+classes = ReferenceTable('classes', 'class_id', 'class_name')
+TABLES = {table.table: table for table in (genders, classes)}
+
+
+def invalidate_all():
+    for table in TABLES.values():
+        table.invalidate()
+
+
+def cache_stats():
+    """Hit/miss counters for every reference table"""
+    return {name: table.stats() for name, table in TABLES.items()}
+
+
+def _on_refdata_changed(table_name):
+    table = TABLES.get(table_name)
+    if table is not None:
+        table.invalidate()
+    else:
+        invalidate_all()
+
+
+subscribe(REFDATA_CHANNEL, _on_refdata_changed, on_reset=invalidate_all)
+
@@ -0,0 +1,243 @@
+import functools
+import itertools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from flask import g, has_request_context, request
+
+import metrics
+from db import PoolTimeout, ConnectionPool, acquire, borrowed, connect, get_connection
+
+# Comma-separated DSNs (key=value strings or postgresql:// URLs) of read replicas
+DB_REPLICAS = [dsn.strip() for dsn in os.environ.get('DB_REPLICAS', '').split(',') if dsn.strip()]
+# 'round_robin' or 'least_loaded' (fewest connections checked out by this worker)
+DB_REPLICA_POLICY = os.environ.get('DB_REPLICA_POLICY', 'round_robin')
+# Replicas further behind the primary than this many seconds are not read from
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 1))
+DB_REPLICA_POOL_MAX = int(os.environ.get('DB_REPLICA_POOL_MAX', os.environ.get('DB_POOL_MAX', 10)))
+# How long a client's reads are held to its last write position
+READ_YOUR_WRITES_TTL = int(os.environ.get('READ_YOUR_WRITES_TTL', 60))
+LSN_COOKIE = 'db_lsn'
+LSN_HEADER = 'X-DB-LSN'
+
+REPLICA_STATUS_SQL = '''
+    SELECT pg_is_in_recovery(),
+           pg_last_wal_replay_lsn() - '0/0'::pg_lsn,
+           EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'''
+PRIMARY_LSN_SQL = "SELECT pg_current_wal_lsn() - '0/0'::pg_lsn"
+
+reads = metrics.register(metrics.Counter(
+    'db_reads_total', 'Read transactions by the server they were routed to', ('target',)))
+
+
+class Replica:
+    """One read replica with its own pool and last observed replication state"""
+
+    def __init__(self, dsn):
+        params = psycopg2.extensions.parse_dsn(dsn)
+        self.name = f"{params.get('host', 'localhost')}:{params.get('port', '5432')}"
+        self.pool = ConnectionPool(maxconn=DB_REPLICA_POOL_MAX, connect=functools.partial(connect, dsn))
+        self.healthy = False
+        self.lag = None
+        self.replay_lsn = 0
+        self.error = None
+        self.checked_at = None
+
+    def check(self, primary_lsn, max_lag):
+        """Refresh the replication state; a failed check takes it out of rotation"""
+        try:
+            with borrowed(self.pool.getconn(), self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(REPLICA_STATUS_SQL)
+                    in_recovery, replay_lsn, replay_age = cur.fetchone()
+                conn.rollback()
+        except (psycopg2.Error, PoolTimeout) as e:
+            self.healthy = False
+            self.error = str(e).strip()
+            return
+        self.checked_at = time.time()
+        if not in_recovery:
+            self.healthy = False
+            self.error = 'not in recovery (promoted or not a replica)'
+            return
+        self.replay_lsn = int(replay_lsn or 0)
+        # Caught up with the primary's position as read just before: no lag,
+        # however long ago the last transaction was replayed
+        if primary_lsn is not None and self.replay_lsn >= primary_lsn:
+            self.lag = 0.0
+        else:
+            self.lag = float(replay_age) if replay_age is not None else None
+        self.healthy = self.lag is not None and self.lag <= max_lag
+        self.error = None if self.healthy else f'lagging {self.lag}s behind the primary'
+
+    def mark_down(self, error):
+        self.healthy = False
+        self.error = str(error).strip()
+
+    def status(self):
+        return {'replica': self.name, 'healthy': self.healthy, 'lag': self.lag,
+                'replay_lsn': self.replay_lsn, 'error': self.error, 'checked_at': self.checked_at,
+                'in_use': self.pool.stats()['in_use']}
+
+
+class ReplicaSet:
+    """Routes read-only work to healthy replicas and everything else to the primary.
+
+    A background thread per worker checks every replica's replay position
+    and lag each ``check_interval`` seconds; replicas that are down, promoted
+    or more than ``max_lag`` seconds behind are skipped until they recover.
+    """
+
+    def __init__(self, dsns=DB_REPLICAS, policy=DB_REPLICA_POLICY, max_lag=DB_REPLICA_MAX_LAG,
+                 check_interval=DB_REPLICA_CHECK_INTERVAL):
+        if policy not in ('round_robin', 'least_loaded'):
+            raise ValueError(f'Invalid DB_REPLICA_POLICY: {policy} (expected round_robin or least_loaded)')
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self.policy = policy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._turn = itertools.count()
+        self._checker_pid = None
+        self._checker_lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            for replica in self.replicas:
+                os.register_at_fork(after_in_child=replica.pool._after_fork)
+
+    def check(self):
+        try:
+            with get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(PRIMARY_LSN_SQL)
+                    primary_lsn = int(cur.fetchone()[0])
+                conn.rollback()
+        except (psycopg2.Error, PoolTimeout):
+            primary_lsn = None
+        for replica in self.replicas:
+            replica.check(primary_lsn, self.max_lag)
+
+    def _run_checks(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+    def ensure_checker(self):
+        """Start this process's replica checker if it is not running yet"""
+        if not self.replicas or self._checker_pid == os.getpid():
+            return
+        with self._checker_lock:
+            if self._checker_pid == os.getpid():
+                return
+            threading.Thread(target=self._run_checks, name='replica-checker', daemon=True).start()
+            self._checker_pid = os.getpid()
+
+    def choose(self, min_lsn=None):
+        """A healthy replica that has replayed ``min_lsn``, or None for the primary"""
+        self.ensure_checker()
+        candidates = [replica for replica in self.replicas
+                      if replica.healthy and (min_lsn is None or replica.replay_lsn >= min_lsn)]
+        if not candidates:
+            return None
+        if self.policy == 'least_loaded':
+            return min(candidates, key=lambda replica: replica.pool.stats()['in_use'])
+        return candidates[next(self._turn) % len(candidates)]
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
+
+
+replicas = ReplicaSet()
+
+
+def request_min_lsn():
+    """The WAL position of the client's last write (``X-DB-LSN`` header or
+    ``db_lsn`` cookie), or None"""
+    if not has_request_context():
+        return None
+    value = request.headers.get(LSN_HEADER) or request.cookies.get(LSN_COOKIE)
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def _behind_cached_versions(conn):
+    """Whether the replica has not yet replayed the table versions the
+    response cache keyed this request on (see response_cache.cached_response)"""
+    expected = g.get('cache_versions') if has_request_context() else None
+    if not expected:
+        return False
+    with conn.cursor() as cur:
+        cur.execute('SELECT table_name, version FROM table_versions WHERE table_name = ANY(%s)',
+                    (list(expected),))
+        found = dict(cur.fetchall())
+    return any(found.get(table, -1) < version for table, version in expected.items())
+
+
+@contextmanager
+def read_connection():
+    """Borrow a connection for read-only work, from a replica when one is usable.
+
+    Falls back to the primary when there are no healthy replicas, when the
+    client's last write (``X-DB-LSN`` header or ``db_lsn`` cookie) has not
+    reached any of them yet, or when the chosen replica fails.
+    """
+    replica = replicas.choose(request_min_lsn()) if replicas.replicas else None
+    if replica is not None:
+        try:
+            # The primary is the fallback; only its failure makes the request degrade
+            conn = acquire(replica.pool, report_unavailable=False)
+        except (psycopg2.OperationalError, PoolTimeout) as e:
+            replica.mark_down(e)
+        else:
+            with borrowed(conn, replica.pool):
+                try:
+                    stale = _behind_cached_versions(conn)
+                except psycopg2.Error:
+                    stale = True
+                conn.rollback()
+                if not stale:
+                    reads.inc(replica.name)
+                    yield conn
+                    return
+    reads.inc('primary')
+    with get_connection() as conn:
+        yield conn
+
+
+def remember_write(response):
+    """Pin the client's following reads to data at least as new as this write"""
+    if not replicas.replicas:
+        return response
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(PRIMARY_LSN_SQL)
+                lsn = str(int(cur.fetchone()[0]))
+            conn.rollback()
+    except (psycopg2.Error, PoolTimeout) as e:
+        print(f'could not read the primary WAL position: {e}', file=sys.stderr)
+        return response
+    response.headers[LSN_HEADER] = lsn
+    response.set_cookie(LSN_COOKIE, lsn, max_age=READ_YOUR_WRITES_TTL, httponly=True, samesite='Lax')
+    return response
+
+
+def _replica_metrics():
+    lines = ['# HELP db_replica_healthy Whether the replica is in read rotation',
+             '# TYPE db_replica_healthy gauge']
+    lines += [f'db_replica_healthy{{replica="{r.name}"}} {int(r.healthy)}' for r in replicas.replicas]
+    lines += ['# HELP db_replica_lag_seconds Replication lag at the last check',
+              '# TYPE db_replica_lag_seconds gauge']
+    lines += [f'db_replica_lag_seconds{{replica="{r.name}"}} {r.lag}'
+              for r in replicas.replicas if r.lag is not None]
+    return lines
+
+
+if replicas.replicas:
+    metrics.add_collector(_replica_metrics)
@@ -0,0 +1,251 @@
+import functools
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+from flask import g, make_response, request
+
+from db import PoolTimeout, get_connection
+from listener import ensure_listener, listening, subscribe
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '1') not in ('0', 'false', 'False', '')
+# Empty for an in-memory cache per worker, or a redis:// URL for a shared one
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', '')
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+TABLE_VERSIONS_FOLD_INTERVAL = float(os.environ.get('TABLE_VERSIONS_FOLD_INTERVAL', 5))
+# The table version triggers (migrations 4 and 11) announce '<table>' here
+# when a writing transaction commits
+DATA_CHANNEL = 'data_changed'
+
+
+class TableVersions:
+    """Latest committed write version of each table.
+
+    Versions are read from the small ``table_versions`` view, which never
+    touches the data tables, and served from memory until a notification
+    says a table was written.  While the change listener is not connected
+    they are read for every request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._synced = False
+
+    def _read(self):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT table_name, version FROM table_versions')
+                return dict(cur.fetchall())
+
+    def get(self, tables):
+        """Tuple of versions for ``tables``, or None if they are unavailable"""
+        ensure_listener()
+        with self._lock:
+            synced = self._synced and listening()
+            # Set before reading, so a write announced during the read is read next time
+            self._synced = listening()
+        if not synced:
+            try:
+                versions = self._read()
+            except Exception:
+                # No table_versions view or no database: serve uncached
+                with self._lock:
+                    self._synced = False
+                return None
+            with self._lock:
+                self._versions.update(versions)
+        with self._lock:
+            if any(table not in self._versions for table in tables):
+                return None
+            return tuple(self._versions[table] for table in tables)
+
+    def on_notify(self, payload):
+        with self._lock:
+            self._synced = False
+
+    def reset(self):
+        with self._lock:
+            self._synced = False
+
+
+versions = TableVersions()
+subscribe(DATA_CHANNEL, versions.on_notify, on_reset=versions.reset)
+
+
+def fold_versions():
+    """Move the committed table version deltas into the base; returns how
+    many.  Skipped while another process folds."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('table_versions_fold'))")
+            folded = 0
+            if cur.fetchone()[0]:
+                cur.execute('SELECT table_versions_fold()')
+                folded = cur.fetchone()[0]
+        conn.commit()
+    return folded
+
+
+class VersionFolder:
+    """Background thread folding the table version deltas every ``interval`` seconds"""
+
+    def __init__(self, interval=TABLE_VERSIONS_FOLD_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {'runs': 0, 'folded': 0, 'failures': 0}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                folded = fold_versions()
+            except (psycopg2.Error, PoolTimeout) as e:
+                print(f'folding the table version deltas failed: {e}', file=sys.stderr)
+                self.stats['failures'] += 1
+                continue
+            self.stats['runs'] += 1
+            self.stats['folded'] += folded
+
+    def ensure_running(self):
+        """Start this process's folder if it is not running yet"""
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='table-version-folder', daemon=True).start()
+            self._pid = os.getpid()
+
+
+version_folder = VersionFolder()
+
+
+class MemoryBackend:
+    """Bounded LRU cache local to one worker process"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class RedisBackend:
+    """Cache shared by all workers through a Redis-compatible server"""
+
+    def __init__(self, url=RESPONSE_CACHE_URL, ttl=RESPONSE_CACHE_TTL, prefix='response:'):
+        if redis is None:
+            raise RuntimeError('RESPONSE_CACHE_URL is set but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except redis.RedisError:
+            return None
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+        except redis.RedisError as e:
+            print(f'response cache write failed: {e}', file=sys.stderr)
+
+
+backend = RedisBackend() if RESPONSE_CACHE_URL else MemoryBackend()
+stats = {'not_modified': 0, 'hits': 0, 'misses': 0, 'bypassed': 0}
+
+
+def make_etag(tables, table_versions):
+    """Strong ETag for the current request URL at the given table versions"""
+    key = '\n'.join([request.method, request.full_path] + [
+        f'{table}:{version}' for table, version in zip(tables, table_versions)
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def skip_cache():
+    """Keep the response being built out of the cache and without an ETag"""
+    g.skip_response_cache = True
+
+
+def cached_response(*tables):
+    """Serve a GET view through ETags and the response cache.
+
+    ``tables`` lists every table the view reads.  Their write versions are
+    folded into the ETag, so a request with a matching If-None-Match gets a
+    304 and a cached body is reused until one of those tables changes.  Only
+    200 responses that are not streamed and did not call ``skip_cache()``
+    are stored.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not RESPONSE_CACHE_ENABLED:
+                return view(*args, **kwargs)
+            table_versions = versions.get(tables)
+            if table_versions is None:
+                stats['bypassed'] += 1
+                return view(*args, **kwargs)
+            etag = make_etag(tables, table_versions)
+
+            # Weak comparison: compression marks the ETag of an encoded body weak
+            if request.if_none_match.contains_weak(etag):
+                stats['not_modified'] += 1
+                response = make_response('', 304)
+            else:
+                cached = backend.get(etag)
+                if cached is not None:
+                    stats['hits'] += 1
+                    body, mimetype = cached
+                    response = make_response(body, 200)
+                    response.mimetype = mimetype
+                else:
+                    stats['misses'] += 1
+                    # Lets replica reads check they have replayed these versions
+                    g.cache_versions = dict(zip(tables, table_versions))
+                    response = make_response(view(*args, **kwargs))
+                    if (response.status_code != 200 or response.is_streamed
+                            or g.get('skip_response_cache')):
+                        return response
+                    backend.set(etag, (response.get_data(), response.mimetype))
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
@@ -0,0 +1,153 @@
+"""Ranked people search over names, email, contact and mother_name.
+
+Every word of the query has to match the start of a word in one of the
+searched columns (full-text prefix search on an expression GIN index).
+Where the pg_trgm extension is available a trigram index adds typo-tolerant
+and substring matches.  Without it, search falls back to prefix matching only.
+Results whose words all match whole words come first; within that and
+within the rest, name matches rank above email and contact matches, which
+rank above mother_name matches.  The indexes are created by migration 7.
+
+A common prefix can match a large share of the table, and ranking every
+match costs as much as reading them all, so at most SEARCH_MAX_CANDIDATES
+whole-word matches and as many other matches are ranked.  Whole-word hits
+are therefore never crowded out by prefix hits; among more prefix matches
+than that, the ones ranked are those first in the table, the same ones on
+every call while the table is unchanged.
+"""
+import os
+import re
+import threading
+
+from queries import PEOPLE_SELECT
+
+SEARCH_DEFAULT_LIMIT = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 20))
+SEARCH_MAX_LIMIT = int(os.environ.get('SEARCH_MAX_LIMIT', 100))
+SEARCH_MAX_QUERY_LENGTH = 100
+# Shorter words only match whole words: a one or two letter prefix matches
+# too much of the table to search quickly
+SEARCH_MIN_PREFIX = int(os.environ.get('SEARCH_MIN_PREFIX', 3))
+# Whole-word matches and other matches ranked per query, at most; a common
+# prefix then costs about as much as a rare one (see above)
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 1000))
+# Lowest pg_trgm word similarity (0-1) a fuzzy match needs
+SEARCH_MIN_SIMILARITY = float(os.environ.get('SEARCH_MIN_SIMILARITY', 0.5))
+SEARCH_FUZZY = os.environ.get('SEARCH_FUZZY', '1') not in ('0', 'false', 'False', '')
+
+# Both expressions must match the indexed ones (migration 7) exactly for the
+# planner to use them
+SEARCH_VECTOR = '''(
+    setweight(to_tsvector('simple', coalesce(first_name, '') || ' ' || coalesce(last_name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(email, '') || ' ' || coalesce(contact, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(mother_name, '')), 'C'))'''
+SEARCH_TEXT = '''lower(
+    coalesce(first_name, '') || ' ' || coalesce(last_name, '') || ' ' || coalesce(email, '') || ' ' ||
+    coalesce(contact, '') || ' ' || coalesce(mother_name, ''))'''
+
+EXACT_MATCH = f"{SEARCH_VECTOR} @@ to_tsquery('simple', %(exact)s)"
+PREFIX_MATCH = f"{SEARCH_VECTOR} @@ to_tsquery('simple', %(terms)s)"
+FUZZY_MATCH = f'%(text)s <%% {SEARCH_TEXT}'
+
+# Candidates first, capped per tier, then ranked; PEOPLE_SELECT gives the
+# same columns as GET /people/<id>
+SEARCH_SQL = '''
+    WITH exact AS MATERIALIZED (
+        SELECT p.id, {rank} AS rank
+        FROM people p
+        WHERE {exact}
+        LIMIT %(candidates)s
+    ), matches AS MATERIALIZED (
+        SELECT p.id, {rank} AS rank
+        FROM people p
+        WHERE {match}
+        LIMIT %(candidates)s
+    ), candidates AS (
+        SELECT id, 0 AS tier, rank FROM exact
+        UNION ALL
+        SELECT id, 1, rank FROM matches WHERE id NOT IN (SELECT id FROM exact)
+    )
+''' + PEOPLE_SELECT + '''
+    JOIN candidates ON candidates.id = p.id
+    ORDER BY candidates.tier, candidates.rank DESC, p.id
+    LIMIT %(limit)s'''
+
+PREFIX_RANK = f"ts_rank({SEARCH_VECTOR}, to_tsquery('simple', %(terms)s))"
+FUZZY_RANK = f"greatest({PREFIX_RANK}, word_similarity(%(text)s, {SEARCH_TEXT}))"
+
+TRIGRAM_SQL = "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+
+_lock = threading.Lock()
+_trigram = {}
+
+
+def parse_search(args):
+    """Read ``q`` and ``limit`` from the query string"""
+    text = ' '.join(args.get('q', '').split())
+    if not text:
+        raise ValueError('q is required')
+    if len(text) > SEARCH_MAX_QUERY_LENGTH:
+        raise ValueError(f'q must be at most {SEARCH_MAX_QUERY_LENGTH} characters')
+    limit = args.get('limit', SEARCH_DEFAULT_LIMIT)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError(f'Invalid value for limit: {limit}')
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    return text, min(limit, SEARCH_MAX_LIMIT)
+
+
+def _words(text):
+    return [word for word in re.split(r"[\s'\\:&|!()<>]+", text.lower()) if word]
+
+
+def prefix_terms(text):
+    """A tsquery string requiring every word of ``text`` as a word prefix"""
+    return ' & '.join(f"'{word}':*" if len(word) >= SEARCH_MIN_PREFIX else f"'{word}'" for word in _words(text))
+
+
+def exact_terms(text):
+    """A tsquery string requiring every word of ``text`` as a whole word"""
+    return ' & '.join(f"'{word}'" for word in _words(text))
+
+
+def trigram_available(cur):
+    """Whether the database this cursor talks to has pg_trgm, checked once per server"""
+    dsn = cur.connection.dsn
+    with _lock:
+        if dsn not in _trigram:
+            cur.execute(TRIGRAM_SQL)
+            _trigram[dsn] = cur.fetchone()[0]
+        return _trigram[dsn]
+
+
+def search_query(text, limit, fuzzy):
+    """(settings, sql, params) finding the ``limit`` best matches for ``text``,
+    with trigram matches when ``fuzzy``.  ``settings`` are (sql, params) pairs
+    to run first in the same transaction."""
+    params = {'terms': prefix_terms(text), 'exact': exact_terms(text), 'text': text.lower(),
+              'limit': limit, 'candidates': max(SEARCH_MAX_CANDIDATES, limit)}
+    # Parallel workers would hand back a different set of capped candidates
+    # on every call
+    settings = [("SELECT set_config('max_parallel_workers_per_gather', '0', true)", ())]
+    if fuzzy:
+        # word_similarity is only consulted above this session setting
+        settings.append(("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)",
+                         (str(SEARCH_MIN_SIMILARITY),)))
+        match = f'{PREFIX_MATCH} OR {FUZZY_MATCH}' if params['terms'] else FUZZY_MATCH
+        rank = FUZZY_RANK if params['terms'] else f'word_similarity(%(text)s, {SEARCH_TEXT})'
+    elif params['terms']:
+        match, rank = PREFIX_MATCH, PREFIX_RANK
+    else:
+        match, rank = 'FALSE', '0'
+    exact = EXACT_MATCH if params['exact'] else 'FALSE'
+    return settings, SEARCH_SQL.format(exact=exact, match=match, rank=rank), params
+
+
+def search_sql(cur, text, limit):
+    """(sql, params) finding the ``limit`` best matches for ``text``, once
+    the settings it needs are applied to ``cur``'s transaction"""
+    settings, sql, params = search_query(text, limit, SEARCH_FUZZY and trigram_available(cur))
+    for setting in settings:
+        cur.execute(*setting)
+    return sql, params
@@ -0,0 +1,111 @@
+"""Fill a local database with synthetic people, classes and activities.
+
+    python seed.py --people 1000000 --classes 200
+    python seed.py --reset --people 100000 --seed 42
+
+Rows are generated server-side with generate_series, in chunks so progress
+is committed as it goes.  Existing rows are kept unless ``--reset`` is given:
+the people count is topped up to ``--people``.  Activity flags come from the
+server's random(), seeded with ``--seed``, so a reset run is reproducible.
+"""
+import argparse
+import json
+import sys
+import time
+
+from db import get_connection
+
+SEED_CHUNK_SIZE = 100000
+GENDERS = ('male', 'female')
+
+
+def seed(people, classes, genders=GENDERS, activities_per_person=1, flag_ratios=(0.3, 0.2, 0.1),
+         chunk_size=SEED_CHUNK_SIZE, random_seed=0.5, reset=False, log=None):
+    """Top the tables up to ``people`` people spread over ``classes`` classes.
+
+    ``flag_ratios`` are the shares of activities rows with activity1,
+    activity2 and transport set.  Returns the row count of each table.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            if reset:
+                cur.execute('TRUNCATE activities, people, classes, gender RESTART IDENTITY CASCADE')
+            cur.execute('''
+                INSERT INTO gender (gender_name)
+                SELECT name FROM unnest(%s::text[]) AS name
+                WHERE NOT EXISTS (SELECT 1 FROM gender WHERE gender_name = name)
+            ''', (list(genders),))
+            cur.execute('''
+                INSERT INTO classes (class_name)
+                SELECT 'class' || i FROM generate_series(1, %s) AS i
+                WHERE NOT EXISTS (SELECT 1 FROM classes WHERE class_name = 'class' || i)
+            ''', (classes,))
+            conn.commit()
+            cur.execute('SELECT array_agg(gender_id ORDER BY gender_id) FROM gender')
+            gender_ids = cur.fetchone()[0]
+            cur.execute('SELECT array_agg(class_id ORDER BY class_id) FROM classes')
+            class_ids = cur.fetchone()[0]
+            cur.execute('SELECT count(*) FROM people')
+            existing = cur.fetchone()[0]
+            cur.execute('SELECT setseed(%s)', (random_seed,))
+            while existing < people:
+                count = min(chunk_size, people - existing)
+                cur.execute('''
+                    WITH new_people AS (
+                        INSERT INTO people (first_name, last_name, email, gender_id, contact,
+                                            mother_name, class_id, created_at)
+                        SELECT 'first' || i, 'last' || i, 'person' || i || '@example.com',
+                               (%(genders)s::int[])[1 + i %% cardinality(%(genders)s::int[])],
+                               '06' || lpad(i::text, 8, '0'), 'mother' || i,
+                               (%(classes)s::int[])[1 + i %% cardinality(%(classes)s::int[])],
+                               now() - (i %% 730) * interval '1 day'
+                        FROM generate_series(%(start)s, %(stop)s) AS i
+                        RETURNING id
+                    )
+                    INSERT INTO activities (person_id, activity1, activity2, transport)
+                    SELECT id, random() < %(activity1)s, random() < %(activity2)s, random() < %(transport)s
+                    FROM new_people, generate_series(1, %(per_person)s)
+                ''', {'genders': gender_ids, 'classes': class_ids,
+                      'start': existing + 1, 'stop': existing + count, 'per_person': activities_per_person,
+                      'activity1': flag_ratios[0], 'activity2': flag_ratios[1], 'transport': flag_ratios[2]})
+                conn.commit()
+                existing += count
+                if log:
+                    log(f'{existing} people')
+            cur.execute('ANALYZE gender, classes, people, activities')
+            conn.commit()
+            counts = {}
+            for table in ('gender', 'classes', 'people', 'activities'):
+                cur.execute(f'SELECT count(*) FROM {table}')
+                counts[table] = cur.fetchone()[0]
+            cur.execute('SELECT min(id), max(id) FROM people')
+            counts['people_id_range'] = list(cur.fetchone())
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--people', type=int, default=100000)
+    parser.add_argument('--classes', type=int, default=200)
+    parser.add_argument('--genders', default=','.join(GENDERS), help='comma-separated gender names')
+    parser.add_argument('--activities-per-person', type=int, default=1)
+    parser.add_argument('--flag-ratios', default='0.3,0.2,0.1',
+                        help='shares of activities with activity1,activity2,transport set')
+    parser.add_argument('--seed', type=float, default=0.5, help='random seed between -1 and 1')
+    parser.add_argument('--reset', action='store_true', help='empty the tables first')
+    parser.add_argument('--chunk-size', type=int, default=SEED_CHUNK_SIZE)
+    args = parser.parse_args()
+    ratios = tuple(float(value) for value in args.flag_ratios.split(','))
+    if len(ratios) != 3:
+        parser.error('--flag-ratios needs three values')
+    start = time.perf_counter()
+    counts = seed(args.people, args.classes, genders=args.genders.split(','),
+                  activities_per_person=args.activities_per_person, flag_ratios=ratios,
+                  chunk_size=args.chunk_size, random_seed=args.seed, reset=args.reset,
+                  log=lambda message: print(message, file=sys.stderr))
+    counts['seconds'] = round(time.perf_counter() - start, 1)
+    print(json.dumps(counts))
+
+
+if __name__ == '__main__':
+    main()
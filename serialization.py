@@ -0,0 +1,101 @@
+import os
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 'orjson' (when installed) or 'default' for Flask's stdlib json provider
+JSON_PROVIDER = os.environ.get('JSON_PROVIDER', 'orjson')
+# 'http' keeps Flask's 'Sat, 17 Oct 2026 18:31:38 GMT' dates; 'iso' emits
+# ISO 8601 straight from orjson, which is faster
+JSON_DATE_FORMAT = os.environ.get('JSON_DATE_FORMAT', 'http')
+
+ROW_FORMATS = ('records', 'columns')
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value):
+    """Format like werkzeug.http.http_date, without its email.utils round trip"""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        hour, minute, second = value.hour, value.minute, value.second
+    else:
+        hour = minute = second = 0
+    return (f'{_WEEKDAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} '
+            f'{value.year:04d} {hour:02d}:{minute:02d}:{second:02d} GMT')
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson.
+
+    Datetimes, dates, UUIDs, tuples and dataclasses are handled by orjson in
+    C; Decimals are encoded as strings like the default provider does.
+    """
+
+    def __init__(self, app, date_format=JSON_DATE_FORMAT):
+        super().__init__(app)
+        self.date_format = date_format
+
+    def _options(self):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.date_format == 'http':
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        return option
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, Decimal):
+            return str(value)
+        if isinstance(value, date):
+            return http_date(value)
+        if isinstance(value, time):
+            return value.isoformat()
+        return DefaultJSONProvider.default(value)
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self._default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self._default, option=self._options() | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def install_json_provider(app, provider=JSON_PROVIDER):
+    """Switch ``app`` to the configured JSON provider"""
+    if provider == 'orjson' and orjson is not None:
+        app.json = OrjsonProvider(app)
+    return app.json
+
+
+def parse_row_format(args):
+    """Read ``?format=records|columns`` for the list endpoints"""
+    fmt = args.get('format', 'records')
+    if fmt not in ROW_FORMATS:
+        raise ValueError(f"Invalid format: {fmt} (expected one of {', '.join(ROW_FORMATS)})")
+    return fmt
+
+
+def tabulate(columns, rows, fmt='records'):
+    """Shape cursor rows for a JSON response.
+
+    ``records`` is the usual list of objects.  ``columns`` returns
+    ``{"columns": [...], "rows": [[...], ...]}`` and passes the row tuples
+    through untouched, so no dict is built per row.
+    """
+    if fmt == 'columns':
+        return {'columns': columns, 'rows': rows}
+    return [dict(zip(columns, row)) for row in rows]
@@ -0,0 +1,86 @@
+"""Coalescing of identical in-flight lookups within a worker.
+
+When several threads ask for the same key at once, only the first runs the
+lookup; the others wait for it and get the same result (or exception).
+Nothing is kept once the lookup finishes, so a result is never handed to
+a request that arrives after it.  Lookups are only shared
+between requests that saw the same table versions (see
+response_cache.cached_response) and are pinned to the same last write (see
+replicas.read_connection), so none of them can cache or return data older
+than it expects.
+"""
+import os
+import threading
+
+from flask import g, has_request_context
+
+import metrics
+from replicas import request_min_lsn
+
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', '1') not in ('0', 'false', 'False', '')
+
+saved = metrics.register(metrics.Counter(
+    'db_queries_coalesced_total', 'Lookups answered by a concurrent identical lookup', ('lookup',)))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # The leader's g.db_unavailable, so waiters degrade the same way
+        self.unavailable = None
+
+
+class SingleFlight:
+    """Runs ``fn`` once for concurrent ``do`` calls with the same key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {'queries': 0, 'coalesced': 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats['queries'] += 1
+            else:
+                self.stats['coalesced'] += 1
+        if not leader:
+            saved.inc(key[0])
+            call.done.wait()
+            if call.error is not None:
+                if call.unavailable is not None and has_request_context():
+                    g.db_unavailable = call.unavailable
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            if has_request_context():
+                call.unavailable = g.get('db_unavailable')
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def status(self):
+        with self._lock:
+            return {'enabled': SINGLE_FLIGHT_ENABLED, 'in_flight': len(self._calls), **self.stats}
+
+
+flights = SingleFlight()
+
+
+def coalesced(lookup, args, fn):
+    """``fn()``, shared with concurrent requests making the same ``lookup`` for ``args``"""
+    if not SINGLE_FLIGHT_ENABLED:
+        return fn()
+    versions = tuple(sorted(g.get('cache_versions', {}).items())) if has_request_context() else ()
+    return flights.do((lookup, args, versions, request_min_lsn()), fn)
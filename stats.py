@@ -0,0 +1,211 @@
+"""Grouped counts of people by class, gender, activity flag and signup date.
+
+The counts come from ``stats_rollup``, one row per combination of class,
+gender, created_at month and activity flags holding how many people fall
+into it.  Triggers on people and activities append each write's difference
+to ``stats_deltas`` inside the writing transaction, so add_person,
+update_activities, delete_person and every other writer keep the counts
+current without a full recount.  Appending rather than updating the rollup
+in place means concurrent writers never wait on each other's rollup rows.
+Reads add the pending deltas to the rollup, and a background thread in
+each worker folds them in every STATS_FOLD_INTERVAL seconds (see
+health.warm_up).  ``python stats.py rebuild`` recomputes the rollup from
+scratch.  People with no class or gender are kept under id 0 so the key has
+no NULLs, and a person counts under a flag when any of their activities
+rows has it set.  The rollup, its triggers and stats_bucket() are created
+by migrations 6 and 10.
+
+    python stats.py fold        move the pending deltas into the rollup
+    python stats.py rebuild     recount the rollup from the tables
+    python stats.py check       compare the rollup with a fresh recount
+"""
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+
+from db import PoolTimeout, get_connection
+
+STATS_FOLD_INTERVAL = float(os.environ.get('STATS_FOLD_INTERVAL', 5))
+
+# Granularities the created_at buckets can be reported at
+BUCKETS = ('month', 'quarter', 'year')
+FLAGS = ('activity1', 'activity2', 'transport')
+
+# The rollup with the deltas not folded into it yet
+ROLLUP_SQL = '''
+    SELECT class_id, gender_id, bucket, activity1, activity2, transport, sum(people) AS people
+    FROM (
+        SELECT class_id, gender_id, bucket, activity1, activity2, transport, people FROM stats_rollup
+        UNION ALL
+        SELECT class_id, gender_id, bucket, activity1, activity2, transport, people FROM stats_deltas
+    ) r
+    GROUP BY 1, 2, 3, 4, 5, 6
+    HAVING sum(people) <> 0'''
+
+# Every breakdown in one pass over the rollup; GROUPING() tells the sets apart
+STATS_QUERY = f'''
+    SELECT GROUPING(class_id) AS all_classes, GROUPING(gender_id) AS all_genders,
+           GROUPING(bucket) AS all_buckets, class_id, gender_id, bucket,
+           sum(people) AS people,
+           coalesce(sum(people) FILTER (WHERE activity1), 0) AS activity1,
+           coalesce(sum(people) FILTER (WHERE activity2), 0) AS activity2,
+           coalesce(sum(people) FILTER (WHERE transport), 0) AS transport
+    FROM (
+        SELECT class_id, gender_id, date_trunc(%s, bucket)::date AS bucket,
+               activity1, activity2, transport, people
+        FROM ({ROLLUP_SQL}) r
+    ) r
+    GROUP BY GROUPING SETS ((), (class_id), (gender_id), (class_id, gender_id), (bucket))
+    ORDER BY class_id, gender_id, bucket'''
+
+# The same counts straight from the tables, to check the rollup against
+RECOUNT_SQL = '''
+    SELECT coalesce(p.class_id, 0), coalesce(p.gender_id, 0), stats_bucket(p.created_at),
+           coalesce(f.activity1, FALSE), coalesce(f.activity2, FALSE), coalesce(f.transport, FALSE),
+           count(*)
+    FROM people p
+    LEFT JOIN (
+        SELECT person_id, bool_or(activity1) AS activity1, bool_or(activity2) AS activity2,
+               bool_or(transport) AS transport
+        FROM activities
+        GROUP BY person_id
+    ) f ON f.person_id = p.id
+    GROUP BY 1, 2, 3, 4, 5, 6'''
+
+
+def parse_bucket(args):
+    """The ?bucket= granularity for the created_at breakdown, month by default"""
+    bucket = args.get('bucket', 'month')
+    if bucket not in BUCKETS:
+        raise ValueError(f"Invalid value for bucket: {bucket} (expected one of {', '.join(BUCKETS)})")
+    return bucket
+
+
+def grouped_counts(cur, bucket='month', class_names=None, gender_names=None):
+    """People and activity flag counts overall, per class, per gender, per
+    class and gender, and per created_at ``bucket``.
+
+    ``class_names`` and ``gender_names`` map ids to the names reported.
+    """
+    cur.execute(STATS_QUERY, (bucket,))
+    return summarize(cur.fetchall(), class_names, gender_names)
+
+
+def summarize(rows, class_names=None, gender_names=None):
+    """grouped_counts() for STATS_QUERY rows already fetched"""
+    class_names = class_names or {}
+    gender_names = gender_names or {}
+    result = {'total': None, 'by_class': [], 'by_gender': [], 'by_class_gender': [], 'by_created': []}
+    for all_classes, all_genders, all_buckets, class_id, gender_id, day, *counts in rows:
+        entry = dict(zip(('people',) + FLAGS, (int(count) for count in counts)))
+        if not all_classes:
+            entry = {'class': class_names.get(class_id) if class_id else None, **entry}
+        if not all_genders:
+            entry = {'gender': gender_names.get(gender_id) if gender_id else None, **entry}
+        if not all_buckets:
+            result['by_created'].append({'bucket': day.isoformat(), **entry})
+        elif not all_classes and not all_genders:
+            result['by_class_gender'].append(entry)
+        elif not all_classes:
+            result['by_class'].append(entry)
+        elif not all_genders:
+            result['by_gender'].append(entry)
+        else:
+            result['total'] = entry
+    if result['total'] is None:
+        result['total'] = dict.fromkeys(('people',) + FLAGS, 0)
+    return result
+
+
+def fold():
+    """Move the committed deltas into the rollup; returns how many.
+    Skipped while another process folds."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('stats_fold'))")
+            folded = 0
+            if cur.fetchone()[0]:
+                cur.execute('SELECT stats_fold()')
+                folded = cur.fetchone()[0]
+        conn.commit()
+    return folded
+
+
+class Folder:
+    """Background thread folding the deltas into the rollup every ``interval`` seconds"""
+
+    def __init__(self, interval=STATS_FOLD_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {'runs': 0, 'folded': 0, 'failures': 0}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                folded = fold()
+            except (psycopg2.Error, PoolTimeout) as e:
+                print(f'folding the stats deltas failed: {e}', file=sys.stderr)
+                self.stats['failures'] += 1
+                continue
+            self.stats['runs'] += 1
+            self.stats['folded'] += folded
+
+    def ensure_running(self):
+        """Start this process's folder if it is not running yet"""
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='stats-folder', daemon=True).start()
+            self._pid = os.getpid()
+
+
+folder = Folder()
+
+
+def rebuild():
+    """Recount the rollup from the tables, in one transaction"""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('LOCK TABLE stats_rollup IN EXCLUSIVE MODE')
+            cur.execute('SELECT stats_rebuild()')
+        conn.commit()
+
+
+def check():
+    """Rollup keys whose count differs from a fresh recount, as
+    ``(key, rollup count, recounted)`` tuples"""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cur.execute(ROLLUP_SQL)
+            rollup = {tuple(row[:6]): row[6] for row in cur.fetchall()}
+            cur.execute(RECOUNT_SQL)
+            recount = {tuple(row[:6]): row[6] for row in cur.fetchall()}
+        conn.rollback()
+    return [(key, rollup.get(key, 0), recount.get(key, 0))
+            for key in sorted(rollup.keys() | recount.keys(), key=str)
+            if rollup.get(key, 0) != recount.get(key, 0)]
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['fold']:
+        print(f'Folded {fold()} stats deltas')
+    elif sys.argv[1:] == ['rebuild']:
+        rebuild()
+        print('Rebuilt the stats rollup')
+    elif sys.argv[1:] == ['check']:
+        mismatches = check()
+        for key, counted, expected in mismatches:
+            print(f'{key}: rollup has {counted}, tables have {expected}')
+        print(f'{len(mismatches)} mismatched keys')
+        sys.exit(1 if mismatches else 0)
+    else:
+        print('usage: python stats.py fold|rebuild|check')
+        sys.exit(2)
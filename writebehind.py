@@ -0,0 +1,242 @@
+"""Write-behind queue for activity flag toggles.
+
+With WRITE_BEHIND_ENABLED, PUT /activities/<id> only records the new flag
+values and answers 202; a background thread per worker writes everything
+recorded in the last WRITE_BEHIND_INTERVAL seconds with one batched UPDATE.
+Only the last value of each (activity_id, field) is kept, so a burst of
+toggles costs one row update and the database sees one commit per interval.
+
+Accepted toggles are appended to a spill file in WRITE_BEHIND_DIR before
+the request is answered, and the file is only removed once its toggles are
+committed.  A worker replays the files left by workers that died without
+flushing, from warm-up and then every interval; on a clean exit (gunicorn's worker_exit hook, or atexit) the
+queue is flushed first.  Toggles still queued are not visible to reads, and
+a direct write to the same flag inside the window may be overwritten.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import psycopg2
+
+from batch import update_activities
+from db import PoolTimeout, get_connection
+
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', '0') not in ('0', 'false', 'False', '')
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.5))
+WRITE_BEHIND_DIR = os.environ.get('WRITE_BEHIND_DIR', os.path.join(tempfile.gettempdir(), 'write-behind'))
+# fsync every append: survives power loss, not just a crashed worker, at
+# the cost of a disk flush per toggle
+WRITE_BEHIND_FSYNC = os.environ.get('WRITE_BEHIND_FSYNC', '0') not in ('0', 'false', 'False', '')
+
+
+class WriteBehindQueue:
+    """Pending flag values by activity id, spilled to append-only segment files.
+
+    Each worker appends to its own segment, ``activities-<pid>-<n>.log``,
+    one JSON line per accepted toggle.  A flush swaps the pending values
+    and the segment for fresh ones, writes the values in one transaction
+    and deletes the segment after the commit.  If the write fails, the
+    values go back into the queue under anything newer and the segment is
+    kept until a later flush succeeds.
+
+    A worker holds an exclusive flock on every segment it owns until the
+    segment is deleted.  The kernel drops the lock when the process dies,
+    so a segment whose lock can be taken has been orphaned; a PID in the
+    name says nothing, as it may have been reused.
+    """
+
+    def __init__(self, directory=WRITE_BEHIND_DIR, interval=WRITE_BEHIND_INTERVAL, fsync=WRITE_BEHIND_FSYNC):
+        self.directory = directory
+        self.interval = interval
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._segment = None
+        self._segment_number = 0
+        self._unflushed = []
+        self._pid = None
+        self.stats = {'queued': 0, 'coalesced': 0, 'flushes': 0, 'rows_flushed': 0, 'not_found': 0,
+                      'failures': 0, 'recovered': 0}
+
+    def _open_segment(self):
+        self._segment_number += 1
+        name = f'activities-{os.getpid()}-{self._segment_number}.log'
+        # Locked before it gets a name that recovery looks for
+        hidden = os.path.join(self.directory, f'.{name}.tmp')
+        fd = os.open(hidden, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+        path = os.path.join(self.directory, name)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.rename(hidden, path)
+        except OSError:
+            os.close(fd)
+            os.remove(hidden)
+            raise
+        self._segment = (path, fd)
+
+    def _claim(self, path):
+        """Lock and rename an orphaned segment; returns ``(path, fd)`` or None
+        if a live worker owns it or someone else claimed it first"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Claimed and deleted by another worker between open() and flock()
+            if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+            # Still named after a worker, so it is recovered again if this one dies too
+            claimed = os.path.join(self.directory, f'activities-{os.getpid()}-recovered-{os.path.basename(path)}')
+            os.rename(path, claimed)
+        except (BlockingIOError, FileNotFoundError):
+            os.close(fd)
+            return None
+        return claimed, fd
+
+    def _merge(self, updates, under=False):
+        """Fold ``{activity_id: {field: value}}`` into the queue; with ``under``
+        the values already queued win"""
+        for activity_id, fields in updates.items():
+            pending = self._pending.setdefault(activity_id, {})
+            for field, value in fields.items():
+                if field in pending:
+                    if under:
+                        continue
+                    self.stats['coalesced'] += 1
+                pending[field] = value
+
+    def _recover(self):
+        """Take over the segments of workers that are gone and queue their
+        toggles under the ones this worker already holds"""
+        owned = {self._segment[0]} if self._segment else set()
+        owned.update(path for path, _ in self._unflushed)
+        for path in sorted(glob.glob(os.path.join(self.directory, 'activities-*.log'))):
+            if path in owned:
+                continue
+            segment = self._claim(path)
+            if segment is None:
+                continue
+            recovered = {}
+            try:
+                with open(segment[0]) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # A line cut short by the crash was never acknowledged
+                            continue
+                        recovered.setdefault(entry['activity_id'], {}).update(entry['fields'])
+                        self.stats['recovered'] += 1
+            except Exception:
+                # Unlocked, so the next pass claims it again
+                os.close(segment[1])
+                raise
+            self._merge(recovered, under=True)
+            self._unflushed.append(segment)
+
+    def start(self):
+        """Per process: recover orphaned segments and start the flusher"""
+        if self._pid == os.getpid():
+            return
+        # State inherited across fork() belongs to the parent
+        self._pending = {}
+        self._unflushed = []
+        self._segment = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        self._open_segment()
+        threading.Thread(target=self._run, name='write-behind', daemon=True).start()
+        self._pid = os.getpid()
+
+    def put(self, activity_id, fields):
+        """Queue new values for ``fields`` of ``activity_id``; durable on return"""
+        line = (json.dumps({'activity_id': activity_id, 'fields': fields}) + '\n').encode()
+        with self._lock:
+            self.start()
+            os.write(self._segment[1], line)
+            if self.fsync:
+                os.fsync(self._segment[1])
+            self._merge({activity_id: fields})
+            self.stats['queued'] += 1
+
+    def _requeue(self, batch, segments):
+        """Put back a batch whose flush failed, under anything queued since"""
+        with self._lock:
+            self._merge(batch, under=True)
+            self._unflushed = segments + self._unflushed
+            self.stats['failures'] += 1
+
+    def flush(self):
+        """Write everything queued so far in one transaction; returns the rows updated"""
+        with self._flush_lock:
+            with self._lock:
+                if self._pid != os.getpid() or not self._pending:
+                    return 0
+                current = self._segment
+                # Opened first: if it fails, the queue and its segments stay as they are
+                self._open_segment()
+                batch, self._pending = self._pending, {}
+                # Kept open, and so locked, until deleted
+                segments, self._unflushed = self._unflushed + [current], []
+            try:
+                with get_connection() as conn:
+                    with conn.cursor() as cur:
+                        updated = update_activities(cur, batch)
+                    conn.commit()
+            except (psycopg2.Error, PoolTimeout) as e:
+                print(f'write-behind flush of {len(batch)} activities failed: {e}', file=sys.stderr)
+                self._requeue(batch, segments)
+                return 0
+            except Exception:
+                self._requeue(batch, segments)
+                raise
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['rows_flushed'] += len(updated)
+                self.stats['not_found'] += len(batch) - len(updated)
+            for path, fd in segments:
+                os.remove(path)
+                os.close(fd)
+            return len(updated)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self._lock:
+                    self._recover()
+                self.flush()
+            except Exception as e:
+                # Keep going: the toggles stay queued and on disk for the next pass
+                print(f'write-behind flusher failed: {e}', file=sys.stderr)
+                with self._lock:
+                    self.stats['failures'] += 1
+
+    def shutdown(self):
+        """Flush before the worker exits; anything left stays in the spill file"""
+        if self._pid != os.getpid():
+            return
+        self.flush()
+        with self._lock:
+            if not self._pending and not self._unflushed:
+                os.remove(self._segment[0])
+                os.close(self._segment[1])
+                self._pid = None
+
+    def status(self):
+        with self._lock:
+            return {'enabled': WRITE_BEHIND_ENABLED, 'pending': sum(map(len, self._pending.values())),
+                    'interval': self.interval, **self.stats}
+
+
+queue = WriteBehindQueue()
+atexit.register(queue.shutdown)